@@ -0,0 +1,268 @@
+'''asyncio versions of the transfer functions, for pushing lots of small files from one process'''
+import asyncio
+import hashlib
+import os
+import pathlib
+import random
+
+import aiohttp
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob import BlobBlock, ContentSettings, StandardBlobTier, RehydratePriority
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient, BlobClient
+
+from .azure_client import get_md5sum
+from .logger import log
+from .compress import codec_of
+from .dedup import is_chunked
+from .manifest import stored_md5, stored_size
+from .metrics import metrics
+from .transfer import DEFAULT_BLOCK_SIZE, TRANSACTIONAL_CHECK, block_id, pick_block_size
+from .workers import THROTTLED, retry_after
+
+DEFAULT_CONCURRENCY = 256
+
+def connect_service(url: str,
+                    creds: str,
+                    pool_size=DEFAULT_CONCURRENCY,
+                    max_single_put_size=None,
+                    max_block_size=None,
+                    max_chunk_get_size=None,
+                    connection_timeout=None,
+                    read_timeout=None
+                   ) -> BlobServiceClient:
+    '''
+    Async service client on one shared aiohttp session whose connection pool matches the concurrency.
+    Takes the same settings as azure_client.connect_service. Has to be called inside the running loop,
+    close it with close_service.
+    '''
+    options = {k: v for k, v in (
+        ('max_single_put_size', max_single_put_size),
+        ('max_block_size', max_block_size),
+        ('max_chunk_get_size', max_chunk_get_size),
+    ) if v is not None}
+    timeouts = {k: v for k, v in (
+        ('connection_timeout', connection_timeout),
+        ('read_timeout', read_timeout),
+    ) if v is not None}
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size or DEFAULT_CONCURRENCY))
+    transport = AioHttpTransport(session=session, session_owner=False, **timeouts)
+    service = BlobServiceClient(account_url=url, credential=creds, transport=transport, **options)
+    service.session = session
+    return service
+
+async def close_service(service: BlobServiceClient) -> None:
+    await service.close()
+    await service.session.close()
+
+def _read_chunk(fp, size):
+    return fp.read(size)
+
+async def upload_file(blob_client: BlobClient,
+                      filename: str,
+                      tier: StandardBlobTier,
+                      block_size=DEFAULT_BLOCK_SIZE
+                     ) -> (dict, str):
+    '''Same as transfer.upload_file, one read with the md5 worked out on the way. Returns (operation, md5).'''
+    file_size = os.path.getsize(filename)
+    block_size = pick_block_size(file_size, block_size)
+    file_hash = hashlib.md5()
+    with open(filename, 'rb') as fp:
+        if file_size <= block_size:
+            data = await asyncio.to_thread(_read_chunk, fp, -1)
+            file_hash.update(data)
+            with metrics.request('put_blob'):
+                operation = await blob_client.upload_blob(
+                    data,
+                    length=len(data),
+                    overwrite=True,
+                    standard_blob_tier=tier,
+                    content_settings=ContentSettings(content_md5=bytearray(file_hash.digest())),
+                    metadata={'md5': file_hash.hexdigest()},
+                    validate_content=TRANSACTIONAL_CHECK
+                )
+            metrics.inc('azure_bytes_total', len(data), direction='upload')
+            return operation, file_hash.hexdigest()
+
+        block_list = []
+        while chunk := await asyncio.to_thread(_read_chunk, fp, block_size):
+            file_hash.update(chunk)
+            chunk_id = block_id(len(block_list))
+            with metrics.request('stage_block'):
+                await blob_client.stage_block(chunk_id, chunk, length=len(chunk), validate_content=TRANSACTIONAL_CHECK)
+            metrics.inc('azure_bytes_total', len(chunk), direction='upload')
+            block_list.append(BlobBlock(block_id=chunk_id))
+    with metrics.request('commit_block_list'):
+        operation = await blob_client.commit_block_list(
+            block_list,
+            content_settings=ContentSettings(content_md5=bytearray(file_hash.digest())),
+            metadata={'md5': file_hash.hexdigest()},
+            standard_blob_tier=tier
+        )
+    return operation, file_hash.hexdigest()
+
+async def upload_blob(container_client: ContainerClient,
+                      filename: str,
+                      azure_filename: str,
+                      tier: StandardBlobTier,
+                      md5sums=None,
+                      update=False,
+                      overwrite=False,
+                      remote=None,
+                      block_size=DEFAULT_BLOCK_SIZE,
+                      index=None
+                     ) -> dict:
+    '''Coroutine version of azure_client.upload_blob, same update/overwrite/remote/index rules.'''
+    operation = {'operation': 'no-op'} # Default return
+    blob_client = container_client.get_blob_client(azure_filename)
+    file_stat = os.stat(filename)
+
+    if update:
+        if remote is None:
+            with metrics.request('get_properties'):
+                blob_properties = await blob_client.get_blob_properties()
+            blob_md5, blob_size = stored_md5(blob_properties), stored_size(blob_properties)
+        else:
+            blob_md5, blob_size = remote.md5, remote.size
+        file_md5 = None
+        if blob_size == file_stat.st_size and md5sums is not None:
+            file_md5 = await asyncio.to_thread(md5sums.get_md5sum, filename)
+        if file_md5 == blob_md5:
+            log.info('MD5Sums Match - no-op')
+            metrics.inc('files_total', operation='skip')
+            metrics.inc('skipped_bytes_total', file_stat.st_size)
+            return operation
+        if not overwrite:
+            log.info('MD5Sum Mismatch - Set not to overwrite. Will not send %s', filename)
+            metrics.inc('files_total', operation='skip')
+            metrics.inc('skipped_bytes_total', file_stat.st_size)
+            return operation
+        log.info('MD5sum Mismatch - Sending local copy of %s', filename)
+    else:
+        log.info('%s not found in container, sending local file.', filename)
+
+    operation, file_md5 = await upload_file(blob_client, filename, tier, block_size)
+    log.info('Uploaded: %s, request_id: %s', filename, operation['request_id'])
+    metrics.inc('files_total', operation='upload')
+    if md5sums is not None:
+        await asyncio.to_thread(md5sums.record_md5sum, filename, file_md5, file_stat)
+    if index is not None:
+        await asyncio.to_thread(index.record, azure_filename, file_stat.st_size, tier, file_md5, operation.get('etag'))
+    return operation
+
+async def download_blob(blob: BlobClient, blob_info, destination: str, overwrite: bool) -> dict:
+    '''Coroutine version of azure_client.download_blob, the md5 is checked on the stream as it lands.'''
+    destination_filename = pathlib.Path(f'{destination}/{blob.blob_name}')
+    blob_md5 = stored_md5(blob_info) or None
+    operation = {'operation': 'no-op'} # Default return
+
+    if is_chunked(blob_info) or codec_of(blob_info):
+        log.error('%s is a dedup manifest or compressed, download it without --async.', blob.blob_name)
+        metrics.inc('files_total', operation='failed')
+        return operation
+
+    if os.path.isfile(destination_filename):
+        if not overwrite:
+            log.error('file %s already exists and is not set to overwrite.', destination_filename)
+            metrics.inc('files_total', operation='skip')
+            metrics.inc('skipped_bytes_total', stored_size(blob_info))
+            return operation
+        local_md5 = await asyncio.to_thread(get_md5sum, destination_filename)
+        if local_md5 == blob_md5:
+            log.info('local md5sum matches azure md5sum of %s', local_md5)
+            metrics.inc('files_total', operation='skip')
+            metrics.inc('skipped_bytes_total', stored_size(blob_info))
+            return operation
+
+    os.makedirs(destination_filename.parent, exist_ok=True)
+    for attempt in range(3):
+        file_hash = hashlib.md5()
+        with metrics.request('get_blob'):
+            downloader = await blob.download_blob(validate_content=TRANSACTIONAL_CHECK)
+            with open(destination_filename, 'wb') as fp:
+                async for chunk in downloader.chunks():
+                    file_hash.update(chunk)
+                    fp.write(chunk)
+                    metrics.inc('azure_bytes_total', len(chunk), direction='download')
+        if blob_md5 is None or file_hash.hexdigest() == blob_md5:
+            log.info('Downloaded %s to %s, md5 %s', blob.blob_name, destination_filename, file_hash.hexdigest())
+            metrics.inc('files_total', operation='download')
+            return downloader.properties
+        log.error('downloaded file %s md5sum mismatch with cloud, attempt %d.', destination_filename, attempt + 1)
+        metrics.inc('md5_mismatches_total')
+    log.error('%s md5sum mismatch after 3 tries downloading, giving up.', destination_filename)
+    metrics.inc('files_total', operation='failed')
+    return operation
+
+async def set_blob_tier(blob: BlobClient, tier: StandardBlobTier, priority: RehydratePriority) -> None:
+    '''Set/change blob tier'''
+    log.info('Setting blob tier for %s to %s with priority %s', blob.blob_name, tier.value, priority.value)
+    with metrics.request('set_tier'):
+        await blob.set_standard_blob_tier(tier, rehydrate_priority=priority)
+    metrics.inc('tier_changes_total', result='sent')
+
+async def iterate_in_thread(items):
+    '''Async iterator over a blocking iterable, each next() runs in a thread so the loop keeps going.'''
+    items = iter(items)
+    done = object()
+    while (item := await asyncio.to_thread(next, items, done)) is not done:
+        yield item
+
+async def run_pool(func, items, concurrency=DEFAULT_CONCURRENCY, max_attempts=5, base_delay=1.0,
+                   max_delay=60.0, describe=str) -> list:
+    '''
+    asyncio counterpart of workers.WorkerPool. Awaits func(item) for every item (a normal or async
+    iterable, consumed lazily) with at most concurrency in flight, retrying with jittered exponential
+    backoff. Returns the dead letters as [(item, exception)].
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    dead_letters = []
+    tasks = set()
+
+    async def process(item):
+        try:
+            for attempt in range(max_attempts):
+                try:
+                    with metrics.span('item', item=describe(item), attempt=attempt):
+                        await func(item)
+                    metrics.inc('worker_items_total', result='done')
+                    return
+                except Exception as e:
+                    if attempt + 1 >= max_attempts:
+                        log.error('Giving up on %s after %d attempts.', describe(item), attempt + 1, exc_info=e)
+                        metrics.inc('worker_items_total', result='failed')
+                        dead_letters.append((item, e))
+                        return
+                    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+                    delay = max(delay, retry_after(e))
+                    status = e.status_code if isinstance(e, HttpResponseError) else None
+                    metrics.inc('worker_retries_total', throttled=str(status in THROTTLED).lower())
+                    if status in THROTTLED:
+                        log.warning('Throttled (%s) on %s, retrying in %.1fs', status, describe(item), delay)
+                    else:
+                        log.error('Failed on %s, retrying in %.1fs', describe(item), delay, exc_info=e)
+                    await asyncio.sleep(delay)
+        finally:
+            semaphore.release()
+
+    async def feed():
+        if hasattr(items, '__aiter__'):
+            async for item in items:
+                yield item
+        else:
+            for item in items:
+                yield item
+
+    metrics.gauge_callback('workers_busy', lambda: len(tasks))
+    async for item in feed():
+        await semaphore.acquire() # Backpressure, never more than concurrency tasks alive
+        task = asyncio.create_task(process(item))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+    if dead_letters:
+        log.error('%d items failed for good:', len(dead_letters))
+        for item, e in dead_letters:
+            log.error('  %s: %s', describe(item), e)
+    return dead_letters
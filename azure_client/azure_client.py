@@ -1,155 +1,389 @@
 '''set of functions to connect to azure and handle interactions to make scripting easier'''
-from datetime import datetime
-import hashlib
+import argparse
+from collections import Counter
 import os
 import pathlib
-from sys import stderr
 import threading
-from time import sleep
 
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.blob import BlobServiceClient, ContainerClient, BlobClient, BlobProperties
 from azure.storage.blob import StandardBlobTier, RehydratePriority
+import requests
+
 from .logger import log
+from .journal import BlockJournal
+from .limiter import Limiter
+from . import compress
+from .compress import codec_of
+from .blob_index import BlobIndex
+from .dedup import ChunkStore, is_chunked
+from .manifest import RemoteBlob, stored_md5, stored_size
+from .md5summer import md5_file
+from .metrics import metrics, THROTTLED
+from .transfer import TransferBudget, upload_file, download_file, DEFAULT_BLOCK_SIZE, DEFAULT_CHUNK_SIZE
+
+BATCH_SIZE = 256 # Most sub-requests the service takes in one blob batch
+ONLINE_TIERS = ('Hot', 'Cool', 'Cold') # Readable straight away, everything else needs rehydrating first
+DEFAULT_POOL_SIZE = 10 # Same as requests, enough for the single file scripts
+CONNECTION_SETTINGS = {
+    'pool_size': int,
+    'max_single_put_size': int,
+    'max_block_size': int,
+    'max_chunk_get_size': int,
+    'connection_timeout': float,
+    'read_timeout': float,
+}
+_known_containers = set() # (account url, container) pairs connect_container already checked
 
 def get_md5sum(filename: str) -> str:
-    with open(filename, 'rb') as fp:
-        file_hash = hashlib.md5()
-        while chunk := fp.read(8192):
-            file_hash.update(chunk)
-    log.debug(f'Calculated md5 {file_hash.hexdigest()}')
-    return file_hash.hexdigest()
+    file_md5 = md5_file(filename)
+    log.debug('Calculated md5 %s', file_md5)
+    return file_md5
 
-def connect_service(url: str, creds: str) -> BlobServiceClient:
-    '''Connect to the main service, maybe write new ways to connect later'''
-    return BlobServiceClient(account_url=url, credential=creds)
+def add_connection_arguments(parser: argparse.ArgumentParser) -> None:
+    '''Transport flags every script shares, see connection_settings for the environment fallbacks.'''
+    group = parser.add_argument_group('connection', 'each can also be set as AZURE_<NAME> in the environment or .env')
+    group.add_argument('--pool-size', type=int,
+                       help='HTTP connections kept alive, defaults to the requests in flight, 0 keeps the SDK default')
+    group.add_argument('--max-single-put-size', type=int, help='MiB, bigger single puts get split by the SDK')
+    group.add_argument('--max-block-size', type=int, help='MiB per block when the SDK splits a put')
+    group.add_argument('--max-chunk-get-size', type=int, help='MiB per request when the SDK splits a get')
+    group.add_argument('--connection-timeout', type=float, help='Seconds to wait for a connection')
+    group.add_argument('--read-timeout', type=float, help='Seconds to wait on each read of a response')
 
-def connect_container(service: BlobServiceClient, container: str, create=True) -> ContainerClient:
+def connection_settings(args=None, pool_size=DEFAULT_POOL_SIZE) -> dict:
     '''
-    Parse options for container name to upload,
-    compare to list to see if container needs to be created
+    Keyword arguments for connect_service from the flags add_connection_arguments made, falling back to
+    AZURE_POOL_SIZE, AZURE_MAX_SINGLE_PUT_SIZE and so on from the environment, then to pool_size (pass the
+    scripts connection budget) and the SDK defaults. Sizes are given in MiB.
     '''
-    container_list = [x for x in service.list_containers()]
-    container_names = [x['name'] for x in container_list]
+    settings = {'pool_size': pool_size}
+    for name, kind in CONNECTION_SETTINGS.items():
+        value = getattr(args, name, None)
+        if value is None:
+            value = os.getenv(f'AZURE_{name.upper()}') or None
+        if value is None:
+            continue
+        value = kind(value)
+        settings[name] = value * 1024 * 1024 if name.startswith('max_') else value
+    return settings
 
-    container_client = service.get_container_client(container)
+def connect_service(url: str,
+                    creds: str,
+                    pool_size=DEFAULT_POOL_SIZE,
+                    max_single_put_size=None,
+                    max_block_size=None,
+                    max_chunk_get_size=None,
+                    connection_timeout=None,
+                    read_timeout=None,
+                    limiter: Limiter = None
+                   ) -> BlobServiceClient:
+    '''
+    Connect to the main service on one keep-alive session holding pool_size connections, which every worker
+    shares, so size it to the requests in flight or connections get thrown away and opened again all run.
+    pool_size=0 leaves the SDK's own transport. Sizes are bytes, None keeps the SDK defaults. A Limiter
+    paces every request the client sends, retries included.
+    '''
+    options = {k: v for k, v in (
+        ('max_single_put_size', max_single_put_size),
+        ('max_block_size', max_block_size),
+        ('max_chunk_get_size', max_chunk_get_size),
+        ('connection_timeout', connection_timeout),
+        ('read_timeout', read_timeout),
+    ) if v is not None}
+    if pool_size:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        timeouts = {k: options.pop(k) for k in ('connection_timeout', 'read_timeout') if k in options}
+        options['transport'] = RequestsTransport(session=session, **timeouts)
+    if limiter is not None:
+        options['raw_request_hook'] = limiter.request_hook
+        options['raw_response_hook'] = limiter.response_hook
+    return BlobServiceClient(account_url=url, credential=creds, **options)
 
-    if container not in container_names and create: # Meaning no container setup yet.
-        operation = container_client.create_container()
-        if operation['error_code'] is not None:
-            raise Exception(operation['error_code'])
-        else:
-            log.info(f"Created container {container}, request_id: {operation['request_id']}.")
-    elif container not in container_names and not create:
-        log.error(f'Container {container} not found.')
-        exit(1)
+def connect_container(service: BlobServiceClient, container: str, create=True) -> ContainerClient:
+    '''
+    Client for container, checked with one exists call instead of listing the account, and created if it
+    isn't there and create is set (another process creating it first is fine). Containers already checked
+    in this process aren't asked about again.
+    '''
+    container_client = service.get_container_client(container)
+    if (service.url, container) in _known_containers:
+        return container_client
 
+    if not container_client.exists():
+        if not create:
+            log.error('Container %s not found.', container)
+            exit(1)
+        try:
+            operation = container_client.create_container()
+            log.info('Created container %s, request_id: %s.', container, operation['request_id'])
+        except ResourceExistsError:
+            log.debug('Container %s was created by someone else in the meantime.', container)
 
+    _known_containers.add((service.url, container))
     return container_client
 
-def get_blob_manifest(container_client: ContainerClient) -> (list):
-    '''Returns list of filenames.'''
-    return [y.name for y in [x for x in container_client.list_blobs()]]
+def iter_blobs(container_client: ContainerClient, name_starts_with=None, include=None):
+    '''
+    Lazily yields BlobProperties a page at a time as the listing comes back, so callers can start work on
+    the first page and never hold the whole container in memory.
+    '''
+    for page in container_client.list_blobs(name_starts_with=name_starts_with, include=include).by_page():
+        yield from page
+
+def get_blob_manifest(container_client: ContainerClient, name_starts_with=None):
+    '''Yields filenames.'''
+    return (x.name for x in iter_blobs(container_client, name_starts_with))
+
+def get_blob_list_information(container_client: ContainerClient, name_starts_with=None):
+    '''Yields tuples with information about blobs..'''
+    return ((x.name, x.blob_tier, x.size) for x in iter_blobs(container_client, name_starts_with))
+
+def set_blob_tier(blob: BlobClient, tier: StandardBlobTier, priority: RehydratePriority, check=False) -> None:
+    '''Set/change blob tier, check=True spends another request to log where the blob ended up'''
+    log.info('Setting blob tier for %s to %s with priority %s', blob.blob_name, tier.value, priority.value)
+    with metrics.request('set_tier'):
+        blob.set_standard_blob_tier(tier, rehydrate_priority=priority)
+    metrics.inc('tier_changes_total', result='sent')
+    if check:
+        INFO = blob.get_blob_properties()
+        log.info('blob %s tier is currently %s and archive_status is now at %s',
+                 blob.blob_name, INFO.blob_tier, INFO.archive_status)
 
-def get_blob_list_information(container_client: ContainerClient) -> (list):
-    '''Returns list of tuples with information about blobs..'''
-    return [(y.name, y.blob_tier, y.size) for y in [x for x in container_client.list_blobs()]]
+class BatchThrottled(Exception):
+    '''Raised with only the throttled blobs left in the batch, so a WorkerPool retry sends just those.'''
 
-def set_blob_tier(blob: BlobClient, tier: StandardBlobTier, priority: RehydratePriority) -> None:
-    '''Set/change blob tier'''
-    log.info(f'Setting blob tier for {blob.blob_name} to {tier.value} with priority {priority.value}')
-    blob.set_standard_blob_tier(tier, rehydrate_priority=priority)
-    INFO = blob.get_blob_properties()
-    log.info(f'blob {blob.blob_name} tier is currently {INFO.blob_tier} and archive_status is now at '
-             f'{INFO.archive_status}')
+def classify_tier_change(blob_info: BlobProperties, tier: StandardBlobTier) -> str:
+    '''skipped if already there, pending if already on its way there, None if it needs a tier change'''
+    if blob_info.blob_tier == tier.value:
+        return 'skipped'
+    if blob_info.archive_status == f'rehydrate-pending-to-{tier.value.lower()}':
+        return 'pending'
+    return None
+
+def set_blob_tier_batch(container_client: ContainerClient,
+                        batch: list,
+                        tier: StandardBlobTier,
+                        priority: RehydratePriority,
+                        counts: Counter,
+                        lock: threading.Lock,
+                        failed: list = None
+                       ) -> None:
+    '''
+    Sends one blob batch request changing the tier of up to BATCH_SIZE blob names and tallies each
+    sub-response into counts (changed, pending, failed), adding the names that failed to failed if given.
+    Throttled sub-requests are left in batch and BatchThrottled is raised so the caller can back off and
+    send just those again.
+    '''
+    with metrics.request('set_tier_batch'):
+        responses = container_client.set_standard_blob_tier_blobs(
+            tier, *batch, rehydrate_priority=priority, raise_on_any_failure=False
+        )
+    throttled = []
+    with lock:
+        for name, response in zip(batch, responses):
+            error_code = response.headers.get('x-ms-error-code')
+            if response.status_code in (200, 202):
+                counts['changed'] += 1
+            elif error_code == 'BlobBeingRehydrated':
+                counts['pending'] += 1
+            elif response.status_code in THROTTLED:
+                throttled.append(name)
+            else:
+                counts['failed'] += 1
+                if failed is not None:
+                    failed.append(name)
+                log.error('Could not set tier of %s: %s %s', name, response.status_code, error_code)
+    if throttled:
+        metrics.inc('azure_throttled_total', len(throttled), operation='set_tier_batch_item', status='mixed')
+    metrics.inc('tier_changes_total', len(batch) - len(throttled), result='sent')
+    log.info('Tier batch of %d sent, %d throttled.', len(batch), len(throttled))
+    if throttled:
+        batch[:] = throttled
+        raise BatchThrottled(f'{len(throttled)} blobs throttled')
+
+def batched(items, size: int):
+    '''Groups any iterable into lists of up to size without reading ahead more than one batch'''
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def upload_blob(container_client: ContainerClient,
                 filename: str,
                 azure_filename: str,
                 tier: StandardBlobTier,
-                md5sums,
+                md5sums=None,
                 update=False,
                 overwrite=False,
                 retries=0,
-                debug=False
+                debug=False,
+                block_size=DEFAULT_BLOCK_SIZE,
+                max_concurrency=1,
+                budget: TransferBudget = None,
+                journal: BlockJournal = None,
+                remote: RemoteBlob = None,
+                chunks: ChunkStore = None,
+                codec: compress.Codec = None,
+                index: BlobIndex = None
                ) -> dict:
     '''
     Upload a file as a blob to the cloud, there is checking to see if the md5sum matches if its
-    already uploaded, by tagging the md5 in the metadata.
+    already uploaded, by tagging the md5 in the metadata. New files are hashed while they stream up,
+    so they are only read once; a cached md5sum is trusted to skip unchanged files without reading them.
+    Big files are split into block_size blocks, max_concurrency of them going up at once inside budget.
+    Passing a BlockJournal makes big uploads resumable after a crash. Passing the RemoteBlob from a
+    container listing saves the get_blob_properties call, and a size mismatch skips hashing altogether.
+    With a ChunkStore, files of at least its max chunk size go up deduplicated, only chunks it hasn't
+    stored before are sent and the blob itself becomes a small manifest. With a Codec the rest are sent
+    compressed, a frame per block (not resumable, the journal is only used for blobs sent as they are).
+    Passing a BlobIndex records what was sent in it, so the next run can plan without listing.
     '''
     #TODO: Make this log better, more readable, kinda a mess rn
-    file_md5 = md5sums.get_md5sum(filename)
     operation = {'operation': 'no-op'} # Default return
 
     blob_client = container_client.get_blob_client(azure_filename)
+    file_stat = os.stat(filename) # Taken before reading so a change mid-upload isn't cached as fresh
+    chunked = chunks is not None and file_stat.st_size >= chunks.max_size
+
+    def send():
+        if chunked:
+            return chunks.upload_file(blob_client, filename, tier, max_concurrency, budget)
+        if codec is not None:
+            return compress.upload_file(blob_client, filename, tier, codec, block_size, max_concurrency, budget)
+        return upload_file(blob_client, filename, tier, block_size, max_concurrency, budget, journal)
 
     if update:
-        blob_properties = blob_client.get_blob_properties()
-        try:
-            blob_md5 = blob_properties['metadata']['md5']
-        except KeyError:
-            blob_md5 = ''
-        log.info(f"Already in container. {azure_filename} cloud md5: {blob_md5}, {filename} local md5: {file_md5}")
+        if remote is None:
+            with metrics.request('get_properties'):
+                blob_properties = blob_client.get_blob_properties()
+            blob_md5, blob_size = stored_md5(blob_properties), stored_size(blob_properties)
+        else:
+            blob_md5, blob_size = remote.md5, remote.size
+        if blob_size != file_stat.st_size:
+            file_md5 = None # Can't match, no point reading it just to find out
+        else:
+            # Only read the file to compare if nothing is cached, a mismatch streams it up again anyway.
+            file_md5 = md5sums.get_md5sum(filename) if md5sums is not None else get_md5sum(filename)
+        log.info('Already in container. %s cloud md5: %s, %s local md5: %s',
+                 azure_filename, blob_md5, filename, file_md5)
         if file_md5 != blob_md5: # TODO: Reorder to be cleaner
             if overwrite:
-                log.info(f'MD5sum Mismatch - Sending local copy of {filename}')
-                blob_client.delete_blob()
-                with open(filename, 'rb') as data:
-                    operation = blob_client.upload_blob(
-                        data,
-                        standard_blob_tier=tier,
-                        metadata={'md5': file_md5}
-                    )
+                log.info('MD5sum Mismatch - Sending local copy of %s', filename)
+                if journal is None and not chunked: # Would throw away blocks staged by an earlier run
+                    try:
+                        blob_client.delete_blob()
+                    except ResourceNotFoundError:
+                        pass # remote was a packed file (pack.Packer.remote_index), there is no plain blob yet
+                operation, file_md5 = send()
             else:
-                log.info(f'MD5Sum Mismatch - Set not to overwrite. Will not send {filename}')
+                log.info('MD5Sum Mismatch - Set not to overwrite. Will not send %s', filename)
         else:
-            log.info(f'MD5Sums Match - no-op')
+            log.info('MD5Sums Match - no-op')
     else:
-        log.info(f'{filename} not found in container, sending local file.')
-        with open(filename, 'rb') as data:
-            operation = blob_client.upload_blob(
-                data,
-                standard_blob_tier=tier,
-                metadata={'md5': file_md5}
-            )
-        log.info(f"Uploaded: {filename}, request_id: {operation['request_id']}"
-        )
+        log.info('%s not found in container, sending local file.', filename)
+        operation, file_md5 = send()
+        log.info('Uploaded: %s, request_id: %s', filename, operation['request_id'])
+    sent = operation.get('operation') != 'no-op'
+    metrics.inc('files_total', operation='upload' if sent else 'skip')
+    if not sent:
+        metrics.inc('skipped_bytes_total', file_stat.st_size)
+    if md5sums is not None and sent:
+        md5sums.record_md5sum(filename, file_md5, file_stat)
+    if index is not None and sent:
+        index.record(azure_filename, file_stat.st_size, tier, file_md5, operation.get('etag'))
     return operation
 
 
-def download_blob(blob: BlobClient, blob_info: BlobProperties, destination: str, overwrite: bool, attempt=0) -> dict:
+def download_blob(blob: BlobClient,
+                  blob_info: BlobProperties,
+                  destination: str,
+                  overwrite: bool,
+                  attempt=0,
+                  chunk_size=DEFAULT_CHUNK_SIZE,
+                  max_concurrency=1,
+                  budget: TransferBudget = None,
+                  chunks: ChunkStore = None
+                 ) -> dict:
+    '''
+    Download a blob to destination/blob name, fetching max_concurrency ranges at once. The md5 is checked on
+    the stream as it lands, so nothing gets read back off disk after the download. The blobs Content-MD5 is
+    what gets compared, falling back to the md5 metadata; blobs with neither only get the per range checks.
+    Dedup manifests are rebuilt from their chunks through chunks and compressed blobs are decompressed as
+    they stream in, blob_info needs the metadata to tell either.
+    '''
     destination_filename = pathlib.Path(f'{destination}/{blob.blob_name}')
-    blob_md5 = blob_info['metadata']['md5']
+    blob_md5 = stored_md5(blob_info)
+    blob_size = stored_size(blob_info)
     operation = {'operation': 'no-op'} # Default return
 
-    if not overwrite and os.path.isfile(destination_filename):
-        log.error(f'file {destination_filename} already exists and is not set to overwrite.')
+    if attempt > 0:
+        pass # The file there is our own bad download, fetch it again
+    elif not overwrite and os.path.isfile(destination_filename):
+        log.error('file %s already exists and is not set to overwrite.', destination_filename)
         local_md5 = get_md5sum(destination_filename)
-        log.error(f'local md5: {local_md5}, azure md5: {blob_md5}')
+        log.error('local md5: %s, azure md5: %s', local_md5, blob_md5)
+        metrics.inc('files_total', operation='skip')
+        metrics.inc('skipped_bytes_total', blob_size)
         return operation
     elif overwrite and os.path.isfile(destination_filename):
         local_md5 = get_md5sum(destination_filename)
-        log.info(f'file {destination_filename} already exists locally. md5: {local_md5}')
+        log.info('file %s already exists locally. md5: %s', destination_filename, local_md5)
         if local_md5 == blob_md5:
-            log.info(f'local md5sum matches azure md5sum of {local_md5}')
+            log.info('local md5sum matches azure md5sum of %s', local_md5)
+            metrics.inc('files_total', operation='skip')
+            metrics.inc('skipped_bytes_total', blob_size)
             return operation
 
-    log.info(f'Downloading {blob.blob_name} to {destination}/{blob.blob_name}.')
+    log.info('Downloading %s to %s.', blob.blob_name, destination_filename)
     log.debug('Creating path %s.', destination_filename.parent)
     os.makedirs(destination_filename.parent, exist_ok=True)
 
-    with open(destination_filename, 'wb') as fp:
-        download_client = blob.download_blob()
-        operation = download_client.download_to_stream(fp)
-    local_md5 = get_md5sum(destination_filename)
+    if codec_of(blob_info):
+        local_md5 = compress.download_file(
+            blob,
+            destination_filename,
+            compress.get_codec(codec_of(blob_info)),
+            blob_info.size,
+            blob_info.etag,
+            chunk_size,
+            max_concurrency,
+            budget
+        )
+    elif is_chunked(blob_info):
+        if chunks is None:
+            raise ValueError(f'{blob.blob_name} is a dedup manifest, it needs a ChunkStore to download')
+        local_md5 = chunks.download_file(blob, destination_filename, blob_info.etag, max_concurrency, budget)
+    else:
+        local_md5 = download_file(
+            blob, destination_filename, blob_info.size, blob_info.etag, chunk_size, max_concurrency, budget
+        )
+    operation = {'operation': 'download', 'size': blob_size, 'md5': local_md5}
 
-    if local_md5 == blob_md5:
-        log.info(f'downloaded local md5sum of {destination_filename} matches azure md5sum of {local_md5}')
+    if not blob_md5:
+        log.info('%s has no md5 stored, only its ranges were checked. Downloaded md5 %s', blob.blob_name, local_md5)
+        metrics.inc('files_total', operation='download')
+    elif local_md5 == blob_md5:
+        log.info('downloaded local md5sum of %s matches azure md5sum of %s', destination_filename, local_md5)
+        metrics.inc('files_total', operation='download')
     else:
-        log.error(f'downloaded file {destination_filename} md5sum mismatch with cloud.')
+        log.error('downloaded file %s md5sum mismatch with cloud.', destination_filename)
+        metrics.inc('md5_mismatches_total')
         if attempt >= 2:
-            log.error(f'{destination_filename} md5sum mismatch after 3 tries downloading, giving up.')
+            log.error('%s md5sum mismatch after 3 tries downloading, giving up.', destination_filename)
+            metrics.inc('files_total', operation='failed')
             return operation
-        attempt =+ 1
-        operation = download_blob(blob, blob_info, destination, overwrite, attempt)
+        attempt += 1
+        operation = download_blob(
+            blob, blob_info, destination, overwrite, attempt, chunk_size, max_concurrency, budget, chunks
+        )
 
     return operation
@@ -0,0 +1,252 @@
+'''Local SQLite copy of a containers listing, so listing and planning don't have to ask the service every run'''
+import argparse
+import sqlite3
+import threading
+import time
+
+from azure.storage.blob import ContainerClient
+
+from .logger import log
+from .manifest import RemoteBlob, stored_md5, stored_size
+from .pack import INDEX_BLOB, INDEX_DIR, PackedFile, load_shard
+
+PREFIX_END = '\U0010ffff' # Sorts after anything a blob name can hold, so prefixes become ranges on the key
+
+def _prefix_range(prefix) -> (str, str):
+    prefix = prefix or ''
+    return prefix, prefix + PREFIX_END
+
+class BlobIndex:
+    '''
+    Name, size, tier, archive status, md5 and etag of every blob in one container. Sizes and md5s are the
+    ones of the file a blob holds (see manifest.stored_size/stored_md5), what planning compares against.
+    refresh() fills it from a listing a page at a time and keeps the marker of the next page, so a refresh
+    that gets interrupted carries on where it stopped next time instead of starting over, and blobs the
+    listing didn't see again are dropped once it finishes. The scripts record what they upload as they go,
+    so between refreshes the index only misses what other writers and the service itself changed.
+    Prefix queries are ranges on the primary key and there is an index on tier, summaries are aggregated
+    in SQLite, nothing is pulled row by row to answer them. The files in packs are kept too, from the pack
+    index shards, and a shard is only read again when its etag in the listing changed.
+    '''
+    def __init__(self, index_file: str, container: str):
+        self._lock = threading.Lock()
+        self.container = container
+        self.conn = sqlite3.connect(index_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, size INTEGER, tier TEXT, '
+                'archive_status TEXT, md5 TEXT, etag TEXT, seen INTEGER)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS blobs_tier ON blobs (tier, name)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS packed (name TEXT PRIMARY KEY, pack TEXT, offset INTEGER, '
+                'size INTEGER, md5 TEXT, shard TEXT)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS packed_shard ON packed (shard)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS shards (name TEXT PRIMARY KEY, etag TEXT)')
+        indexed = self._get('container')
+        if indexed is None:
+            self._set(container=container)
+        elif indexed != container:
+            raise ValueError(f'{index_file} is the index of container {indexed}, not {container}')
+
+    def _get(self, key: str):
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, **values) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', values.items())
+
+    def age(self) -> float:
+        '''Seconds since the last refresh finished, None if none ever did.'''
+        refreshed = self._get('refreshed')
+        return None if refreshed is None else time.time() - refreshed
+
+    def refresh(self, container_client: ContainerClient, name_starts_with=None) -> int:
+        '''
+        Brings the rows under name_starts_with (everything by default) in line with a listing, resuming an
+        unfinished listing of the same prefix from its marker. Returns the number of blobs listed.
+        '''
+        prefix = name_starts_with or ''
+        generation = self._get('generation') or 0
+        marker = None
+        if self._get('listing') == prefix and self._get('marker'):
+            marker = self._get('marker')
+            log.info('Resuming the listing of %s from where the last refresh stopped.', self.container)
+        else:
+            generation += 1
+            self._set(generation=generation, listing=prefix, marker=None)
+        listed = 0
+        pages = container_client.list_blobs(name_starts_with=name_starts_with, include=['metadata'])
+        pages = pages.by_page(continuation_token=marker)
+        for page in pages:
+            rows = [
+                (x.name, stored_size(x), x.blob_tier, x.archive_status, stored_md5(x), x.etag, generation)
+                for x in page
+            ]
+            with self._lock, self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                self.conn.execute("INSERT OR REPLACE INTO state VALUES ('marker', ?)", (pages.continuation_token,))
+            listed += len(rows)
+        with self._lock, self.conn:
+            gone = self.conn.execute(
+                'DELETE FROM blobs WHERE name >= ? AND name < ? AND seen < ?', (*_prefix_range(prefix), generation)
+            ).rowcount
+        self._set(listing=None, marker=None, **({'refreshed': time.time()} if not prefix else {}))
+        log.info('Index of %s refreshed: %d blobs listed, %d gone.', self.container, listed, gone)
+        self.sync_packs(container_client)
+        return listed
+
+    def ensure_fresh(self, container_client: ContainerClient, max_age: float) -> None:
+        '''Refreshes unless the last full refresh is under max_age seconds old, then catches up on the pack index.'''
+        age = self.age()
+        if age is not None and age < max_age and not self._get('marker'):
+            log.info('Using the index of %s from %.0f minutes ago, no listing needed.', self.container, age / 60)
+            self.sync_packs(container_client)
+            return
+        self.refresh(container_client)
+
+    def sync_packs(self, container_client: ContainerClient) -> int:
+        '''
+        Reads the pack index shards whose etag in the blobs table differs from the one they were last read
+        at, nothing when none changed. Returns the number of shards read.
+        '''
+        with self._lock:
+            listed = dict(self.conn.execute(
+                'SELECT name, etag FROM blobs WHERE name >= ? AND name < ?', _prefix_range(INDEX_DIR.rstrip('/'))
+            ))
+            known = dict(self.conn.execute('SELECT name, etag FROM shards'))
+        # The old single index blob first, entries in the shards replace its ones
+        changed = sorted((x for x in listed if listed[x] != known.get(x)), key=lambda x: x != INDEX_BLOB)
+        for shard in changed:
+            self._store_shard(shard, *load_shard(container_client, shard))
+        if INDEX_BLOB in known and INDEX_BLOB not in listed:
+            self._store_shard(INDEX_BLOB, None, {})
+            with self._lock, self.conn:
+                self.conn.execute('DELETE FROM shards WHERE name = ?', (INDEX_BLOB,))
+        if changed:
+            log.info('Read %d changed pack index shards of %s.', len(changed), self.container)
+        return len(changed)
+
+    def _store_shard(self, shard: str, etag: str, entries: dict) -> None:
+        verb = 'IGNORE' if shard == INDEX_BLOB else 'REPLACE'
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM packed WHERE shard = ?', (shard,))
+            self.conn.executemany(
+                f'INSERT OR {verb} INTO packed VALUES (?, ?, ?, ?, ?, ?)', ((*x, shard) for x in entries.values())
+            )
+            self.conn.execute('INSERT OR REPLACE INTO shards VALUES (?, ?)', (shard, etag))
+
+    def record_packs(self, saved: dict) -> None:
+        '''Write through for the {shard: (etag, entries)} pack.save_index returned.'''
+        for shard, (etag, entries) in saved.items():
+            self._store_shard(shard, etag, entries)
+            with self._lock, self.conn:
+                self.conn.execute('UPDATE blobs SET etag = ? WHERE name = ?', (etag, shard))
+
+    def query_packed(self, name_starts_with=None, tier=None):
+        '''
+        Yields (name, tier, size) of the packed files under the prefix in name order, with the tier of their
+        pack, optionally only those whose pack is in tier. Files that are plain blobs too are left to query().
+        '''
+        sql = ('SELECT p.name, b.tier, p.size FROM packed p LEFT JOIN blobs b ON b.name = p.pack '
+               'WHERE p.name >= ? AND p.name < ? AND NOT EXISTS (SELECT 1 FROM blobs x WHERE x.name = p.name)')
+        params = list(_prefix_range(name_starts_with))
+        if tier:
+            sql += ' AND b.tier = ?'
+            params.append(tier)
+        return self._stream(sql + ' ORDER BY p.name', params)
+
+    def pack_shards(self) -> dict:
+        '''{shard: (etag, {file name: PackedFile})} like pack.load_shards, for pack.save_index to start from.'''
+        with self._lock:
+            shards = {name: (etag, {}) for name, etag in self.conn.execute('SELECT name, etag FROM shards')}
+            for row in self.conn.execute('SELECT name, pack, offset, size, md5, shard FROM packed'):
+                shards[row[5]][1][row[0]] = PackedFile(*row[:5])
+        return shards
+
+    def record(self, name: str, size: int, tier: str, md5: str, etag=None, archive_status=None) -> None:
+        '''Write through for a blob this process just wrote, so the index stays current without a listing.'''
+        generation = self._get('generation') or 0
+        tier = getattr(tier, 'value', tier) # StandardBlobTier, listings give plain strings
+        with self._lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (name, size, tier, archive_status, md5, etag, generation)
+            )
+
+    def remove(self, name: str) -> None:
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM blobs WHERE name = ?', (name,))
+
+    def query(self, name_starts_with=None, tier=None):
+        '''Yields (name, tier, size, archive_status, md5) under the prefix, in name order, optionally of one tier.'''
+        sql = 'SELECT name, tier, size, archive_status, md5 FROM blobs WHERE name >= ? AND name < ?'
+        params = list(_prefix_range(name_starts_with))
+        if tier:
+            sql += ' AND tier = ?'
+            params.append(tier)
+        return self._stream(sql + ' ORDER BY name', params)
+
+    def _stream(self, sql: str, params):
+        '''Rows of sql a page at a time, so big results are never held whole.'''
+        with self._lock:
+            cursor = self.conn.execute(sql, params)
+            rows = cursor.fetchmany(1000)
+        while rows:
+            yield from rows
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+
+    def remote_index(self, name_starts_with=None) -> dict:
+        '''{name: RemoteBlob} like manifest.get_remote_index, without a request.'''
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT name, md5, size, tier, etag FROM blobs WHERE name >= ? AND name < ?',
+                _prefix_range(name_starts_with)
+            ).fetchall()
+        log.info('%d blobs of %s from the index', len(rows), self.container)
+        return {name: RemoteBlob(*rest) for name, *rest in rows}
+
+    def summary(self, name_starts_with=None, by='tier') -> list:
+        '''
+        [(key, blobs, bytes)] under the prefix, keyed by tier, or with by='prefix' by the next path part after
+        name_starts_with, slash included (blobs right under it keep their own name), like a du of the container.
+        '''
+        low, high = _prefix_range(name_starts_with)
+        if by == 'tier':
+            key = 'tier'
+            params = (low, high)
+        else:
+            start = len(low) + 1
+            key = ("CASE WHEN instr(substr(name, ?), '/') > 0 "
+                   "THEN substr(name, 1, ? + instr(substr(name, ?), '/')) ELSE name END")
+            params = (start, start - 1, start, low, high)
+        with self._lock:
+            return self.conn.execute(
+                f'SELECT {key} AS k, COUNT(*), SUM(size) FROM blobs WHERE name >= ? AND name < ? '
+                'GROUP BY k ORDER BY k',
+                params
+            ).fetchall()
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+def add_index_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group('container index')
+    group.add_argument('--index', help='SQLite file keeping the containers listing between runs')
+    group.add_argument('--index-max-age', default=24.0, type=float,
+                       help='Hours an index is trusted for before it is refreshed with a listing, 0 always lists')
+
+def from_args(args, container_client: ContainerClient) -> BlobIndex:
+    '''The --index for container_client, refreshed if it is older than --index-max-age. None without --index.'''
+    if not args.index:
+        return None
+    index = BlobIndex(args.index, container_client.container_name)
+    index.ensure_fresh(container_client, args.index_max_age * 3600)
+    return index
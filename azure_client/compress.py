@@ -0,0 +1,237 @@
+'''Compresses blobs on the way up across every core and decompresses them on the way down, both streaming'''
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import os
+import threading
+from typing import NamedTuple
+import zlib
+
+from azure.storage.blob import BlobClient, BlobBlock, StandardBlobTier
+
+from .fileio import advise_sequential
+from .logger import log
+from .metrics import metrics
+from .transfer import (
+    TransferBudget, block_id, fetch_range, pick_block_size, TRANSACTIONAL_CHECK, DEFAULT_BLOCK_SIZE, DEFAULT_CHUNK_SIZE
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class Codec(NamedTuple):
+    name: str
+    compress: object     # bytes -> one complete frame
+    decompressor: object # () -> object with decompress(), eof and unused_data, like zlib.decompressobj
+
+def _zstd(level=None) -> Codec:
+    level = 3 if level is None else level
+    return Codec(
+        'zstd',
+        lambda data: zstandard.ZstdCompressor(level=level).compress(data), # Compressors aren't thread safe
+        lambda: zstandard.ZstdDecompressor().decompressobj()
+    )
+
+def _gzip(level=None) -> Codec:
+    level = 6 if level is None else level
+    return Codec(
+        'gzip',
+        lambda data: gzip.compress(data, level, mtime=0),
+        lambda: zlib.decompressobj(wbits=31)
+    )
+
+CODECS = {'zstd': _zstd, 'gzip': _gzip}
+
+def get_codec(name: str, level=None) -> Codec:
+    '''
+    'zstd' needs the zstandard package, 'gzip' is always there. 'auto' is zstd when it is installed and
+    gzip when it isn't. Levels are the codecs own, None picks its default.
+    '''
+    if name == 'auto':
+        name = 'zstd' if zstandard is not None else 'gzip'
+    if name == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package, pip install zstandard or use gzip')
+    return CODECS[name](level)
+
+def codec_of(blob) -> str:
+    '''Name of the codec a blob was compressed with, None for blobs stored as they are.'''
+    return (getattr(blob, 'metadata', None) or {}).get('codec')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def compress_pool() -> ThreadPoolExecutor:
+    '''One compressor per core for the whole process, zstd and zlib let go of the GIL while they work.'''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='compress')
+        return _pool
+
+def upload_file(blob_client: BlobClient,
+                filename: str,
+                tier: StandardBlobTier,
+                codec: Codec,
+                block_size=DEFAULT_BLOCK_SIZE,
+                max_concurrency=1,
+                budget: TransferBudget = None
+               ) -> (dict, str):
+    '''
+    transfer.upload_file with every block_size of the file compressed as a frame of its own on the compress
+    pool, so a big file keeps every core busy while blocks go up, and each staged block is one frame.
+    Frames back to back are still one valid zstd or gzip stream. The codec, the original size and the md5
+    of the original go in the metadata, the md5 is what update checks and downloads compare against.
+    Returns (operation, md5).
+    '''
+    file_size = os.path.getsize(filename)
+    block_size = pick_block_size(file_size, block_size)
+    own_budget = budget is None
+    if own_budget:
+        budget = TransferBudget(max_concurrency)
+    pool = compress_pool()
+    file_hash = hashlib.md5()
+    compressed_size = 0
+    size_lock = threading.Lock()
+
+    def compress(data):
+        nonlocal compressed_size
+        frame = codec.compress(data)
+        metrics.inc('compression_saved_bytes_total', len(data) - len(frame), codec=codec.name)
+        with size_lock:
+            compressed_size += len(frame)
+        return frame
+
+    try:
+        with open(filename, 'rb') as fp:
+            advise_sequential(fp.fileno())
+            if file_size <= block_size:
+                data = fp.read()
+                file_hash.update(data)
+                frame = compress(data)
+                metadata = _metadata(codec, len(data), file_hash.hexdigest())
+                with budget.slot(), metrics.request('put_blob'):
+                    operation = blob_client.upload_blob(
+                        frame,
+                        length=len(frame),
+                        overwrite=True,
+                        standard_blob_tier=tier,
+                        metadata=metadata,
+                        validate_content=TRANSACTIONAL_CHECK
+                    )
+                metrics.inc('azure_bytes_total', len(frame), direction='upload')
+                return operation, metadata['md5']
+
+            in_flight = threading.BoundedSemaphore(max_concurrency)
+            futures = []
+            block_list = []
+
+            def stage(chunk_id, data):
+                try:
+                    frame = pool.submit(compress, data).result()
+                    with budget.slot(), metrics.request('stage_block'):
+                        blob_client.stage_block(
+                            chunk_id, frame, length=len(frame), validate_content=TRANSACTIONAL_CHECK
+                        )
+                    metrics.inc('azure_bytes_total', len(frame), direction='upload')
+                finally:
+                    in_flight.release()
+
+            while data := fp.read(block_size):
+                file_hash.update(data)
+                chunk_id = block_id(len(block_list))
+                block_list.append(BlobBlock(block_id=chunk_id))
+                in_flight.acquire() # Keeps at most max_concurrency blocks of this file in memory
+                futures.append(budget.pool.submit(stage, chunk_id, data))
+                if futures[0].done():
+                    futures.pop(0).result() # Surface failures early instead of reading the whole file
+            for future in futures:
+                future.result()
+    finally:
+        if own_budget:
+            budget.shutdown()
+
+    metadata = _metadata(codec, file_size, file_hash.hexdigest())
+    log.debug('Compressed %s with %s, %d bytes down to %d', filename, codec.name, file_size, compressed_size)
+    with budget.slot(), metrics.request('commit_block_list'):
+        operation = blob_client.commit_block_list(block_list, metadata=metadata, standard_blob_tier=tier)
+    return operation, metadata['md5']
+
+def _metadata(codec: Codec, size: int, file_md5: str) -> dict:
+    return {'md5': file_md5, 'codec': codec.name, 'size': str(size)}
+
+def decompress_frames(codec: Codec, chunks):
+    '''Yields the decompressed data of an iterable of compressed chunks holding any number of frames.'''
+    decompressor = codec.decompressor()
+    for data in chunks:
+        while data:
+            yield decompressor.decompress(data)
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = codec.decompressor()
+            else:
+                data = b''
+
+def download_file(blob_client: BlobClient,
+                  destination_filename: str,
+                  codec: Codec,
+                  size: int,
+                  etag=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE,
+                  max_concurrency=1,
+                  budget: TransferBudget = None
+                 ) -> str:
+    '''
+    Downloads a compressed blob of size bytes, fetching up to max_concurrency ranges ahead while earlier
+    ones are decompressed and written out in order. Returns the md5 of what was written, the original
+    contents, worked out on the way through.
+    '''
+    own_budget = budget is None
+    if own_budget:
+        budget = TransferBudget(max_concurrency)
+    file_hash = hashlib.md5()
+
+    def ranges():
+        pending = deque()
+        try:
+            for offset in range(0, size, chunk_size):
+                pending.append(budget.pool.submit(
+                    fetch_range, blob_client, offset, min(chunk_size, size - offset), etag, budget
+                ))
+                if len(pending) >= max_concurrency:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    written = 0
+    try:
+        with open(destination_filename, 'wb') as fp:
+            for data in decompress_frames(codec, ranges()):
+                file_hash.update(data)
+                fp.write(data)
+                written += len(data)
+        metrics.inc('compression_saved_bytes_total', written - size, codec=codec.name)
+    finally:
+        if own_budget:
+            budget.shutdown()
+    return file_hash.hexdigest()
+
+def add_compression_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group('compression')
+    group.add_argument('--compress', choices=['auto', *CODECS],
+                       help='Compress blobs on the way up, auto is zstd when zstandard is installed, else gzip')
+    group.add_argument('--compress-level', type=int, help='Codec level, defaults to 3 for zstd and 6 for gzip')
+
+def from_args(args) -> Codec:
+    '''The Codec add_compression_arguments flags asked for, None when not compressing.'''
+    if not args.compress:
+        return None
+    codec = get_codec(args.compress, args.compress_level)
+    log.info('Compressing with %s.', codec.name)
+    return codec
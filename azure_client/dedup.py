@@ -0,0 +1,329 @@
+'''Content-defined chunking, so a backup only sends the parts of big files that changed since any earlier run'''
+from concurrent.futures import Future
+import hashlib
+import json
+import sqlite3
+import threading
+
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError, ResourceExistsError
+from azure.storage.blob import BlobClient, BlobServiceClient, StandardBlobTier
+
+from .fileio import advise_sequential
+from .logger import log
+from .metrics import metrics
+from .transfer import (
+    TransferBudget, write_pieces, TRANSACTIONAL_CHECK, DEFAULT_CHUNK_SIZE, RANGE_ATTEMPTS
+)
+
+try:
+    from fastcdc import fastcdc as _fastcdc # Same chunking in C, a lot faster than the loop below
+except ImportError:
+    _fastcdc = None
+
+DEDUP_FORMAT = 'v1' # Goes in the manifests metadata as dedup=, that is how downloads know to rebuild
+DEFAULT_AVG_SIZE = 1024 * 1024
+# Chunks are shared by every manifest that references them and nothing rehydrates them, so they never
+# go to Archive whatever tier the files are sent at.
+DEFAULT_CHUNK_TIER = StandardBlobTier.COOL
+READ_SIZE = 64 * 1024 * 1024 # Chunked a buffer at a time, has to stay well above the max chunk size
+MASK_64 = (1 << 64) - 1
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+class ChunkError(Exception):
+    '''A chunk kept coming back different from the hash it is stored under.'''
+
+def is_chunked(blob) -> bool:
+    '''True for manifests upload_blob wrote in dedup mode, from blob properties or a listing with metadata.'''
+    return bool((getattr(blob, 'metadata', None) or {}).get('dedup'))
+
+def _gear_cut(data, min_size: int, avg_size: int, max_size: int) -> int:
+    '''
+    Length of the first chunk of data, FastCDC style: a gear rolling hash from min_size on, with a harder
+    mask before avg_size and an easier one after it so chunk sizes bunch up around avg_size. The mask is on
+    the high bits, those are the ones that depend on the whole 64 byte window.
+    '''
+    size = len(data)
+    if size <= min_size:
+        return size
+    bits = avg_size.bit_length() - 1
+    mask_small = ((1 << (bits + 1)) - 1) << (63 - bits)
+    mask_large = ((1 << (bits - 1)) - 1) << (65 - bits)
+    gear = GEAR
+    h = 0
+    i = min_size
+    normal = min(avg_size, size)
+    end = min(max_size, size)
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & MASK_64
+        i += 1
+        if not h & mask_small:
+            return i
+    while i < end:
+        h = ((h << 1) + gear[data[i]]) & MASK_64
+        i += 1
+        if not h & mask_large:
+            return i
+    return end
+
+def chunk_lengths(data, min_size: int, avg_size: int, max_size: int) -> list:
+    '''
+    Lengths of the chunks data splits into, the last one running to the end of data. Cut points only depend
+    on the bytes since the last one, so an insert early in a file leaves every chunk after it alone.
+    Uses fastcdc when it is installed, its cut points differ from the fallbacks so chunks made with one
+    are not found again with the other (nothing breaks, there is just less to share).
+    '''
+    if _fastcdc is not None:
+        return [x.length for x in _fastcdc(data, min_size, avg_size, max_size)]
+    lengths = []
+    view = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        lengths.append(_gear_cut(view[offset:], min_size, avg_size, max_size))
+        offset += lengths[-1]
+    return lengths
+
+def iter_chunks(fp, min_size: int, avg_size: int, max_size: int, read_size=READ_SIZE):
+    '''
+    Yields the chunks of an open file as memoryviews into one buffer that is read into again and again, so
+    chunks are hashed without being copied. A chunk is only valid until the next one is asked for, take
+    bytes() of it to keep it.
+    '''
+    buffer = bytearray(read_size + max_size)
+    view = memoryview(buffer)
+    tail = 0
+    while True:
+        read = fp.readinto(view[tail:tail + read_size])
+        end = tail + read
+        if not end:
+            return
+        lengths = chunk_lengths(view[:end], min_size, avg_size, max_size)
+        if read:
+            lengths.pop() # The buffer end cut the last one short, it is chunked again with what comes next
+        offset = 0
+        for length in lengths:
+            with view[offset:offset + length] as chunk:
+                yield chunk
+            offset += length
+        tail = end - offset
+        buffer[:tail] = bytes(view[offset:end]) # Under max_size, cheaper than having the source overlap
+
+class ChunkIndex:
+    '''The chunks already in the chunk container, in SQLite so the next run can skip them without asking.'''
+    def __init__(self, index_file: str):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(index_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER)')
+
+    def __contains__(self, digest: str) -> bool:
+        with self._lock:
+            return self.conn.execute('SELECT 1 FROM chunks WHERE hash = ?', (digest,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+
+    def add(self, chunks) -> None:
+        '''Takes (hash, size) pairs.'''
+        with self._lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO chunks (hash, size) VALUES (?, ?)', chunks)
+
+class ChunkStore:
+    '''
+    Stores files as a manifest blob under their own name plus chunks named by sha256 in chunk_container,
+    each chunk sent once no matter how many files or runs it turns up in. A chunk in the index, or one
+    another file of this run is already sending, is only referenced. The index is filled from a listing of
+    the chunk container when it starts out empty, so deleting it just costs one listing. Chunks removed
+    from the container behind the indexs back would leave manifests pointing at nothing, don't.
+    Files smaller than max_size go up as plain blobs, a manifest and one chunk would only be more requests.
+    Downloads just need the service, the chunk container is read from each manifest.
+    Chunks always go up at chunk_tier, an online tier, so restoring a file only ever means rehydrating its
+    manifest. Archive is refused for it.
+    '''
+    def __init__(self,
+                 service: BlobServiceClient,
+                 chunk_container: str = None,
+                 index_file: str = None,
+                 avg_size=DEFAULT_AVG_SIZE,
+                 chunk_tier: StandardBlobTier = DEFAULT_CHUNK_TIER
+                ):
+        if chunk_tier == StandardBlobTier.ARCHIVE:
+            raise ValueError('Chunks have to stay online, nothing rehydrates them, use Hot, Cool or Cold')
+        if chunk_container is not None and _fastcdc is None:
+            log.warning('fastcdc is not installed, chunking falls back to pure Python at a few MB/s. '
+                        'pip install fastcdc before deduplicating anything big.')
+        self.service = service
+        self.chunk_container = chunk_container
+        self.chunk_tier = chunk_tier
+        self.min_size = avg_size // 4
+        self.avg_size = avg_size
+        self.max_size = avg_size * 4
+        self._lock = threading.Lock()
+        self._sending = {} # {hash: Future} for chunks on their way up right now
+        self.index = None
+        if chunk_container is not None:
+            self.index = ChunkIndex(index_file if index_file is not None else ':memory:')
+            if not len(self.index):
+                self.sync()
+
+    def sync(self) -> None:
+        '''Adds every chunk the chunk container holds to the index.'''
+        container = self.service.get_container_client(self.chunk_container)
+        self.index.add((x.name, x.size) for x in container.list_blobs())
+        log.info('Chunk index has %d chunks from %s', len(self.index), self.chunk_container)
+
+    def _claim(self, digest: str) -> (Future, bool):
+        '''(Future that resolves once the chunk is stored, True if the caller has to send it) or (None, False).'''
+        with self._lock:
+            if digest in self._sending:
+                return self._sending[digest], False
+            if digest in self.index:
+                return None, False
+            claim = self._sending[digest] = Future()
+            return claim, True
+
+    def upload_file(self,
+                    blob_client: BlobClient,
+                    filename: str,
+                    tier: StandardBlobTier,
+                    max_concurrency=1,
+                    budget: TransferBudget = None
+                   ) -> (dict, str):
+        '''
+        Chunks filename, sends the chunks nobody has stored yet (max_concurrency at a time inside budget,
+        at chunk_tier) and then the manifest at tier, only once every chunk it lists is in. Returns
+        (operation, md5) like transfer.upload_file, the md5 being the whole files.
+        '''
+        own_budget = budget is None
+        if own_budget:
+            budget = TransferBudget(max_concurrency)
+        chunk_container = self.service.get_container_client(self.chunk_container)
+        in_flight = threading.BoundedSemaphore(max_concurrency)
+        file_hash = hashlib.md5()
+        entries = []
+        waits = []
+        sent = sent_bytes = 0
+
+        def put(digest, chunk, claim):
+            try:
+                try:
+                    with budget.slot(), metrics.request('put_chunk'):
+                        chunk_container.get_blob_client(digest).upload_blob(
+                            chunk,
+                            length=len(chunk),
+                            overwrite=False,
+                            standard_blob_tier=self.chunk_tier,
+                            validate_content=TRANSACTIONAL_CHECK
+                        )
+                    metrics.inc('azure_bytes_total', len(chunk), direction='upload')
+                except ResourceExistsError:
+                    pass # Another machine, or a run with another index, got it there first
+                self.index.add([(digest, len(chunk))])
+                claim.set_result(digest)
+            except BaseException as e:
+                claim.set_exception(e)
+            finally:
+                with self._lock:
+                    self._sending.pop(digest, None)
+                in_flight.release()
+
+        try:
+            with open(filename, 'rb') as fp:
+                advise_sequential(fp.fileno())
+                for chunk in iter_chunks(fp, self.min_size, self.avg_size, self.max_size):
+                    file_hash.update(chunk)
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    entries.append([digest, len(chunk)])
+                    claim, mine = self._claim(digest)
+                    if claim is not None:
+                        waits.append(claim)
+                    if not mine:
+                        metrics.inc('dedup_bytes_total', len(chunk), result='reused')
+                        continue
+                    sent += 1
+                    sent_bytes += len(chunk)
+                    metrics.inc('dedup_bytes_total', len(chunk), result='sent')
+                    in_flight.acquire() # Keeps at most max_concurrency chunks of this file in memory
+                    budget.pool.submit(put, digest, bytes(chunk), claim) # Only chunks that go up are copied
+                    if waits[0].done():
+                        waits.pop(0).result() # Surface failures early instead of chunking the whole file
+            for claim in waits:
+                claim.result()
+        finally:
+            if own_budget:
+                budget.shutdown()
+
+        file_md5 = file_hash.hexdigest()
+        size = sum(x[1] for x in entries)
+        manifest = json.dumps({
+            'format': DEDUP_FORMAT,
+            'size': size,
+            'md5': file_md5,
+            'chunk_container': self.chunk_container,
+            'chunks': entries
+        }).encode()
+        log.debug('%s is %d chunks, sent %d (%d bytes)', filename, len(entries), sent, sent_bytes)
+        with budget.slot(), metrics.request('put_blob'):
+            operation = blob_client.upload_blob(
+                manifest,
+                length=len(manifest),
+                overwrite=True,
+                standard_blob_tier=tier,
+                metadata={'md5': file_md5, 'dedup': DEDUP_FORMAT, 'size': str(size)},
+                validate_content=TRANSACTIONAL_CHECK
+            )
+        metrics.inc('azure_bytes_total', len(manifest), direction='upload')
+        return operation, file_md5
+
+    def download_file(self,
+                      blob_client: BlobClient,
+                      destination_filename: str,
+                      etag=None,
+                      max_concurrency=1,
+                      budget: TransferBudget = None
+                     ) -> str:
+        '''
+        Rebuilds a file from its manifest, fetching max_concurrency chunks at once and writing each at its
+        offset. Every chunk is checked against the sha256 it is named by and fetched again if it doesn't
+        match. Returns the whole file md5, worked out as the chunks land.
+        '''
+        conditions = {'etag': etag, 'match_condition': MatchConditions.IfNotModified} if etag else {}
+        with metrics.request('get_blob'):
+            manifest = json.loads(blob_client.download_blob(**conditions).readall())
+        chunk_container = self.service.get_container_client(manifest['chunk_container'])
+        pieces = []
+        offset = 0
+        for digest, length in manifest['chunks']:
+            pieces.append((offset, length, digest))
+            offset += length
+
+        def fetch(piece):
+            _, length, digest = piece
+            for attempt in range(RANGE_ATTEMPTS):
+                try:
+                    with budget.slot(), metrics.request('get_chunk'):
+                        data = chunk_container.get_blob_client(digest).download_blob(
+                            validate_content=TRANSACTIONAL_CHECK if length <= DEFAULT_CHUNK_SIZE else False
+                        ).readall()
+                    if hashlib.sha256(data).hexdigest() == digest:
+                        break
+                    error = 'content does not match its hash'
+                except AzureError as e:
+                    error = e
+                if attempt + 1 >= RANGE_ATTEMPTS:
+                    raise ChunkError(f'Chunk {digest} of {blob_client.blob_name}: {error}')
+                metrics.inc('range_retries_total')
+                log.warning('Chunk %s of %s failed, fetching again: %s', digest, blob_client.blob_name, error)
+            metrics.inc('azure_bytes_total', len(data), direction='download')
+            return data
+
+        own_budget = budget is None
+        if own_budget:
+            budget = TransferBudget(max_concurrency)
+        try:
+            return write_pieces(destination_filename, manifest['size'], pieces, fetch, max_concurrency, budget)
+        finally:
+            if own_budget:
+                budget.shutdown()
@@ -0,0 +1,40 @@
+'''Reads files for hashing and uploading with as few copies and syscalls as Python allows'''
+import mmap
+import os
+
+DEFAULT_MMAP_THRESHOLD = 1024 * 1024 # Mapping costs a few syscalls and page faults, under this a plain read is cheaper
+MMAP_THRESHOLD = None # Off unless asked for (--mmap), see iter_views
+
+def advise_sequential(fd: int) -> None:
+    '''Tells the kernel a file is about to be read front to back, so it reads ahead further. No-op off POSIX.'''
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass # Some filesystems (FUSE, some network mounts) don't take advice, reading works the same
+
+def iter_views(filename: str, size: int):
+    '''
+    Yields the file as memoryviews of size bytes (the last one shorter), read through one reused buffer so
+    nothing is copied on the way to a hasher. A view is only valid until the next one is asked for: take
+    bytes() of it to keep it. With MMAP_THRESHOLD set (--mmap) files of that size and up are memory mapped
+    instead and the views point straight into the page cache. That is off by default because a mapped file
+    another process truncates while it is read kills this one with SIGBUS, a read just comes up short.
+    '''
+    with open(filename, 'rb', buffering=0) as fp:
+        advise_sequential(fp.fileno())
+        file_size = os.fstat(fp.fileno()).st_size
+        if MMAP_THRESHOLD is not None and file_size >= MMAP_THRESHOLD:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(mapped), size):
+                        with view[offset:offset + size] as piece: # Released before the map is closed
+                            yield piece
+            return
+        buffer = bytearray(min(size, file_size) or 1)
+        with memoryview(buffer) as view:
+            while read := fp.readinto(buffer):
+                with view[:read] as piece:
+                    yield piece
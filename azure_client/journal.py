@@ -0,0 +1,82 @@
+'''On disk journal of staged blocks so big uploads can pick up where a crashed run left off'''
+import hashlib
+import json
+import os
+import threading
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobClient
+
+from .logger import log
+from .transfer import block_id
+
+class BlockJournal:
+    '''
+    Keeps one small journal file per in-flight upload in a directory. The first line records the local
+    files identity (size, mtime_ns, inode) and block size, then one line is appended per staged block.
+    On a restart the journal is checked against the files stat and the services uncommitted block list,
+    and only blocks both sides agree on are skipped.
+    '''
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, filename: str, blob_name: str) -> str:
+        key = hashlib.sha1(f'{filename}\0{blob_name}'.encode()).hexdigest()
+        return os.path.join(self.directory, key + '.journal')
+
+    def resume(self, blob_client: BlobClient, filename: str, block_size: int) -> (int, dict):
+        '''
+        Returns (block_size, {index: length}) of blocks that don't need sending again, starting a fresh
+        journal when there is nothing usable to resume from. A resumed upload keeps its old block size.
+        '''
+        path = self._path(filename, blob_client.blob_name)
+        stat = os.stat(filename)
+        identity = {
+            'filename': filename,
+            'blob': blob_client.blob_name,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'inode': stat.st_ino
+        }
+        journaled = {}
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                header = json.loads(fp.readline() or '{}')
+                if {k: header.get(k) for k in identity} == identity:
+                    for line in fp:
+                        try:
+                            index, offset, length = (int(x) for x in line.split())
+                        except ValueError:
+                            break # Torn last line from a crash mid-write
+                        journaled[index] = (offset, length)
+                else:
+                    log.info('%s changed since its last upload attempt, starting it over.', filename)
+
+        if journaled:
+            block_size = header['block_size']
+            try:
+                _, uncommitted = blob_client.get_block_list('uncommitted')
+            except ResourceNotFoundError:
+                uncommitted = []
+            staged = {block.id: block.size for block in uncommitted}
+            done = {i: length for i, (_, length) in journaled.items() if staged.get(block_id(i)) == length}
+            log.info('Resuming %s: %d of %d journaled blocks still staged.', filename, len(done), len(journaled))
+            return block_size, done
+
+        with self._lock, open(path, 'w') as fp:
+            fp.write(json.dumps(dict(identity, block_size=block_size)) + '\n')
+        return block_size, {}
+
+    def record(self, blob_client: BlobClient, filename: str, index: int, offset: int, length: int) -> None:
+        '''Appends one staged block, called once the service has acknowledged it.'''
+        with self._lock, open(self._path(filename, blob_client.blob_name), 'a') as fp:
+            fp.write(f'{index} {offset} {length}\n')
+
+    def finish(self, blob_client: BlobClient, filename: str) -> None:
+        '''Drops the journal once the block list is committed.'''
+        try:
+            os.remove(self._path(filename, blob_client.blob_name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,180 @@
+'''Token buckets on bytes/s and requests/s shared by every request a client sends, with schedules and live changes'''
+import argparse
+import datetime
+import os
+import signal
+import threading
+import time
+
+from .logger import log
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_rate(text: str) -> float:
+    '''"20M" -> 20 MiB, "500K", "1.5G", plain numbers as they are. "", "0", "-" and "off" mean no limit (None).'''
+    text = text.strip().upper().removesuffix('B').removesuffix('I')
+    if text in ('', '0', '-', 'OFF'):
+        return None
+    unit = text[-1] if text[-1] in UNITS else ''
+    return float(text[:len(text) - len(unit)]) * UNITS[unit]
+
+def parse_schedule(text: str) -> list:
+    '''
+    "08:00-18:00=20M/100,18:00-08:00=off" -> [(start, end, bytes_per_s, requests_per_s)]. The requests part
+    is optional, windows can wrap past midnight and the first window that matches wins.
+    '''
+    schedule = []
+    for window in filter(None, (x.strip() for x in text.split(','))):
+        times, _, limits = window.partition('=')
+        start, end = (datetime.time.fromisoformat(x.strip()) for x in times.split('-'))
+        bandwidth, _, requests = limits.partition('/')
+        schedule.append((start, end, parse_rate(bandwidth), parse_rate(requests)))
+    return schedule
+
+def _in_window(now: datetime.time, start: datetime.time, end: datetime.time) -> bool:
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+class TokenBucket:
+    '''
+    Refills at rate tokens a second up to a seconds worth. Taking more than is there puts the bucket in debt
+    and the caller sleeps the debt off, so big blocks and many small requests are paced the same way.
+    A rate of None lets everything through without touching the lock.
+    '''
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate or 0
+        self.stamp = time.monotonic()
+
+    def set_rate(self, rate) -> None:
+        with self._lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate or 0)
+            self.stamp = time.monotonic()
+
+    def take(self, amount: float) -> None:
+        if not self.rate or not amount:
+            return
+        with self._lock:
+            rate = self.rate
+            if not rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(rate, self.tokens + (now - self.stamp) * rate) - amount
+            self.stamp = now
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class Limiter:
+    '''
+    Paces every request a client sends (retries included) on requests/s, and on bytes/s by the
+    Content-Length going up or coming back. The limits in force come from, first to last: the control
+    file (lines like "bandwidth=20M" and "requests=100", re-read when it changes), the schedule window
+    the time of day falls in, then the plain bandwidth/requests. SIGUSR1 re-reads everything at once,
+    SIGUSR2 switches all limits off and on again without stopping the job.
+    '''
+    def __init__(self, bandwidth=None, requests=None, schedule=None, control_file=None, poll=5.0):
+        self.bandwidth = bandwidth
+        self.requests = requests
+        self.schedule = schedule or []
+        self.control_file = control_file
+        self.poll = poll
+        self.suspended = False
+        self.bytes = TokenBucket()
+        self.calls = TokenBucket()
+        self._control = (None, {})
+        self._wake = threading.Event()
+        self._current = None
+        self.apply()
+
+    def _read_control(self) -> dict:
+        if not self.control_file:
+            return {}
+        try:
+            mtime = os.stat(self.control_file).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        if mtime != self._control[0]:
+            limits = {}
+            with open(self.control_file) as fp:
+                for line in fp:
+                    key, _, value = line.partition('=')
+                    if key.strip() in ('bandwidth', 'requests') and value.strip():
+                        limits[key.strip()] = parse_rate(value)
+            self._control = (mtime, limits)
+        return self._control[1]
+
+    def limits(self, now=None) -> (float, float):
+        '''(bytes/s, requests/s) that should be in force now, None meaning unlimited.'''
+        if self.suspended:
+            return None, None
+        bandwidth, requests = self.bandwidth, self.requests
+        now = now or datetime.datetime.now().time()
+        for start, end, window_bandwidth, window_requests in self.schedule:
+            if _in_window(now, start, end):
+                bandwidth, requests = window_bandwidth, window_requests
+                break
+        control = self._read_control()
+        return control.get('bandwidth', bandwidth), control.get('requests', requests)
+
+    def apply(self) -> None:
+        try:
+            limits = self.limits()
+        except (OSError, ValueError) as e:
+            log.error('Could not read limits, keeping the current ones: %s', e)
+            return
+        if limits != self._current:
+            bandwidth, requests = limits
+            self.bytes.set_rate(bandwidth)
+            self.calls.set_rate(requests)
+            self._current = limits
+            log.info('Limits now %s/s and %s requests/s.',
+                     f'{bandwidth / 1024 ** 2:.1f}MiB' if bandwidth else 'unlimited',
+                     f'{requests:g}' if requests else 'unlimited')
+
+    def start(self) -> 'Limiter':
+        '''Re-checks the schedule and control file every poll seconds, and hooks up the signals.'''
+        def loop():
+            while True:
+                self._wake.wait(self.poll)
+                self._wake.clear()
+                self.apply()
+        threading.Thread(target=loop, daemon=True, name='limiter').start()
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda *_: self._wake.set())
+            signal.signal(signal.SIGUSR2, lambda *_: self.toggle())
+        return self
+
+    def toggle(self) -> None:
+        self.suspended = not self.suspended
+        log.warning('Limits %s.', 'suspended, running at full speed' if self.suspended else 'back on')
+        self._wake.set()
+
+    def request_hook(self, request) -> None:
+        '''raw_request_hook, runs for every attempt just before it goes on the wire.'''
+        self.calls.take(1)
+        if request.http_request.method in ('PUT', 'POST'):
+            self.bytes.take(int(request.http_request.headers.get('Content-Length') or 0))
+
+    def response_hook(self, response) -> None:
+        '''raw_response_hook, charges downloads once the size of what is coming back is known.'''
+        if response.http_request.method == 'GET':
+            self.bytes.take(int(response.http_response.headers.get('Content-Length') or 0))
+
+def add_limit_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group('limits', 'rates take K/M/G suffixes, 0 or off means unlimited')
+    group.add_argument('--max-bandwidth', type=parse_rate, help='Bytes per second across all workers, e.g. 20M')
+    group.add_argument('--max-requests', type=parse_rate, help='Requests per second across all workers')
+    group.add_argument('--limit-schedule', type=parse_schedule,
+                       help='Limits by time of day, e.g. "08:00-18:00=20M/100,18:00-08:00=off"')
+    group.add_argument('--limit-control-file',
+                       help='File with bandwidth=/requests= lines that override the rest while it exists')
+
+def from_args(args) -> Limiter:
+    '''A started Limiter for the flags add_limit_arguments made, None when no limit was asked for.'''
+    if not (args.max_bandwidth or args.max_requests or args.limit_schedule or args.limit_control_file):
+        return None
+    return Limiter(args.max_bandwidth, args.max_requests, args.limit_schedule, args.limit_control_file).start()
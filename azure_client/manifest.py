@@ -0,0 +1,83 @@
+'''Diffs a local tree against one listing of the container so workers never ask for blob properties'''
+from collections import Counter
+from typing import NamedTuple
+import os
+
+from azure.storage.blob import ContainerClient
+
+from .compress import codec_of
+from .dedup import is_chunked
+from .logger import log
+
+UPLOAD = 'upload'       # Not in the container yet
+UPDATE = 'update'       # In the container and might differ, compare and overwrite if it does
+SKIP = 'skip'           # Known to match, or there and not set to overwrite
+
+class RemoteBlob(NamedTuple):
+    md5: str
+    size: int
+    tier: str
+    etag: str
+
+def stored_md5(blob) -> str:
+    '''
+    Hex md5 of a blob from its properties or listing entry. The standard Content-MD5 comes first, the md5
+    metadata is the fallback for blobs older versions committed as blocks. '' when the blob has neither.
+    Dedup manifests and compressed blobs only have the original files md5 in their metadata, their
+    Content-MD5 is the one of what is stored.
+    '''
+    if is_chunked(blob) or codec_of(blob):
+        return blob.metadata['md5']
+    content_md5 = blob.content_settings.content_md5 if blob.content_settings else None
+    if content_md5:
+        return bytes(content_md5).hex()
+    return (blob.metadata or {}).get('md5', '')
+
+def stored_size(blob) -> int:
+    '''Size of the file a blob holds, the original files for dedup manifests and compressed blobs.'''
+    if is_chunked(blob) or codec_of(blob):
+        return int(blob.metadata['size'])
+    return blob.size
+
+def get_remote_index(container_client: ContainerClient, name_starts_with=None) -> dict:
+    '''One paginated listing with metadata, returned as {name: RemoteBlob}.'''
+    index = {}
+    for blob in container_client.list_blobs(name_starts_with=name_starts_with, include=['metadata']):
+        index[blob.name] = RemoteBlob(
+            stored_md5(blob),
+            stored_size(blob),
+            blob.blob_tier,
+            blob.etag
+        )
+    log.info('Listed %d blobs in %s', len(index), container_client.container_name)
+    return index
+
+def plan_uploads(files, remote_index: dict, md5sums=None, overwrite=False):
+    '''
+    Takes (filename, azure_filename, size) from the scan and yields
+    (action, filename, azure_filename, RemoteBlob or None, size) as the scan comes in, so the plan is never
+    held in memory and nothing downstream has to stat a file just to learn its size. Files that already
+    exist are skipped outright when not overwriting, and skipped without reading them when a cached md5sum
+    already matches. Everything else that exists is left as UPDATE for the worker to compare.
+    '''
+    counts = Counter()
+    for filename, azure_filename, size in files:
+        remote = remote_index.get(azure_filename)
+        if remote is None:
+            action = UPLOAD
+        elif not overwrite:
+            action = SKIP
+        else:
+            try:
+                stat = os.stat(filename)
+            except OSError as e: # Gone since the scan, the worker reports it for this file alone
+                log.debug('Could not stat %s while planning: %s', filename, e)
+                stat = None
+            cached = md5sums.cached_md5sum(filename, stat) if md5sums is not None and stat else None
+            if stat and stat.st_size == remote.size and cached is not None and cached == remote.md5:
+                action = SKIP
+            else:
+                action = UPDATE
+        counts[action] += 1
+        yield action, filename, azure_filename, remote, size
+    log.info('Plan: %d to upload, %d to compare, %d to skip.', counts[UPLOAD], counts[UPDATE], counts[SKIP])
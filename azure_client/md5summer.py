@@ -1,35 +1,145 @@
+import atexit
 import hashlib
 import os
-from datetime import datetime
+import sqlite3
+import threading
+import time
 
+from .fileio import iter_views
 from .logger import log
 
+SQLITE_HEADER = b'SQLite format 3\x00'
+HASH_BUFFER = 8 * 1024 * 1024 # hashlib only lets go of the GIL for big updates, small reads pin hashing to one core
+
+def md5_file(filename: str, buffer_size=HASH_BUFFER) -> str:
+    '''
+    md5 of a file hashed straight from the page cache (see fileio.iter_views) buffer_size at a time, so
+    threads hashing different files run on separate cores and nothing is copied on the way.
+    '''
+    file_hash = hashlib.md5()
+    for view in iter_views(filename, buffer_size):
+        file_hash.update(view)
+    return file_hash.hexdigest()
+
 class md5summer:
-    def __init__(self, md5sum_file: str):
+    '''
+    md5sum cache kept in a SQLite database (WAL mode) so lookups are indexed, nothing gets loaded up front,
+    and any number of threads and processes can share it. An entry is only trusted while the files size,
+    mtime_ns and inode all still match what was recorded. Writes are buffered and committed in batches.
+    '''
+    def __init__(self, md5sum_file: str, batch_size=500, flush_interval=5.0):
         self.md5sum_file = md5sum_file
-        self.md5sums = {}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {} # {"filename": (size, mtime_ns, inode, md5sum)} waiting to be written
+        self._last_flush = time.monotonic()
+
+        legacy_file = None
+        if os.path.exists(self.md5sum_file) and os.path.getsize(self.md5sum_file) > 0:
+            with open(self.md5sum_file, 'rb') as fp:
+                if fp.read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+                    legacy_file = self.md5sum_file + '.txt.bak'
+                    log.info('Converting old md5sum file %s, keeping a copy at %s', self.md5sum_file, legacy_file)
+                    os.replace(self.md5sum_file, legacy_file)
+
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS md5sums ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, md5 TEXT)'
+            )
+        if legacy_file:
+            self._import_text_file(legacy_file)
+
+        atexit.register(self.close)
+
+    def _connection(self) -> sqlite3.Connection:
+        '''sqlite connections can't be shared between threads, so each thread gets its own.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.md5sum_file, timeout=60)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _import_text_file(self, legacy_file: str) -> None:
+        '''
+        Pulls in the old "md5sum filename" format. That only knew the files mtime was older than the sums
+        file, so entries that pass that test are stamped with the files current stat.
+        '''
+        legacy_mdate = os.path.getmtime(legacy_file)
+        imported = 0
+        with open(legacy_file, 'r') as fp:
+            for line in fp:
+                d = line.rstrip('\n').split(' ', 1)
+                if len(d) != 2:
+                    continue
+                try:
+                    stat = os.stat(d[1])
+                except OSError:
+                    continue
+                if stat.st_mtime < legacy_mdate:
+                    self.record_md5sum(d[1], d[0], stat)
+                    imported += 1
+        self.flush()
+        log.info('Imported %d md5sums from %s', imported, legacy_file)
+
+    def cached_md5sum(self, filename: str, stat: os.stat_result = None) -> str:
+        '''Returns the cached md5sum of filename if it is still fresh, None otherwise. Never reads the file.'''
+        if stat is None:
+            stat = os.stat(filename)
+        with self._lock:
+            row = self._pending.get(filename)
+        if row is None:
+            row = self._connection().execute(
+                'SELECT size, mtime_ns, inode, md5 FROM md5sums WHERE path = ?', (filename,)
+            ).fetchone()
+        if row is not None and tuple(row[:3]) == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            log.info('Already calculated MD5SUM previously (%s)', row[3])
+            return row[3]
+        return None
+
+    def record_md5sum(self, filename: str, md5sum: str, stat: os.stat_result = None) -> None:
+        '''
+        Saves a md5sum that was worked out somewhere else, like while streaming an upload. Pass the stat
+        taken before the file was read so a change during hashing isn't recorded as fresh.
+        '''
+        if stat is None:
+            stat = os.stat(filename)
+        with self._lock:
+            self._pending[filename] = (stat.st_size, stat.st_mtime_ns, stat.st_ino, md5sum)
+            due = (len(self._pending) >= self.batch_size
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
 
-        if not os.path.exists(self.md5sum_file):
-            fp = open(self.md5sum_file, 'w')
-            fp.close() # Making an empty file
-        self.md5sum_mdate = datetime.fromtimestamp(os.path.getmtime(md5sum_file))
+    def flush(self) -> None:
+        '''Writes out everything buffered in one transaction.'''
+        with self._lock:
+            rows = [(k,) + v for k, v in self._pending.items()]
+            self._pending = {}
+            self._last_flush = time.monotonic()
+        if not rows:
+            return
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO md5sums (path, size, mtime_ns, inode, md5) VALUES (?, ?, ?, ?, ?)', rows
+            )
+        log.debug('Wrote %d md5sums to %s', len(rows), self.md5sum_file)
 
-        with open(md5sum_file, 'r') as fp:
-            for line in fp.readlines():
-                d = line.strip().split()
-                self.md5sums[d[1]] = d[0] # {"filename": "md5sum"}
+    def close(self) -> None:
+        self.flush()
 
     def get_md5sum(self, filename: str) -> str:
-        if filename in self.md5sums.keys():
-            if self.md5sum_mdate > datetime.fromtimestamp(os.path.getmtime(filename)):
-                log.info(f'Already calculated MD5SUM previously ({self.md5sums[filename]})')
-                return self.md5sums[filename]
-        else:
-            with open(filename, 'rb') as fp:
-                file_hash = hashlib.md5()
-                while chunk := fp.read(8192):
-                    file_hash.update(chunk)
-            log.debug(f'Calculated md5 {file_hash.hexdigest()}')
-            with open(self.md5sum_file, 'a') as fp:
-                fp.write(file_hash.hexdigest() + ' ' + filename + '\n')
-            return file_hash.hexdigest()
+        stat = os.stat(filename)
+        cached = self.cached_md5sum(filename, stat)
+        if cached is not None:
+            return cached
+        file_md5 = md5_file(filename)
+        log.debug('Calculated md5 %s', file_md5)
+        self.record_md5sum(filename, file_md5, stat)
+        return file_md5
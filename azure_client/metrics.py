@@ -0,0 +1,219 @@
+'''Counters, histograms and trace spans for the transfer paths, exported as a Prometheus textfile or JSON lines'''
+import argparse
+import atexit
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from azure.core.exceptions import HttpResponseError
+
+from .logger import log
+
+THROTTLED = (429, 500, 503) # Status codes the service uses when it wants us to slow down
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+def _prometheus_name(key: tuple, suffix='', extra=()) -> str:
+    name, labels = key
+    labels = labels + extra
+    if not labels:
+        return name + suffix
+    return name + suffix + '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+class Metrics:
+    '''
+    Process wide registry. Counters and gauges are plain numbers keyed by name and labels, histograms keep
+    cumulative bucket counts, and gauge callbacks (queue depths and the like) are only read when exporting.
+    Every update is one dict operation under one lock, cheap next to any request.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._callbacks = {}
+        self._histograms = {} # {key: [bucket counts..., sum, count]}
+        self._trace = None
+        self._trace_lock = threading.Lock()
+        self._export = None
+
+    def inc(self, name: str, value=1, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add(self, name: str, value, **labels) -> None:
+        '''Moves a gauge up or down, like the number of requests in flight.'''
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def gauge_callback(self, name: str, func, **labels) -> None:
+        '''func() is read for the gauges value every export.'''
+        with self._lock:
+            self._callbacks[_key(name, labels)] = func
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            row = self._histograms.get(key)
+            if row is None:
+                row = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def request(self, operation: str):
+        '''Times one request to the service, counting errors by status and throttling on the side.'''
+        self.add('azure_requests_in_flight', 1)
+        start = time.perf_counter()
+        try:
+            yield
+        except HttpResponseError as e:
+            self.inc('azure_request_errors_total', operation=operation, status=e.status_code)
+            if e.status_code in THROTTLED:
+                self.inc('azure_throttled_total', operation=operation, status=e.status_code)
+            raise
+        finally:
+            self.add('azure_requests_in_flight', -1)
+            self.observe('azure_request_seconds', time.perf_counter() - start, operation=operation)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        '''Writes a JSON line with the duration (and error, if any) of the block when tracing is on.'''
+        if self._trace is None:
+            yield
+            return
+        start, error = time.time(), None
+        try:
+            yield
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            line = json.dumps({
+                'span': name,
+                'start': start,
+                'seconds': round(time.time() - start, 6),
+                'thread': threading.get_ident(),
+                'error': error,
+                **attributes
+            }, default=str)
+            with self._trace_lock:
+                if self._trace is not None:
+                    self._trace.write(line + '\n')
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            callbacks = dict(self._callbacks)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        for key, func in callbacks.items():
+            try:
+                gauges[key] = func()
+            except Exception as e:
+                log.debug('Gauge %s failed: %s', key[0], e)
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def prometheus(self) -> str:
+        '''Everything in the Prometheus text exposition format, for the node_exporter textfile collector.'''
+        snap = self.snapshot()
+        lines = []
+        typed = set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+        for key, value in sorted(snap['counters'].items()):
+            declare(key[0], 'counter')
+            lines.append(f'{_prometheus_name(key)} {value}')
+        for key, value in sorted(snap['gauges'].items()):
+            declare(key[0], 'gauge')
+            lines.append(f'{_prometheus_name(key)} {value}')
+        for key, row in sorted(snap['histograms'].items()):
+            declare(key[0], 'histogram')
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, row):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{_prometheus_name(key, '_bucket', (('le', le),))} {cumulative}")
+            lines.append(f"{_prometheus_name(key, '_sum')} {row[-2]}")
+            lines.append(f"{_prometheus_name(key, '_count')} {row[-1]}")
+        return '\n'.join(lines) + '\n'
+
+    def json_line(self) -> str:
+        '''One JSON object with the time and every metric, names in the Prometheus style.'''
+        snap = self.snapshot()
+        return json.dumps({
+            'time': time.time(),
+            'counters': {_prometheus_name(k): v for k, v in snap['counters'].items()},
+            'gauges': {_prometheus_name(k): v for k, v in snap['gauges'].items()},
+            'histograms': {
+                _prometheus_name(k): {'count': v[-1], 'sum': v[-2], 'buckets': v[:len(LATENCY_BUCKETS)]}
+                for k, v in snap['histograms'].items()
+            },
+        })
+
+    def write(self, path: str, fmt: str) -> None:
+        if fmt == 'prometheus':
+            temp = f'{path}.{os.getpid()}.tmp'
+            with open(temp, 'w') as fp:
+                fp.write(self.prometheus())
+            os.replace(temp, path) # The collector must never see half a file
+        else:
+            with open(path, 'a') as fp:
+                fp.write(self.json_line() + '\n')
+
+    def start_export(self, path: str, fmt='prometheus', interval=15.0) -> None:
+        '''Writes the metrics to path every interval seconds from a daemon thread, and once more at exit.'''
+        stop = threading.Event()
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    self.write(path, fmt)
+                except OSError as e:
+                    log.warning('Could not write metrics to %s: %s', path, e)
+        thread = threading.Thread(target=loop, daemon=True, name='metrics')
+        thread.start()
+        self._export = (stop, path, fmt)
+        atexit.register(self.close)
+
+    def start_trace(self, path: str) -> None:
+        self._trace = open(path, 'a', buffering=1024 * 1024)
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        if self._export is not None:
+            stop, path, fmt = self._export
+            self._export = None
+            stop.set()
+            self.write(path, fmt)
+        with self._trace_lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+metrics = Metrics()
+
+def add_metrics_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group('metrics')
+    group.add_argument('--metrics-file', help='Write counters and latency histograms here while running')
+    group.add_argument('--metrics-format', choices=['prometheus', 'json'], default='prometheus',
+                       help='Prometheus textfile (rewritten each time) or JSON lines (appended)')
+    group.add_argument('--metrics-interval', default=15.0, type=float, help='Seconds between metrics writes')
+    group.add_argument('--trace-file', help='Append a JSON line per file processed, with its duration')
+
+def start_from_args(args) -> None:
+    '''Turns on whatever add_metrics_arguments flags were given.'''
+    if args.metrics_file:
+        metrics.start_export(args.metrics_file, args.metrics_format, args.metrics_interval)
+    if args.trace_file:
+        metrics.start_trace(args.trace_file)
@@ -0,0 +1,464 @@
+'''Packs small files into big tar blobs with a sharded index, so millions of files cost thousands of requests'''
+from contextlib import nullcontext
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import tarfile
+import threading
+import time
+from typing import NamedTuple
+
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import BlobBlock, ContainerClient, ContentSettings, StandardBlobTier
+
+from .logger import log
+from .manifest import RemoteBlob
+from .metrics import metrics
+from .transfer import (
+    TransferBudget, block_id, fetch_range, TRANSACTIONAL_CHECK, DEFAULT_BLOCK_SIZE, DEFAULT_CHUNK_SIZE, RANGE_ATTEMPTS
+)
+
+PACK_PREFIX = '.packs/'
+INDEX_DIR = '.packs/index/'
+INDEX_SHARDS = 64 # Fixed, readers find a files shard by hashing its name
+INDEX_BLOB = '.packs/index.json.gz' # The whole index in one blob as v1 wrote it, folded into shards on the next save
+PACK_FORMAT = 'v2'
+DEFAULT_PACK_SIZE = 256 * 1024 * 1024
+DEFAULT_PACK_THRESHOLD = 1024 * 1024
+TAR_BLOCK = 512
+
+class PackedFile(NamedTuple):
+    name: str
+    pack: str
+    offset: int # Of the files data in the pack, past its tar header
+    size: int
+    md5: str
+
+class PackSlice(NamedTuple):
+    '''Files to get out of one pack, shaped enough like a listing entry for the download scripts.'''
+    name: str
+    blob_tier: str
+    size: int
+    members: list
+
+def is_pack_blob(name: str) -> bool:
+    '''Packs and the index, blobs that aren't files of their own.'''
+    return name.startswith(PACK_PREFIX)
+
+def shard_of(name: str) -> str:
+    '''The index shard blob holding name.'''
+    return f'{INDEX_DIR}{int(hashlib.md5(name.encode()).hexdigest()[:8], 16) % INDEX_SHARDS:02x}.json.gz'
+
+def list_index(container_client: ContainerClient) -> dict:
+    '''{blob name: etag} of the index shards and the old single index blob, in one listing.'''
+    return {x.name: x.etag for x in container_client.list_blobs(name_starts_with=INDEX_DIR.rstrip('/'))}
+
+def load_shard(container_client: ContainerClient, shard: str) -> (str, dict):
+    '''(etag, {file name: PackedFile}) from one index blob, (None, {}) when it doesn't exist.'''
+    try:
+        with metrics.request('get_blob'):
+            downloader = container_client.get_blob_client(shard).download_blob()
+            data = downloader.readall()
+    except ResourceNotFoundError:
+        return None, {}
+    files = json.loads(gzip.decompress(data))['files']
+    return downloader.properties.etag, {name: PackedFile(name, *entry) for name, entry in files.items()}
+
+def load_shards(container_client: ContainerClient, names=None) -> dict:
+    '''
+    {index blob: (etag, {file name: PackedFile})} of every shard, or with names only of the shards holding
+    them, so looking up one file costs a listing and one small read however many files are packed. Includes
+    the old single index blob while there is one.
+    '''
+    existing = list_index(container_client)
+    wanted = existing.keys() if names is None else {shard_of(x) for x in names} | {INDEX_BLOB}
+    return {shard: load_shard(container_client, shard) for shard in sorted(wanted & existing.keys())}
+
+def merge_shards(shards: dict) -> dict:
+    '''{file name: PackedFile} from load_shards, the shards win over the old single index blob.'''
+    index = dict(shards[INDEX_BLOB][1]) if INDEX_BLOB in shards else {}
+    for shard, (_, entries) in shards.items():
+        if shard != INDEX_BLOB:
+            index.update(entries)
+    return index
+
+def load_index(container_client: ContainerClient, names=None) -> dict:
+    '''{file name: PackedFile} of the whole index, or of the shards holding names. Empty without packs.'''
+    return merge_shards(load_shards(container_client, names))
+
+def _save_shard(container_client: ContainerClient, shard: str, entries: dict, removed, known=None) -> (str, dict):
+    '''
+    Merges entries into one shard and drops the names in removed, starting from known (etag, entries) when
+    given instead of reading the shard. The write is conditional on the etag, so when another run wrote the
+    shard in between it is read and merged again instead of one of them losing its files. Returns the
+    shards new (etag, {file name: PackedFile}).
+    '''
+    blob = container_client.get_blob_client(shard)
+    while True:
+        if known is not None:
+            etag, index = known[0], dict(known[1])
+            known = None
+        else:
+            etag, index = load_shard(container_client, shard)
+        index.update(entries)
+        for name in removed:
+            index.pop(name, None)
+        data = gzip.compress(json.dumps({
+            'format': PACK_FORMAT,
+            'files': {name: list(entry[1:]) for name, entry in index.items()}
+        }).encode())
+        conditions = {'etag': etag, 'match_condition': MatchConditions.IfNotModified} if etag else {}
+        try:
+            with metrics.request('put_blob'):
+                response = blob.upload_blob(
+                    data, length=len(data), overwrite=etag is not None, validate_content=TRANSACTIONAL_CHECK,
+                    **conditions
+                )
+            return response.get('etag'), index
+        except (ResourceExistsError, ResourceModifiedError):
+            log.warning('Pack index shard %s changed while writing it, merging again.', shard)
+
+def save_index(container_client: ContainerClient, entries: dict, removed=(), shards=None) -> dict:
+    '''
+    Merges entries into the index and drops the names in removed, rewriting only the shards they hash to.
+    shards is what load_shards returned earlier, shards the listing shows unchanged since aren't read
+    again. An old single index blob is folded into the shards first and then deleted. Returns
+    {shard: (etag, {file name: PackedFile})} of every shard written.
+    '''
+    existing = list_index(container_client)
+    shards = shards or {}
+
+    def known(shard):
+        if shard not in existing:
+            return None, {}
+        if shard in shards and shards[shard][0] == existing[shard]:
+            return shards[shard]
+        return None
+
+    legacy = {}
+    if INDEX_BLOB in existing:
+        cached = known(INDEX_BLOB)
+        legacy = cached[1] if cached else load_shard(container_client, INDEX_BLOB)[1]
+        log.info('Moving %d files from %s into index shards.', len(legacy), INDEX_BLOB)
+    changes = {}
+    for name, entry in itertools.chain(legacy.items(), entries.items()):
+        changes.setdefault(shard_of(name), ({}, set()))[0][name] = entry
+    for name in removed:
+        changes.setdefault(shard_of(name), ({}, set()))[1].add(name)
+    saved = {
+        shard: _save_shard(container_client, shard, shard_entries, shard_removed, known(shard))
+        for shard, (shard_entries, shard_removed) in sorted(changes.items())
+    }
+    if legacy:
+        try:
+            with metrics.request('delete_blob'):
+                container_client.get_blob_client(INDEX_BLOB).delete_blob(
+                    etag=existing[INDEX_BLOB], match_condition=MatchConditions.IfNotModified
+                )
+        except (ResourceModifiedError, ResourceNotFoundError):
+            log.warning('%s changed while moving it into shards, it is kept and moved again next save.', INDEX_BLOB)
+    log.info('Pack index updated, %d files packed and %d dropped in %d shards.',
+             len(entries), len(removed), len(saved))
+    return saved
+
+def group_by_pack(index: dict, name_starts_with=None) -> dict:
+    '''{pack name: [PackedFile]} for the files under name_starts_with, in pack order.'''
+    packs = {}
+    for entry in index.values():
+        if entry.name.startswith(name_starts_with or ''):
+            packs.setdefault(entry.pack, []).append(entry)
+    for members in packs.values():
+        members.sort(key=lambda x: x.offset)
+    return packs
+
+def expand_packs(blobs, container_client: ContainerClient, name_starts_with=None):
+    '''
+    Passes a container listing through without the pack blobs, then yields a PackSlice per pack holding files
+    under name_starts_with, so each pack is read in one go. Costs the index shards and one listing of the packs.
+    A file that is also a plain blob is only taken from the blob, the pack holds an older copy of it.
+    '''
+    index = load_index(container_client)
+    for blob_info in blobs:
+        if not is_pack_blob(blob_info.name):
+            index.pop(blob_info.name, None)
+            yield blob_info
+    if not index:
+        return
+    tiers = {x.name: x.blob_tier for x in container_client.list_blobs(name_starts_with=PACK_PREFIX)}
+    for pack, members in group_by_pack(index, name_starts_with).items():
+        yield PackSlice(pack, tiers.get(pack), sum(x.size for x in members), members)
+
+def _read_spans(members: list, span_size: int):
+    '''Groups members lying one after the other in a pack into runs of about span_size, one GET each.'''
+    span = []
+    for entry in members:
+        if span and entry.offset + entry.size - span[0].offset > span_size:
+            yield span
+            span = []
+        span.append(entry)
+    if span:
+        yield span
+
+def extract_pack(container_client: ContainerClient,
+                 pack: str,
+                 members: list,
+                 destination: str,
+                 overwrite: bool,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 budget: TransferBudget = None
+                ) -> list:
+    '''
+    Writes members (PackedFiles of pack, in pack order) to destination/name using ranged GETs of about
+    chunk_size, so a single file costs one small read and a whole pack streams in a few big ones. Each file
+    is checked against its md5. Files already there are left alone unless overwrite. Returns the members
+    that failed their md5 check.
+    '''
+    blob = container_client.get_blob_client(pack)
+    failed = []
+    wanted = []
+    for entry in members:
+        if os.path.isfile(os.path.join(destination, entry.name)) and not overwrite:
+            log.error('file %s already exists and is not set to overwrite.', entry.name)
+            metrics.inc('files_total', operation='skip')
+            metrics.inc('skipped_bytes_total', entry.size)
+            continue
+        wanted.append(entry)
+    for span in _read_spans(wanted, chunk_size):
+        start = span[0].offset
+        length = span[-1].offset + span[-1].size - start
+        data = fetch_range(blob, start, length, budget=budget) if length else b''
+        for entry in span:
+            content = data[entry.offset - start:entry.offset - start + entry.size]
+            destination_filename = os.path.join(destination, entry.name)
+            if hashlib.md5(content).hexdigest() != entry.md5:
+                log.error('%s from %s md5sum mismatch with the pack index.', entry.name, pack)
+                metrics.inc('md5_mismatches_total')
+                metrics.inc('files_total', operation='failed')
+                failed.append(entry)
+                continue
+            os.makedirs(os.path.dirname(destination_filename) or '.', exist_ok=True)
+            with open(destination_filename, 'wb') as fp:
+                fp.write(content)
+            metrics.inc('files_total', operation='download')
+    log.info('Extracted %d files from %s.', len(wanted) - len(failed), pack)
+    return failed
+
+class PackWriter:
+    '''
+    One pack being written: files are laid out as a tar stream (so a pack can also be read with tar) and
+    staged block_size at a time as it fills, then committed with its md5 as the Content-MD5.
+    '''
+    def __init__(self,
+                 container_client: ContainerClient,
+                 name: str,
+                 tier: StandardBlobTier,
+                 block_size: int,
+                 budget: TransferBudget = None
+                ):
+        self.name = name
+        self.blob_client = container_client.get_blob_client(name)
+        self.tier = tier
+        self.block_size = block_size
+        self.budget = budget
+        self.buffer = bytearray()
+        self.blocks = []
+        self.size = 0
+        self.members = [] # [(PackedFile, filename, stat)]
+        self.pack_hash = hashlib.md5()
+        self.etag = None
+
+    def add(self, filename: str, azure_filename: str, data: bytes, file_md5: str, stat: os.stat_result) -> None:
+        info = tarfile.TarInfo(azure_filename)
+        info.size = len(data)
+        info.mtime = int(stat.st_mtime)
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT)
+        entry = PackedFile(azure_filename, self.name, self.size + len(header), len(data), file_md5)
+        mark, size, pack_hash = len(self.buffer), self.size, self.pack_hash.copy()
+        self._write(header)
+        self._write(data)
+        self._write(bytes(-len(data) % TAR_BLOCK))
+        try:
+            self._flush(self.block_size)
+        except Exception:
+            # Nothing of the file counts as staged yet, take it back out so a retry adds it once
+            del self.buffer[mark:]
+            self.size, self.pack_hash = size, pack_hash
+            raise
+        self.members.append((entry, filename, stat))
+
+    def _write(self, data: bytes) -> None:
+        self.buffer += data
+        self.size += len(data)
+        self.pack_hash.update(data)
+
+    def _flush(self, at_least: int) -> None:
+        '''
+        Stages whole blocks while the buffer holds at_least bytes. The buffer and block list only move on
+        once every block of the call is in, so a failure leaves the pack as it was before the call.
+        '''
+        staged = []
+        offset = 0
+        while len(self.buffer) > offset and len(self.buffer) - offset >= at_least:
+            block = bytes(self.buffer[offset:offset + self.block_size])
+            chunk_id = block_id(len(self.blocks) + len(staged))
+            for attempt in range(RANGE_ATTEMPTS):
+                try:
+                    with (self.budget.slot() if self.budget else nullcontext()), metrics.request('stage_block'):
+                        self.blob_client.stage_block(
+                            chunk_id, block, length=len(block), validate_content=TRANSACTIONAL_CHECK
+                        )
+                    break
+                except AzureError as e:
+                    if attempt + 1 >= RANGE_ATTEMPTS:
+                        raise
+                    log.warning('Block %d of %s failed, staging again: %s',
+                                len(self.blocks) + len(staged), self.name, e)
+            metrics.inc('azure_bytes_total', len(block), direction='upload')
+            staged.append(BlobBlock(block_id=chunk_id))
+            offset += len(block)
+        self.blocks += staged
+        del self.buffer[:offset]
+
+    def finish(self) -> None:
+        self._write(bytes(TAR_BLOCK * 2)) # End of archive
+        self._flush(1)
+        with (self.budget.slot() if self.budget else nullcontext()), metrics.request('commit_block_list'):
+            response = self.blob_client.commit_block_list(
+                self.blocks,
+                content_settings=ContentSettings(content_md5=bytearray(self.pack_hash.digest())),
+                metadata={'pack': PACK_FORMAT, 'files': str(len(self.members))},
+                standard_blob_tier=self.tier
+            )
+        self.etag = response.get('etag')
+        log.info('Committed pack %s, %d files in %d bytes.', self.name, len(self.members), self.size)
+
+class Packer:
+    '''
+    Sends files smaller than threshold into packs of about pack_size instead of blobs of their own. Every
+    worker thread fills a pack of its own so they never wait on each other. A file counts as uploaded once
+    its pack is committed, and is findable once close() has merged this runs files into the index shards;
+    a crash in between leaves packs the index doesn't point at, their files are just sent again next run.
+    Files replaced by a later run stay in their old pack, only the index moves on. A packed file that grew
+    past threshold goes up as a plain blob, forget() it so close() takes it out of the index; until then,
+    and after a crash, a plain blob always wins over a pack entry of the same name.
+    '''
+    def __init__(self,
+                 container_client: ContainerClient,
+                 tier: StandardBlobTier,
+                 pack_size=DEFAULT_PACK_SIZE,
+                 threshold=DEFAULT_PACK_THRESHOLD,
+                 block_size=DEFAULT_BLOCK_SIZE,
+                 budget: TransferBudget = None,
+                 md5sums=None,
+                 blob_index=None
+                ):
+        self.container_client = container_client
+        self.tier = tier
+        self.pack_size = pack_size
+        self.threshold = threshold
+        self.block_size = block_size
+        self.budget = budget
+        self.md5sums = md5sums
+        self.blob_index = blob_index # A blob_index.BlobIndex to take the shards from and write them through to
+        # Saved from on close, unchanged shards aren't read again
+        self.shards = load_shards(container_client) if blob_index is None else blob_index.pack_shards()
+        self.index = merge_shards(self.shards)
+        self.entries = {} # What this run packed, merged into the index on close
+        self.removed = set() # Packed files this run sent as plain blobs, dropped from the index on close
+        self.shadowed = set() # Packed files that are plain blobs as well, the blob is the real one
+        self.failed = [] # Filenames lost with a pack that couldn't be committed
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writers = []
+        self._run = f'{time.strftime("%Y%m%dT%H%M%S")}-{os.urandom(3).hex()}'
+        self._count = itertools.count()
+
+    def remote_index(self, remote_index: dict) -> dict:
+        '''
+        The packed files as RemoteBlobs for manifest.plan_uploads, tiers taken from the packs in remote_index.
+        Files remote_index already has as plain blobs are left out, those entries are stale.
+        '''
+        self.shadowed = {x for x in self.index if x in remote_index}
+        return {
+            x.name: RemoteBlob(x.md5, x.size, remote_index[x.pack].tier if x.pack in remote_index else None, None)
+            for x in self.index.values()
+            if x.name not in self.shadowed
+        }
+
+    def wants(self, filename: str, azure_filename: str, remote=None) -> bool:
+        '''Small files go in packs, unless they are already plain blobs, those are updated where they are.'''
+        if os.path.getsize(filename) >= self.threshold:
+            return False
+        return remote is None or (azure_filename in self.index and azure_filename not in self.shadowed)
+
+    def forget(self, azure_filename: str) -> None:
+        '''azure_filename went up as a plain blob, any entry the index has for it goes on close().'''
+        if azure_filename in self.index or azure_filename in self.shadowed:
+            with self._lock:
+                self.removed.add(azure_filename)
+
+    def add(self, filename: str, azure_filename: str, remote=None) -> None:
+        '''Appends the file to this threads pack, skipping it when it matches remote.'''
+        stat = os.stat(filename)
+        with open(filename, 'rb') as fp:
+            data = fp.read()
+        file_md5 = hashlib.md5(data).hexdigest()
+        if remote is not None and remote.md5 == file_md5:
+            log.info('MD5Sums Match - no-op for %s', filename)
+            metrics.inc('files_total', operation='skip')
+            metrics.inc('skipped_bytes_total', len(data))
+            if self.md5sums is not None:
+                self.md5sums.record_md5sum(filename, file_md5, stat)
+            return
+        writer = getattr(self._local, 'writer', None)
+        if writer is None:
+            name = f'{PACK_PREFIX}{self._run}-{next(self._count):05d}.tar'
+            writer = self._local.writer = PackWriter(
+                self.container_client, name, self.tier, self.block_size, self.budget
+            )
+            with self._lock:
+                self._writers.append(writer)
+        writer.add(filename, azure_filename, data, file_md5, stat)
+        if writer.size >= self.pack_size:
+            self._local.writer = None
+            self._finish(writer)
+
+    def _finish(self, writer: PackWriter) -> None:
+        with self._lock:
+            self._writers.remove(writer)
+        try:
+            writer.finish()
+        except Exception as e:
+            log.error('Could not commit pack %s, its %d files were not sent: %s',
+                      writer.name, len(writer.members), e)
+            with self._lock:
+                self.failed.extend(filename for _, filename, _ in writer.members)
+            return
+        with self._lock:
+            for entry, _, _ in writer.members:
+                self.entries[entry.name] = entry
+        if self.blob_index is not None:
+            self.blob_index.record(writer.name, writer.size, self.tier, writer.pack_hash.hexdigest(), writer.etag)
+        for entry, filename, stat in writer.members:
+            metrics.inc('files_total', operation='upload')
+            if self.md5sums is not None:
+                self.md5sums.record_md5sum(filename, entry.md5, stat)
+
+    def close(self) -> list:
+        '''Commits the packs still open and merges this runs files into the index. Returns the files that failed.'''
+        for writer in list(self._writers):
+            self._finish(writer)
+        removed = self.removed - self.entries.keys()
+        if self.entries or removed:
+            saved = save_index(self.container_client, self.entries, removed, self.shards)
+            self.shards.update(saved)
+            if self.blob_index is not None:
+                self.blob_index.record_packs(saved)
+            self.index.update(self.entries)
+            for name in removed:
+                self.index.pop(name, None)
+        return self.failed
@@ -0,0 +1,72 @@
+'''Hashes the files an upload plan has to compare ahead of the upload workers, on every core'''
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import os
+
+from .logger import log
+from .manifest import UPDATE
+from .metrics import metrics
+from .md5summer import md5summer, md5_file
+
+def _hash(filename: str) -> (str, os.stat_result):
+    stat = os.stat(filename) # Taken before reading so a change while hashing isn't cached as fresh
+    return md5_file(filename), stat
+
+def prehash_plan(plan, md5sums: md5summer, workers=None, lookahead=None):
+    '''
+    Yields the items of an upload plan, hashing the UPDATE ones whose md5sum isn't cached yet on a pool of
+    workers threads (defaults to the number of cores, fewer suits spinning disks). Hashing reads in large
+    buffers, so hashlib runs without the GIL and the threads really do use separate cores. Items with
+    nothing to hash are passed on straight away so the upload workers never wait on hashing, the others
+    once their md5sum is in the cache, and ones that turn out to match the container are dropped.
+    At most lookahead files (4 per worker by default) are being hashed or waiting to be handed out.
+    '''
+    workers = workers or os.cpu_count() or 1
+    lookahead = lookahead or workers * 4
+    hashed = matched = 0
+
+    def needs_hash(item):
+        action, filename, _, remote, _ = item
+        if action != UPDATE or remote is None:
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError: # Gone since the scan, the upload worker reports it for this file alone
+            return False
+        # upload_blob doesn't hash when the sizes differ, it just sends the file
+        return stat.st_size == remote.size and md5sums.cached_md5sum(filename, stat) is None
+
+    def finished(done):
+        nonlocal hashed, matched
+        for future in done:
+            item = futures.pop(future)
+            try:
+                file_md5, stat = future.result()
+            except OSError as e:
+                log.error('Could not hash %s, leaving it to the upload: %s', item[1], e)
+                yield item
+                continue
+            hashed += 1
+            md5sums.record_md5sum(item[1], file_md5, stat)
+            if file_md5 == item[3].md5:
+                matched += 1
+                metrics.inc('files_total', operation='skip')
+                metrics.inc('skipped_bytes_total', item[3].size)
+                log.info('MD5Sums Match - no-op for %s', item[1])
+                continue
+            yield item
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prehash') as pool:
+        for item in plan:
+            yield from finished([x for x in futures if x.done()])
+            if not needs_hash(item):
+                yield item
+                continue
+            if len(futures) >= lookahead:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                yield from finished(done)
+            futures[pool.submit(_hash, item[1])] = item
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            yield from finished(done)
+    log.info('Pre-hashed %d files, %d already matched the container.', hashed, matched)
@@ -0,0 +1,161 @@
+'''Progress and ETA for long transfers, worked out from the metrics counters on a thread of its own'''
+import argparse
+import sys
+import threading
+import time
+
+from .logger import log
+from .metrics import metrics
+
+def human_bytes(num: float) -> str:
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if abs(num) < 1024.0:
+            return f'{num:.1f}{unit}'
+        num /= 1024.0
+    return f'{num:.1f}PiB'
+
+def human_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return f'{seconds // 86400}d{seconds % 86400 // 3600}h'
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    return f'{seconds // 60}m{seconds % 60:02d}s'
+
+class Progress:
+    '''
+    Reports files and bytes done against what was planned, aggregate MB/s, an ETA from an exponential moving
+    average of the rate, busy workers and queue depth. Transfer threads don't do anything for it: the bytes
+    and files they already count in metrics are read back here every interval. mode 'tty' redraws one line
+    on stderr, 'log' writes a summary line through the logger every interval (cron friendly).
+    '''
+    def __init__(self, total_files=0, total_bytes=0, mode='tty', interval=1.0, smoothing=0.1):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.mode = mode
+        self.interval = interval
+        self.smoothing = smoothing
+        self.listing_done = True
+        self.started = time.monotonic()
+        self.rate = None
+        self._last = (self.started, 0)
+        self._base = self._counts() # Anything counted before this job started isn't part of it
+        self._stop = threading.Event()
+        self._thread = None
+
+    def planned(self, items, size):
+        '''
+        Passes items through while adding them to the totals, for jobs that are listed as they run.
+        size(item) gives the bytes an item will move, None leaves it out of the totals.
+        '''
+        self.listing_done = False
+        for item in items:
+            item_size = size(item)
+            if item_size is not None:
+                self.total_files += 1
+                self.total_bytes += item_size
+            yield item
+        self.listing_done = True
+
+    async def planned_async(self, items, size):
+        '''planned for async iterables.'''
+        self.listing_done = False
+        async for item in items:
+            item_size = size(item)
+            if item_size is not None:
+                self.total_files += 1
+                self.total_bytes += item_size
+            yield item
+        self.listing_done = True
+
+    @staticmethod
+    def _counts() -> dict:
+        snap = metrics.snapshot()
+        def total(kind, name):
+            return sum(v for k, v in snap[kind].items() if k[0] == name)
+        return {
+            'files': total('counters', 'files_total'),
+            'moved': total('counters', 'azure_bytes_total'),
+            'skipped': total('counters', 'skipped_bytes_total'),
+            'saved': total('counters', 'compression_saved_bytes_total'), # Planned sizes are before compression
+            'busy': total('gauges', 'workers_busy'),
+            'queue': total('gauges', 'worker_queue_depth'),
+        }
+
+    def sample(self) -> dict:
+        counts = self._counts()
+        for name in ('files', 'moved', 'skipped', 'saved'):
+            counts[name] -= self._base[name]
+        counts['bytes'] = min(counts['moved'] + counts['skipped'] + counts['saved'], self.total_bytes or float('inf'))
+        return counts
+
+    def update(self) -> str:
+        now = time.monotonic()
+        current = self.sample()
+        last_time, last_moved = self._last
+        if now > last_time:
+            instant = (current['moved'] - last_moved) / (now - last_time)
+            self.rate = instant if self.rate is None else self.smoothing * instant + (1 - self.smoothing) * self.rate
+        self._last = (now, current['moved'])
+
+        average = current['moved'] / max(now - self.started, 1e-9)
+        remaining = max(self.total_bytes - current['bytes'], 0)
+        if not self.listing_done:
+            eta = 'listing'
+        elif remaining == 0:
+            eta = 'done'
+        elif self.rate:
+            eta = human_seconds(remaining / self.rate)
+        else:
+            eta = '?'
+        percent = f' ({current["bytes"] / self.total_bytes:.0%})' if self.total_bytes else ''
+        return (
+            f'{current["files"]}/{self.total_files} files  '
+            f'{human_bytes(current["bytes"])}/{human_bytes(self.total_bytes)}{percent}  '
+            f'{(self.rate or 0) / 1024 ** 2:.1f}MiB/s (avg {average / 1024 ** 2:.1f})  ETA {eta}  '
+            f'workers busy {current["busy"]}  queue {current["queue"]}'
+        )
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.show()
+
+    def show(self) -> None:
+        line = self.update()
+        if self.mode == 'tty':
+            sys.stderr.write('\r\033[K' + line)
+            sys.stderr.flush()
+        else:
+            log.info('Progress: %s', line)
+
+    def start(self) -> 'Progress':
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='progress')
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        '''Stops reporting and prints one last line.'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.show()
+        if self.mode == 'tty':
+            sys.stderr.write('\n')
+
+def add_progress_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group('progress')
+    group.add_argument('--progress', choices=['auto', 'tty', 'log', 'off'], default='auto',
+                       help='tty redraws a status line, log writes a summary every --progress-interval, '
+                            'auto picks tty when stderr is a terminal')
+    group.add_argument('--progress-interval', type=float,
+                       help='Seconds between updates, defaults to 1 on a tty and 60 in log mode')
+
+def from_args(args, total_files=0, total_bytes=0) -> Progress:
+    '''A started Progress for the flags add_progress_arguments made, None with --progress off.'''
+    if args.progress == 'off':
+        return None
+    mode = args.progress
+    if mode == 'auto':
+        mode = 'tty' if sys.stderr.isatty() else 'log'
+    interval = args.progress_interval or (1.0 if mode == 'tty' else 60.0)
+    return Progress(total_files, total_bytes, mode, interval).start()
@@ -0,0 +1,189 @@
+'''Overlaps rehydration with downloading, blobs are handed to the download pool as soon as they come online'''
+import atexit
+from collections import Counter
+import itertools
+import sqlite3
+import threading
+import time
+
+from azure.storage.blob import ContainerClient, StandardBlobTier, RehydratePriority
+
+from .azure_client import iter_blobs, set_blob_tier_batch, batched, BatchThrottled, BATCH_SIZE, ONLINE_TIERS
+from .logger import log
+from .pack import is_pack_blob, PACK_PREFIX
+
+ARCHIVED = 'archived'       # Still needs a rehydration request
+PENDING = 'pending'         # Rehydration requested, waiting on the service
+READY = 'ready'             # Online, handed to the download pool
+DOWNLOADED = 'downloaded'
+FAILED = 'failed'
+MAX_TIER_ATTEMPTS = 5 # Refused tier changes per blob before a restore gives up on it
+
+class RestoreState:
+    '''
+    Where every blob of a restore is at, in SQLite so a restore can be stopped and picked up again. State
+    changes are buffered and committed in batches like md5summer does, with synchronous=NORMAL, so a big
+    restore isn't one fsync per blob. Buffered changes are lost in a crash, that only costs handing those
+    blobs out again.
+    '''
+    def __init__(self, state_file: str, batch_size=500, flush_interval=5.0):
+        self._lock = threading.Lock()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = {} # {name: (state, updated)} waiting to be written
+        self._last_flush = time.monotonic()
+        self.conn = sqlite3.connect(state_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, state TEXT, updated REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS blobs_state ON blobs (state)')
+            columns = {x[1] for x in self.conn.execute('PRAGMA table_info(blobs)')}
+            if 'attempts' not in columns: # State files from before tier changes were counted
+                self.conn.execute('ALTER TABLE blobs ADD COLUMN attempts INTEGER DEFAULT 0')
+        atexit.register(self.close)
+
+    def get(self, name: str) -> str:
+        with self._lock:
+            if name in self._pending:
+                return self._pending[name][0]
+            row = self.conn.execute('SELECT state FROM blobs WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, names, state: str) -> None:
+        now = time.time()
+        with self._lock:
+            for name in names:
+                self._pending[name] = (state, now)
+            due = (len(self._pending) >= self.batch_size
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        '''Writes out everything buffered in one transaction.'''
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO blobs (name, state, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET state = excluded.state, updated = excluded.updated',
+                ((name, state, updated) for name, (state, updated) in self._pending.items())
+            )
+            self._pending = {}
+            self._last_flush = time.monotonic()
+
+    def failed_attempt(self, names: list, max_attempts: int) -> list:
+        '''Counts a failed tier change against each name, returns the ones that have now used max_attempts.'''
+        self.flush()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'UPDATE blobs SET attempts = COALESCE(attempts, 0) + 1 WHERE name = ?', ((x,) for x in names)
+            )
+            return [
+                name for name in names
+                if self.conn.execute('SELECT attempts FROM blobs WHERE name = ?', (name,)).fetchone()[0]
+                >= max_attempts
+            ]
+
+    def counts(self) -> dict:
+        self.flush()
+        with self._lock:
+            return dict(self.conn.execute('SELECT state, COUNT(*) FROM blobs GROUP BY state'))
+
+    def names(self, state: str) -> list:
+        self.flush()
+        with self._lock:
+            return [x[0] for x in self.conn.execute('SELECT name FROM blobs WHERE state = ?', (state,))]
+
+    def close(self) -> None:
+        self.flush()
+
+def request_rehydration(container_client: ContainerClient,
+                        state: RestoreState,
+                        names: list,
+                        tier: StandardBlobTier,
+                        priority: RehydratePriority,
+                        max_attempts=MAX_TIER_ATTEMPTS
+                       ) -> None:
+    '''
+    Sends tier changes in blob batches, names that were throttled stay ARCHIVED for the next poll. Names
+    the service refused are asked for again on later polls until they have failed max_attempts times,
+    then they are marked FAILED.
+    '''
+    counts = Counter()
+    lock = threading.Lock()
+    log.info('Requesting rehydration of %d blobs to %s.', len(names), tier.value)
+    state.set(names, ARCHIVED)
+    for batch in batched(names, BATCH_SIZE):
+        sent = list(batch)
+        refused = []
+        try:
+            set_blob_tier_batch(container_client, batch, tier, priority, counts, lock, refused)
+        except BatchThrottled:
+            log.warning('%d rehydration requests throttled, trying them again next poll.', len(batch))
+            throttled = set(batch)
+            sent = [x for x in sent if x not in throttled]
+        refused_set = set(refused)
+        state.set([x for x in sent if x not in refused_set], PENDING)
+        if refused:
+            given_up = state.failed_attempt(refused, max_attempts)
+            if given_up:
+                log.error('Giving up on rehydrating %d blobs after %d refused tier changes: %s',
+                          len(given_up), max_attempts, ', '.join(given_up))
+                state.set(given_up, FAILED)
+
+def restore_feed(container_client: ContainerClient,
+                 state: RestoreState,
+                 tier: StandardBlobTier,
+                 priority: RehydratePriority,
+                 name_starts_with=None,
+                 min_interval=60.0,
+                 max_interval=1800.0,
+                 packs=(),
+                 max_attempts=MAX_TIER_ATTEMPTS
+                ):
+    '''
+    Yields BlobProperties (with metadata) for every blob that is online and not downloaded yet, first from the
+    initial listing, then from polling. Archived blobs get rehydration requested as they are found. Each poll
+    is one paginated listing, and the wait between polls doubles while nothing comes online (up to
+    max_interval) and drops back to min_interval as soon as something does. Stops once a listing finds
+    nothing left offline. Blobs left READY or FAILED by an earlier run are handed out again on the first pass.
+    Of the blobs under the pack prefix only the packs named in packs are restored, whatever name_starts_with.
+    Blobs whose tier change was refused max_attempts times are marked FAILED and not waited on any more.
+    '''
+    interval = min_interval
+    first = True
+    while True:
+        to_rehydrate = []
+        became_ready = waiting = 0
+        listing = iter_blobs(container_client, name_starts_with, include=['metadata'])
+        if packs and not PACK_PREFIX.startswith(name_starts_with or ''):
+            listing = itertools.chain(listing, iter_blobs(container_client, PACK_PREFIX, include=['metadata']))
+        for blob_info in listing:
+            if is_pack_blob(blob_info.name) and blob_info.name not in packs:
+                continue
+            known = state.get(blob_info.name)
+            if known == DOWNLOADED or (known in (READY, FAILED) and not first):
+                continue
+            if blob_info.blob_tier in ONLINE_TIERS:
+                state.set([blob_info.name], READY)
+                became_ready += 1
+                yield blob_info
+                continue
+            waiting += 1
+            if blob_info.archive_status:
+                if known != PENDING:
+                    state.set([blob_info.name], PENDING)
+            else:
+                to_rehydrate.append(blob_info.name)
+                if len(to_rehydrate) >= BATCH_SIZE:
+                    request_rehydration(container_client, state, to_rehydrate, tier, priority, max_attempts)
+                    to_rehydrate = []
+        if to_rehydrate:
+            request_rehydration(container_client, state, to_rehydrate, tier, priority, max_attempts)
+        first = False
+
+        if not waiting:
+            return
+        interval = min_interval if became_ready else min(interval * 2, max_interval)
+        log.info('%d blobs came online, %d still rehydrating, polling again in %.0fs.', became_ready, waiting, interval)
+        time.sleep(interval)
@@ -0,0 +1,120 @@
+'''Walks a local tree with os.scandir, optionally in parallel and against a snapshot of the last scan'''
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import json
+import os
+import sqlite3
+from typing import NamedTuple
+
+from .logger import log
+
+class ScanEntry(NamedTuple):
+    path: str
+    azure_name: str
+    size: int
+    mtime_ns: int
+
+def _scan_dir(path: str, cached) -> (int, list, list, bool):
+    '''
+    Lists one directory, returns (mtime_ns, files, subdirs, reused). files are (name, size, mtime_ns) and
+    subdirs are names. When the cached listing has the same mtime_ns nothing is listed, since adding,
+    removing or renaming an entry always bumps the directories mtime.
+    '''
+    mtime_ns = os.stat(path).st_mtime_ns
+    if cached is not None and cached[0] == mtime_ns:
+        return mtime_ns, cached[1], cached[2], True
+    files, subdirs = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.name.startswith('.'):
+                continue # Hidden files were never picked up by the old glob, hidden folders were
+            elif entry.is_dir():
+                continue # Symlinked folders are not followed
+            else:
+                try:
+                    stat = entry.stat() # Cached by scandir on most platforms, no extra syscall
+                except OSError as e:
+                    log.error('Could not stat %s: %s', entry.path, e)
+                    continue
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return mtime_ns, files, subdirs, False
+
+class ScanSnapshot:
+    '''Directory listings from the last scan kept in SQLite, looked up one directory at a time.'''
+    def __init__(self, snapshot_file: str):
+        # scan_tree is a generator and --async steps it from whichever thread is free, one step at a time
+        self.conn = sqlite3.connect(snapshot_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, listing TEXT)')
+
+    def get(self, path: str):
+        row = self.conn.execute('SELECT mtime_ns, listing FROM dirs WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        files, subdirs = json.loads(row[1])
+        return row[0], [tuple(x) for x in files], subdirs
+
+    def put(self, path: str, mtime_ns: int, files: list, subdirs: list) -> None:
+        self.conn.execute(
+            'INSERT OR REPLACE INTO dirs (path, mtime_ns, listing) VALUES (?, ?, ?)',
+            (path, mtime_ns, json.dumps([files, subdirs]))
+        )
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+def scan_tree(folder: str, strip_base_folder=False, workers=1, snapshot_file=None):
+    '''
+    Yields a ScanEntry for every file under folder as directories get listed. Azure names are relative to
+    the folders parent, or to the folder itself with strip_base_folder. With workers > 1 subtrees are listed
+    on a thread pool. With a snapshot_file, directories whose mtime hasn't moved reuse the last listing
+    instead of being read again; files edited in place don't change their directory, so those keep the
+    size/mtime from the snapshot (the upload plan stats files it compares anyway).
+    '''
+    folder = os.path.normpath(folder)
+    base = folder if strip_base_folder else os.path.dirname(folder)
+    snapshot = ScanSnapshot(snapshot_file) if snapshot_file else None
+    listed = reused = 0
+
+    def entries(path, files):
+        for name, size, mtime_ns in files:
+            full = os.path.join(path, name)
+            yield ScanEntry(full, os.path.relpath(full, base) if base else full, size, mtime_ns)
+
+    def handle(path, result):
+        nonlocal listed, reused
+        mtime_ns, files, subdirs, was_reused = result
+        if was_reused:
+            reused += 1
+        else:
+            listed += 1
+            if snapshot is not None:
+                snapshot.put(path, mtime_ns, files, subdirs)
+        return [os.path.join(path, x) for x in subdirs], entries(path, files)
+
+    cached = lambda path: snapshot.get(path) if snapshot is not None else None
+
+    if workers <= 1:
+        pending = [folder]
+        while pending:
+            path = pending.pop()
+            subdirs, found = handle(path, _scan_dir(path, cached(path)))
+            pending.extend(subdirs)
+            yield from found
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan') as pool:
+            futures = {pool.submit(_scan_dir, folder, cached(folder)): folder}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = futures.pop(future)
+                    subdirs, found = handle(path, future.result())
+                    for subdir in subdirs:
+                        futures[pool.submit(_scan_dir, subdir, cached(subdir))] = subdir
+                    yield from found
+
+    if snapshot is not None:
+        snapshot.commit()
+    log.info('Scanned %s: listed %d directories, reused %d from the snapshot.', folder, listed, reused)
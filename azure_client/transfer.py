@@ -0,0 +1,252 @@
+'''Block level transfer engine, splits big files into blocks/ranges and moves them in parallel'''
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+import hashlib
+import os
+import threading
+
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError
+from azure.storage.blob import BlobClient, BlobBlock, ContentSettings, StandardBlobTier
+
+from .fileio import advise_sequential
+from .logger import log
+from .metrics import metrics
+
+try:
+    import azure.storage.extensions.checksums # Only needed so the SDK can do crc64
+    TRANSACTIONAL_CHECK = 'crc64'
+except ImportError:
+    TRANSACTIONAL_CHECK = True # Transactional md5, works on every SDK version
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+MAX_BLOCK_SIZE = 4000 * 1024 * 1024
+MAX_BLOCKS = 50000 # Azure's limit of blocks in one blob
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024 # Biggest range the service will send a transactional md5 for
+RANGE_ATTEMPTS = 3
+
+class TransferBudget:
+    '''
+    Global cap on requests in flight, shared by every file worker and every block so a few huge files and
+    lots of small ones split the same connections. Blocks run on one shared pool sized to the budget.
+    '''
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.pool = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='block')
+
+    @contextmanager
+    def slot(self):
+        '''Hold one connection for the length of a request.'''
+        with self._slots:
+            yield
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=True)
+
+def block_id(index: int) -> str:
+    '''Block ids have to be base64 and the same length for every block in a blob'''
+    return base64.b64encode(f'{index:08d}'.encode()).decode()
+
+def pick_block_size(file_size: int, block_size: int) -> int:
+    '''Grows the block size if the file would need more blocks than a blob can hold.'''
+    while file_size > block_size * MAX_BLOCKS and block_size < MAX_BLOCK_SIZE:
+        block_size = min(block_size * 2, MAX_BLOCK_SIZE)
+    return block_size
+
+def upload_file(blob_client: BlobClient,
+                filename: str,
+                tier: StandardBlobTier,
+                block_size=DEFAULT_BLOCK_SIZE,
+                max_concurrency=1,
+                budget: TransferBudget = None,
+                journal=None
+               ) -> (dict, str):
+    '''
+    Uploads filename, hashing it as it is read so the file only goes through once. Files that fit in one
+    block go up in a single put, anything bigger is staged as blocks (up to max_concurrency at a time for
+    this file, all inside the shared budget) and committed. Every request carries a transactional checksum
+    the service checks the body against, and the whole file md5 is stored as the blobs Content-MD5 (plus
+    the md5 metadata older versions read). Returns (operation, md5).
+    With a BlockJournal, staged blocks are journaled and blocks a crashed run already staged are only
+    read back locally for the md5, not sent again.
+    '''
+    file_size = os.path.getsize(filename)
+    block_size = pick_block_size(file_size, block_size)
+    already_staged = {}
+    if journal is not None and file_size > block_size:
+        block_size, already_staged = journal.resume(blob_client, filename, block_size)
+    own_budget = budget is None
+    if own_budget:
+        budget = TransferBudget(max_concurrency)
+    file_hash = hashlib.md5()
+
+    try:
+        with open(filename, 'rb') as fp:
+            advise_sequential(fp.fileno())
+            if file_size <= block_size:
+                data = fp.read()
+                file_hash.update(data)
+                file_md5 = file_hash.hexdigest()
+                with budget.slot(), metrics.request('put_blob'):
+                    operation = blob_client.upload_blob(
+                        data,
+                        length=len(data),
+                        overwrite=True,
+                        standard_blob_tier=tier,
+                        content_settings=ContentSettings(content_md5=bytearray(file_hash.digest())),
+                        metadata={'md5': file_md5},
+                        validate_content=TRANSACTIONAL_CHECK
+                    )
+                metrics.inc('azure_bytes_total', len(data), direction='upload')
+                return operation, file_md5
+
+            in_flight = threading.BoundedSemaphore(max_concurrency)
+            futures = []
+            block_list = []
+
+            def stage(index, chunk_id, chunk):
+                try:
+                    with budget.slot(), metrics.request('stage_block'):
+                        blob_client.stage_block(
+                            chunk_id, chunk, length=len(chunk), validate_content=TRANSACTIONAL_CHECK
+                        )
+                    metrics.inc('azure_bytes_total', len(chunk), direction='upload')
+                    if journal is not None:
+                        journal.record(blob_client, filename, index, index * block_size, len(chunk))
+                finally:
+                    in_flight.release()
+
+            # Blocks are read into bytes of their own rather than handed over as views of a map: the SDK only
+            # checksums bytes bodies, and a block still going up has to outlive the reads after it.
+            while chunk := fp.read(block_size):
+                file_hash.update(chunk)
+                index = len(block_list)
+                chunk_id = block_id(index)
+                block_list.append(BlobBlock(block_id=chunk_id))
+                if already_staged.get(index) == len(chunk):
+                    continue
+                in_flight.acquire() # Keeps at most max_concurrency blocks of this file in memory
+                futures.append(budget.pool.submit(stage, index, chunk_id, chunk))
+                if futures[0].done():
+                    futures.pop(0).result() # Surface failures early instead of reading the whole file
+            for future in futures:
+                future.result()
+    finally:
+        if own_budget:
+            budget.shutdown()
+
+    file_md5 = file_hash.hexdigest()
+    log.debug('Staged %d blocks of %d bytes for %s, md5 %s', len(block_list), block_size, filename, file_md5)
+    with budget.slot(), metrics.request('commit_block_list'):
+        operation = blob_client.commit_block_list(
+            block_list,
+            content_settings=ContentSettings(content_md5=bytearray(file_hash.digest())),
+            metadata={'md5': file_md5},
+            standard_blob_tier=tier
+        )
+    if journal is not None:
+        journal.finish(blob_client, filename)
+    return operation, file_md5
+
+def write_pieces(destination_filename: str,
+                 size: int,
+                 pieces,
+                 fetch,
+                 max_concurrency=1,
+                 budget: TransferBudget = None
+                ) -> str:
+    '''
+    Preallocates destination_filename and fills it from pieces, (offset, length, ...) tuples in file order
+    that fetch(piece) turns into bytes. Up to max_concurrency pieces are fetched at once inside budget and
+    each is written at its offset as it lands. The whole file md5 is worked out in order as pieces arrive,
+    so the file is never read back. Returns the md5.
+    '''
+    own_budget = budget is None
+    if own_budget:
+        budget = TransferBudget(max_concurrency)
+    file_hash = hashlib.md5()
+
+    fd = os.open(destination_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+    def fetch_and_write(piece):
+        data = fetch(piece)
+        os.pwrite(fd, data, piece[0])
+        return data
+
+    pending = deque()
+    try:
+        if size and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+        for piece in pieces:
+            pending.append(budget.pool.submit(fetch_and_write, piece))
+            if len(pending) >= max_concurrency: # Keeps at most max_concurrency pieces in memory
+                file_hash.update(pending.popleft().result())
+        while pending:
+            file_hash.update(pending.popleft().result())
+    finally:
+        for future in pending:
+            future.cancel()
+        wait(pending) # Nothing can still be writing when the fd closes
+        os.close(fd)
+        if own_budget:
+            budget.shutdown()
+    return file_hash.hexdigest()
+
+def fetch_range(blob_client: BlobClient, offset: int, length: int, etag=None, budget: TransferBudget = None) -> bytes:
+    '''
+    One range of a blob, checked against the services transactional checksum when it is small enough to
+    get one and fetched again on its own if anything goes wrong. Pass the etag from the listing so a blob
+    changing between ranges fails instead of mixing versions.
+    '''
+    conditions = {'etag': etag, 'match_condition': MatchConditions.IfNotModified} if etag else {}
+    for attempt in range(RANGE_ATTEMPTS):
+        try:
+            with (budget.slot() if budget else nullcontext()), metrics.request('get_range'):
+                data = blob_client.download_blob(
+                    offset,
+                    length,
+                    validate_content=TRANSACTIONAL_CHECK if length <= DEFAULT_CHUNK_SIZE else False,
+                    **conditions
+                ).readall()
+            break
+        except AzureError as e:
+            if attempt + 1 >= RANGE_ATTEMPTS:
+                raise
+            metrics.inc('range_retries_total')
+            log.warning('Range %d-%d of %s failed, fetching again: %s',
+                        offset, offset + length, blob_client.blob_name, e)
+    metrics.inc('azure_bytes_total', len(data), direction='download')
+    return data
+
+def download_file(blob_client: BlobClient,
+                  destination_filename: str,
+                  size: int,
+                  etag=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE,
+                  max_concurrency=1,
+                  budget: TransferBudget = None
+                 ) -> str:
+    '''
+    Downloads the blob into a preallocated file by fetching ranges in parallel and writing each at its
+    offset. Ranges are checked against the services transactional checksum on the way in and a bad one is
+    fetched again on its own. The whole file md5 is worked out in order as ranges arrive, so the file is
+    never read back. Pass the etag from the listing so a blob changing mid-download fails instead of
+    mixing versions. Returns the md5.
+    '''
+    def fetch(piece):
+        return fetch_range(blob_client, piece[0], piece[1], etag, budget)
+
+    own_budget = budget is None
+    if own_budget:
+        budget = TransferBudget(max_concurrency)
+    try:
+        ranges = ((offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size))
+        return write_pieces(destination_filename, size, ranges, fetch, max_concurrency, budget)
+    finally:
+        if own_budget:
+            budget.shutdown()
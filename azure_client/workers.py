@@ -0,0 +1,130 @@
+'''Shared worker pool for the scripts, bounded queue with retry/backoff and clean Ctrl-C handling'''
+import queue
+import random
+import threading
+
+from azure.core.exceptions import HttpResponseError
+
+from .logger import log
+from .metrics import metrics, THROTTLED
+
+QUEUE_DEPTH = 1000 # Work queues stay bounded so listings can't run ahead of the workers
+
+def retry_after(exc: Exception) -> float:
+    '''Seconds the service asked us to wait in a Retry-After header, 0 if it didn't say.'''
+    response = getattr(exc, 'response', None)
+    try:
+        return float(response.headers.get('Retry-After', 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+class WorkerPool:
+    '''
+    Runs func over items on a fixed number of threads fed through a bounded queue. A failed item is retried
+    in the same worker after an exponential backoff with full jitter (stretched to any Retry-After the
+    service sent), and lands in dead_letters once it has used max_attempts. Ctrl-C stops feeding, drops what
+    is still queued and lets in-flight items finish, then run() raises KeyboardInterrupt again so a partial
+    run never looks finished to the caller; a second Ctrl-C leaves straight away.
+    '''
+    def __init__(self,
+                 func,
+                 workers=1,
+                 max_attempts=5,
+                 base_delay=1.0,
+                 max_delay=60.0,
+                 queue_depth=QUEUE_DEPTH,
+                 describe=str
+                ):
+        self.func = func
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.describe = describe
+        self.q = queue.Queue(maxsize=queue_depth)
+        self.dead_letters = [] # [(item, exception)]
+        self.dropped = 0 # Items still queued when Ctrl-C came
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def backoff(self, attempt: int, exc: Exception) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after(exc))
+
+    def _process(self, item) -> None:
+        for attempt in range(self.max_attempts):
+            try:
+                with metrics.span('item', item=self.describe(item), attempt=attempt):
+                    self.func(item)
+                metrics.inc('worker_items_total', result='done')
+                return
+            except Exception as e:
+                status = e.status_code if isinstance(e, HttpResponseError) else None
+                if attempt + 1 >= self.max_attempts or self.stopping.is_set():
+                    log.error('Giving up on %s after %d attempts.', self.describe(item), attempt + 1, exc_info=e)
+                    metrics.inc('worker_items_total', result='failed')
+                    with self._lock:
+                        self.dead_letters.append((item, e))
+                    return
+                delay = self.backoff(attempt, e)
+                metrics.inc('worker_retries_total', throttled=str(status in THROTTLED).lower())
+                if status in THROTTLED:
+                    log.warning('Throttled (%s) on %s, retrying in %.1fs', status, self.describe(item), delay)
+                else:
+                    log.error('Failed on %s, retrying in %.1fs', self.describe(item), delay, exc_info=e)
+                if self.stopping.wait(delay):
+                    metrics.inc('worker_items_total', result='failed')
+                    with self._lock:
+                        self.dead_letters.append((item, e))
+                    return
+
+    def _worker(self) -> None:
+        while True:
+            item = self.q.get()
+            try:
+                if self.stopping.is_set():
+                    with self._lock:
+                        self.dropped += 1
+                else:
+                    metrics.add('workers_busy', 1)
+                    try:
+                        self._process(item)
+                    finally:
+                        metrics.add('workers_busy', -1)
+            finally:
+                self.q.task_done() # Always, or join() hangs forever
+
+    def start(self) -> None:
+        metrics.gauge_callback('worker_queue_depth', self.q.qsize)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def run(self, items) -> list:
+        '''
+        Feeds items (any iterable, consumed lazily) to the workers and waits. Returns the dead letters, or
+        raises KeyboardInterrupt once in-flight items are done if it was interrupted.
+        '''
+        if not self._threads:
+            self.start()
+        interrupted = None
+        try:
+            for item in items:
+                self.q.put(item) # Blocks while full, that's the backpressure
+            self.q.join()
+        except KeyboardInterrupt as e:
+            log.warning('Interrupted, finishing in-flight items. Ctrl-C again to quit now.')
+            interrupted = e
+            self.stopping.set()
+            self.q.join() # Workers drop anything still queued once stopping is set
+        if self.dead_letters:
+            log.error('%d items failed for good:', len(self.dead_letters))
+            for item, e in self.dead_letters:
+                log.error('  %s: %s', self.describe(item), e)
+        if interrupted is not None:
+            log.error('Interrupted: %d queued items dropped and the rest never started, the run is incomplete.',
+                      self.dropped)
+            raise interrupted
+        return self.dead_letters
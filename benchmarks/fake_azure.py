@@ -0,0 +1,285 @@
+'''
+In-process stand in for the parts of BlobServiceClient/ContainerClient/BlobClient the scripts use, so the
+benchmarks can run without an account. Everything lives in memory and every request can be given a fixed
+latency (time.sleep, so it lets go of the GIL like a real socket wait would).
+'''
+from datetime import datetime, timezone
+import hashlib
+import itertools
+import threading
+import time
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError, HttpResponseError
+from azure.storage.blob import BlobProperties, ContentSettings
+
+LATENCY = 0.0 # Seconds added to every request
+PAGE_SIZE = 5000 # Same as the service
+
+_STORE = {} # {container: {name: _Blob}}
+_LOCK = threading.Lock()
+_ETAGS = itertools.count(1)
+_request_total = [0]
+
+def _request():
+    with _LOCK:
+        _request_total[0] += 1
+    if LATENCY:
+        time.sleep(LATENCY)
+
+def request_count() -> int:
+    return _request_total[0]
+
+def reset() -> None:
+    with _LOCK:
+        _STORE.clear()
+        _request_total[0] = 0
+
+class _Blob:
+    def __init__(self, name, data, metadata, tier, content_settings=None):
+        self.name = name
+        self.data = bytes(data)
+        self.metadata = dict(metadata or {})
+        self.tier = tier or 'Hot'
+        self.archive_status = None
+        self.content_settings = content_settings or ContentSettings()
+        self.etag = f'"0x{next(_ETAGS):x}"'
+        self.last_modified = datetime.now(timezone.utc)
+        self.uncommitted = {}
+        self.committed = True
+
+    def properties(self, container):
+        props = BlobProperties(name=self.name)
+        props.container = container
+        props.size = len(self.data)
+        props.metadata = dict(self.metadata)
+        props.blob_tier = self.tier
+        props.archive_status = self.archive_status
+        props.etag = self.etag
+        props.last_modified = self.last_modified
+        props.content_settings = self.content_settings
+        return props
+
+class _Pages:
+    '''Page iterator with the continuation_token of the next page, like the SDKs'''
+    def __init__(self, items, start):
+        self._items = items
+        self._next = start
+        self.continuation_token = str(start) if start else None
+
+    def __iter__(self):
+        if not self._items: # Even an empty listing is one request
+            _request()
+            yield iter(())
+        while self._next < len(self._items):
+            _request()
+            page = self._items[self._next:self._next + PAGE_SIZE]
+            self._next += PAGE_SIZE
+            self.continuation_token = str(self._next) if self._next < len(self._items) else None
+            yield iter(page)
+
+class _Pager:
+    '''Just enough of ItemPaged for iteration and by_page()'''
+    def __init__(self, items):
+        self._items = items
+
+    def by_page(self, continuation_token=None):
+        return _Pages(self._items, int(continuation_token or 0))
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+class _Downloader:
+    def __init__(self, data, properties):
+        self._data = data
+        self.properties = properties
+        self.size = len(data)
+
+    def readall(self):
+        return self._data
+
+    def chunks(self):
+        for i in range(0, len(self._data), 4 * 1024 * 1024):
+            yield self._data[i:i + 4 * 1024 * 1024]
+
+    def readinto(self, stream):
+        stream.write(self._data)
+        return len(self._data)
+
+    def download_to_stream(self, stream):
+        stream.write(self._data)
+        return self.properties
+
+class FakeBlobClient:
+    def __init__(self, container, blob_name):
+        self.container_name = container
+        self.blob_name = blob_name
+
+    def _blobs(self):
+        try:
+            return _STORE[self.container_name]
+        except KeyError:
+            raise ResourceNotFoundError('ContainerNotFound')
+
+    def _get(self, uncommitted=False):
+        blob = self._blobs().get(self.blob_name)
+        if blob is None or not (blob.committed or uncommitted):
+            raise ResourceNotFoundError('BlobNotFound')
+        return blob
+
+    def exists(self, **kwargs):
+        _request()
+        blob = _STORE.get(self.container_name, {}).get(self.blob_name)
+        return blob is not None and blob.committed
+
+    def get_blob_properties(self, **kwargs):
+        _request()
+        return self._get().properties(self.container_name)
+
+    def upload_blob(self, data, length=None, metadata=None, overwrite=False, standard_blob_tier=None,
+                    content_settings=None, **kwargs):
+        _request()
+        if hasattr(data, 'read'):
+            data = data.read()
+        blobs = self._blobs()
+        with _LOCK:
+            if self.blob_name in blobs and blobs[self.blob_name].committed and not overwrite:
+                raise ResourceExistsError('BlobAlreadyExists')
+            tier = standard_blob_tier.value if hasattr(standard_blob_tier, 'value') else standard_blob_tier
+            blobs[self.blob_name] = _Blob(self.blob_name, data, metadata, tier, content_settings)
+        return {'request_id': 'fake', 'etag': blobs[self.blob_name].etag}
+
+    def stage_block(self, block_id, data, length=None, **kwargs):
+        _request()
+        if hasattr(data, 'read'):
+            data = data.read()
+        blobs = self._blobs()
+        with _LOCK:
+            blob = blobs.get(self.blob_name)
+            if blob is None:
+                blob = blobs[self.blob_name] = _Blob(self.blob_name, b'', None, None)
+                blob.committed = False
+            blob.uncommitted[block_id] = bytes(data)
+        return {'request_id': 'fake'}
+
+    def get_block_list(self, block_list_type='committed', **kwargs):
+        _request()
+        blob = self._get(uncommitted=True)
+        blocks = [type('BlobBlock', (), {'id': k, 'size': len(v)})() for k, v in blob.uncommitted.items()]
+        return [], blocks
+
+    def commit_block_list(self, block_list, content_settings=None, metadata=None, standard_blob_tier=None,
+                          **kwargs):
+        _request()
+        blob = self._get(uncommitted=True)
+        with _LOCK:
+            data = b''.join(blob.uncommitted[b.id] for b in block_list)
+            tier = standard_blob_tier.value if hasattr(standard_blob_tier, 'value') else standard_blob_tier
+            self._blobs()[self.blob_name] = _Blob(self.blob_name, data, metadata, tier, content_settings)
+        return {'request_id': 'fake', 'etag': self._blobs()[self.blob_name].etag}
+
+    def delete_blob(self, **kwargs):
+        _request()
+        with _LOCK:
+            if self._blobs().pop(self.blob_name, None) is None:
+                raise ResourceNotFoundError('BlobNotFound')
+
+    def download_blob(self, offset=None, length=None, etag=None, match_condition=None, **kwargs):
+        _request()
+        blob = self._get()
+        if blob.tier == 'Archive':
+            raise HttpResponseError('BlobArchived')
+        if etag is not None and etag != blob.etag:
+            raise HttpResponseError('ConditionNotMet')
+        start = offset or 0
+        end = len(blob.data) if length is None else start + length
+        return _Downloader(blob.data[start:end], blob.properties(self.container_name))
+
+    def set_standard_blob_tier(self, tier, rehydrate_priority=None, **kwargs):
+        _request()
+        self._set_tier(tier)
+
+    def _set_tier(self, tier):
+        blob = self._get()
+        tier = tier.value if hasattr(tier, 'value') else tier
+        if blob.archive_status:
+            error = HttpResponseError('BlobBeingRehydrated')
+            error.error_code = 'BlobBeingRehydrated'
+            raise error
+        if blob.tier == 'Archive' and tier != 'Archive':
+            blob.archive_status = f'rehydrate-pending-to-{tier.lower()}'
+        else:
+            blob.tier = tier
+
+class FakeContainerClient:
+    def __init__(self, container):
+        self.container_name = container
+
+    def exists(self, **kwargs):
+        _request()
+        return self.container_name in _STORE
+
+    def get_container_properties(self, **kwargs):
+        _request()
+        if self.container_name not in _STORE:
+            raise ResourceNotFoundError('ContainerNotFound')
+        return {'name': self.container_name}
+
+    def create_container(self, **kwargs):
+        _request()
+        with _LOCK:
+            if self.container_name in _STORE:
+                raise ResourceExistsError('ContainerAlreadyExists')
+            _STORE[self.container_name] = {}
+        return {'request_id': 'fake', 'error_code': None}
+
+    def set_standard_blob_tier_blobs(self, standard_blob_tier, *blobs, rehydrate_priority=None, **kwargs):
+        '''One request for the whole batch, one response per blob like the real multipart reply'''
+        _request()
+        responses = []
+        for blob in blobs:
+            status, error_code = 202, None
+            try:
+                self.get_blob_client(blob)._set_tier(standard_blob_tier)
+            except ResourceNotFoundError:
+                status, error_code = 404, 'BlobNotFound'
+            except HttpResponseError as e:
+                status, error_code = 409, e.error_code
+            responses.append(type('HttpResponse', (), {
+                'status_code': status,
+                'headers': {'x-ms-error-code': error_code} if error_code else {}
+            })())
+        return iter(responses)
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self.container_name, getattr(blob, 'name', blob))
+
+    def list_blobs(self, name_starts_with=None, include=None, **kwargs):
+        blobs = _STORE.get(self.container_name, {})
+        names = sorted(x for x in list(blobs) if not name_starts_with or x.startswith(name_starts_with))
+        return _Pager([blobs[x].properties(self.container_name) for x in names if blobs[x].committed])
+
+    def upload_blob(self, name, data, **kwargs):
+        return self.get_blob_client(name).upload_blob(data, **kwargs)
+
+class FakeBlobServiceClient:
+    def __init__(self, account_url=None, credential=None, **kwargs):
+        self.url = account_url
+
+    def list_containers(self, **kwargs):
+        return _Pager([{'name': x} for x in sorted(_STORE)])
+
+    def get_container_client(self, container):
+        return FakeContainerClient(container)
+
+    def create_container(self, container, **kwargs):
+        client = FakeContainerClient(container)
+        client.create_container()
+        return client
+
+def seed(container: str, blobs: dict, tier='Hot') -> None:
+    '''Drops {name: bytes} straight into the store with md5 metadata, no requests counted.'''
+    with _LOCK:
+        store = _STORE.setdefault(container, {})
+        for name, data in blobs.items():
+            store[name] = _Blob(name, data, {'md5': hashlib.md5(data).hexdigest()}, tier)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+'''
+Throughput benchmarks for the folder/container scripts. Builds synthetic trees (lots of small files, a few
+huge ones, deep nesting), runs upload_folder_to_azure.py, download_container_from_azure.py and
+rehydrate_container.py against them at each --workers value and prints one JSON line per run with
+files/s, MB/s, p50/p99 per-file latency, peak RSS and CPU seconds per GiB of file data.
+
+By default every run uses the in-process fake in fake_azure.py (with --latency-ms per request standing in
+for the network). --backend azurite points the real SDK at an Azurite emulator instead, started here if
+azurite-blob is on the PATH, otherwise pass --azurite-url for one that is already running.
+
+--compare-transport runs everything twice, once on the SDK's default transport (--pool-size 0) and once on
+the pooled one, to show what sizing the connection pool to the workers is worth, e.g.
+    run_benchmarks.py --backend azurite --workers 32 64 128 --compare-transport
+The fake never opens a connection, so this only means something against Azurite or a real account.
+'''
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = {
+    'upload': 'upload_folder_to_azure.py',
+    'download': 'download_container_from_azure.py',
+    'rehydrate': 'rehydrate_container.py',
+}
+# The well known Azurite development account, not a secret.
+AZURITE_ACCOUNT = 'devstoreaccount1'
+AZURITE_KEY = 'Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=='
+CONTAINER = 'benchmark'
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def make_tree(root: str, scenario: str, args) -> str:
+    '''Builds (or reuses) the synthetic tree for a scenario, returns its path.'''
+    path = os.path.join(root, scenario)
+    if os.path.isdir(path):
+        return path
+    rng = random.Random(scenario)
+    if scenario == 'small':
+        for i in range(args.small_count):
+            folder = os.path.join(path, f'dir{i % 50:02d}')
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, f'file{i:07d}.bin'), 'wb') as fp:
+                fp.write(rng.randbytes(rng.randint(1024, 16 * 1024)))
+    elif scenario == 'huge':
+        os.makedirs(path)
+        for i in range(args.huge_count):
+            with open(os.path.join(path, f'image{i}.img'), 'wb') as fp:
+                for _ in range(args.huge_mb):
+                    fp.write(rng.randbytes(1024 * 1024))
+    elif scenario == 'deep':
+        folder = path
+        for depth in range(args.deep_depth):
+            folder = os.path.join(folder, f'level{depth:03d}')
+            os.makedirs(folder)
+            for i in range(args.deep_files):
+                with open(os.path.join(folder, f'f{i}.txt'), 'wb') as fp:
+                    fp.write(rng.randbytes(rng.randint(100, 4096)))
+    else:
+        raise ValueError(f'Unknown scenario {scenario}')
+    return path
+
+def tree_files(tree: str) -> dict:
+    '''{azure name: local path} using the same naming the upload script does without --strip-base-folder'''
+    base = os.path.dirname(os.path.abspath(tree))
+    files = {}
+    for folder, _, names in os.walk(tree):
+        for name in names:
+            path = os.path.join(folder, name)
+            files[os.path.relpath(path, base)] = path
+    return files
+
+def child(args) -> None:
+    '''Runs one script in this process with timers around the per-file functions, writes a JSON result.'''
+    sys.path.insert(0, REPO)
+    from azure_client import azure_client
+    from azure.storage.blob import StandardBlobTier
+
+    if args.backend == 'fake':
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import fake_azure
+        fake_azure.LATENCY = args.latency_ms / 1000
+        azure_client.BlobServiceClient = fake_azure.FakeBlobServiceClient
+        os.environ['AZURE_URL'], os.environ['AZURE_KEY'] = 'https://fake.blob.core.windows.net', 'fake'
+    else:
+        os.environ['AZURE_URL'], os.environ['AZURE_KEY'] = args.azurite_url, AZURITE_KEY
+
+    files = tree_files(args.tree)
+    total_bytes = sum(os.path.getsize(x) for x in files.values())
+
+    if args.script != 'upload': # Download and rehydrate need the container filled first, untimed
+        tier = 'Archive' if args.script == 'rehydrate' else 'Hot'
+        if args.backend == 'fake':
+            fake_azure.reset()
+            fake_azure.seed(CONTAINER, {k: open(v, 'rb').read() for k, v in files.items()}, tier)
+        else:
+            service = azure_client.connect_service(os.environ['AZURE_URL'], AZURITE_KEY)
+            container = azure_client.connect_container(service, CONTAINER)
+            for name, path in files.items():
+                azure_client.upload_blob(container, path, name, StandardBlobTier(tier), overwrite=True)
+
+    latencies = []
+    def timed(func):
+        def wrapper(*a, **kw):
+            start = time.perf_counter()
+            try:
+                return func(*a, **kw)
+            finally:
+                latencies.append(time.perf_counter() - start)
+        return wrapper
+    for name in ('upload_blob', 'download_blob', 'set_blob_tier'):
+        setattr(azure_client, name, timed(getattr(azure_client, name)))
+
+    work = tempfile.mkdtemp(prefix='bench-')
+    script_args = {
+        'upload': ['-c', CONTAINER, '-f', args.tree, '-t', 'Hot', '-m', os.path.join(work, 'md5sums')],
+        'download': ['-c', CONTAINER, '-d', os.path.join(work, 'restore')],
+        'rehydrate': ['-c', CONTAINER, '-t', 'Cool'],
+    }[args.script]
+    sys.argv = [SCRIPTS[args.script]] + script_args + ['-w', str(args.workers)] + args.extra.split()
+    os.chdir(REPO)
+
+    start = time.perf_counter()
+    cpu_start = sum(resource.getrusage(resource.RUSAGE_SELF)[:2]) # Leaves out imports and seeding the fake
+    exit_code = 0
+    try:
+        runpy.run_path(os.path.join(REPO, SCRIPTS[args.script]), run_name='__main__')
+    except SystemExit as e:
+        exit_code = e.code or 0
+    seconds = time.perf_counter() - start
+    cpu_s = sum(resource.getrusage(resource.RUSAGE_SELF)[:2]) - cpu_start
+    shutil.rmtree(work, ignore_errors=True)
+
+    moved = 0 if args.script == 'rehydrate' else total_bytes
+    result = {
+        'script': args.script,
+        'scenario': os.path.basename(args.tree),
+        'backend': args.backend,
+        'workers': args.workers,
+        'extra': args.extra,
+        'files': len(files),
+        'bytes': moved,
+        'seconds': round(seconds, 4),
+        'files_per_s': round(len(files) / seconds, 2),
+        'mb_per_s': round(moved / seconds / 1024 ** 2, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'cpu_s': round(cpu_s, 3),
+        'cpu_s_per_gb': round(cpu_s / (total_bytes / 1024 ** 3), 3) if total_bytes else None,
+        'exit_code': exit_code,
+    }
+    if args.backend == 'fake':
+        result['requests'] = fake_azure.request_count()
+    with open(args.result_file, 'w') as fp:
+        json.dump(result, fp)
+
+def start_azurite(args):
+    if args.azurite_url:
+        return None
+    binary = shutil.which('azurite-blob')
+    if binary is None:
+        sys.exit('azurite-blob is not on the PATH, install it (npm i -g azurite) or pass --azurite-url')
+    proc = subprocess.Popen(
+        [binary, '--inMemoryPersistence', '--silent', '--blobPort', '10000', '--skipApiVersionCheck'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    args.azurite_url = f'http://127.0.0.1:10000/{AZURITE_ACCOUNT}'
+    time.sleep(2) # Give it a moment to bind
+    return proc
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the transfer scripts')
+    parser.add_argument('--scripts', nargs='+', default=list(SCRIPTS), choices=list(SCRIPTS))
+    parser.add_argument('--scenarios', nargs='+', default=['small', 'huge', 'deep'])
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--backend', choices=['fake', 'azurite'], default='fake')
+    parser.add_argument('--azurite-url', help='Use an Azurite that is already running')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Per request latency of the fake')
+    parser.add_argument('--extra', default='', help='Extra arguments passed through to every script')
+    parser.add_argument('--compare-transport', action='store_true',
+                        help='Run each case on the default and on the pooled transport')
+    parser.add_argument('--small-count', type=int, default=2000)
+    parser.add_argument('--huge-count', type=int, default=2)
+    parser.add_argument('--huge-mb', type=int, default=256)
+    parser.add_argument('--deep-depth', type=int, default=100)
+    parser.add_argument('--deep-files', type=int, default=5)
+    parser.add_argument('--data-dir', help='Where to build (and keep) the synthetic trees, temp dir if unset')
+    parser.add_argument('--output', '-o', help='Append JSON lines here as well as printing them')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--script', help=argparse.SUPPRESS)
+    parser.add_argument('--tree', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.workers = args.workers[0]
+        child(args)
+        return
+
+    if args.compare_transport and args.backend == 'fake':
+        print('--compare-transport does nothing useful against the fake, use --backend azurite', file=sys.stderr)
+    transports = [('default', '--pool-size 0'), ('pooled', '')] if args.compare_transport else [(None, '')]
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bench-data-')
+    azurite = start_azurite(args) if args.backend == 'azurite' else None
+    try:
+        for scenario in args.scenarios:
+            tree = make_tree(data_dir, scenario, args)
+            for script in args.scripts:
+                for workers, (transport, transport_args) in itertools.product(args.workers, transports):
+                    result_file = os.path.join(data_dir, 'result.json')
+                    command = [
+                        sys.executable, os.path.abspath(__file__), '--child',
+                        '--script', script,
+                        '--tree', tree,
+                        '--workers', str(workers),
+                        '--backend', args.backend,
+                        '--latency-ms', str(args.latency_ms),
+                        '--result-file', result_file,
+                        '--extra=' + ' '.join(x for x in (args.extra, transport_args) if x),
+                    ]
+                    if args.azurite_url:
+                        command += ['--azurite-url', args.azurite_url]
+                    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+                    with open(result_file) as fp:
+                        result = json.load(fp)
+                    if transport:
+                        result['transport'] = transport
+                    line = json.dumps(result)
+                    print(line, flush=True)
+                    if args.output:
+                        with open(args.output, 'a') as fp:
+                            fp.write(line + '\n')
+    finally:
+        if azurite is not None:
+            azurite.terminate()
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,11 @@
 import argparse
 import os
 
-from azure.storage.blob import StandardBlobTier
 from dotenv import load_dotenv, find_dotenv
 
-from azure_client import azure_client
-from azure_client.logger import log, formatter
+from azure_client import azure_client, limiter, metrics, pack
+from azure_client.dedup import ChunkStore
+from azure_client.logger import log
 
 load_dotenv(find_dotenv())
 AZURE_URL, AZURE_KEY = os.getenv("AZURE_URL"), os.getenv("AZURE_KEY")
@@ -17,21 +17,49 @@ PARSER.add_argument('--container', '-c', required=True)
 PARSER.add_argument('--filename', '-f', required=True)
 PARSER.add_argument('--destination', '-d', required=True)
 PARSER.add_argument('--overwrite', '-o', action='store_false')
+PARSER.add_argument('--chunk-size', default=4, type=int,
+                    help='Range size in MiB, ranges up to 4 get a checksum checked per request')
+PARSER.add_argument('--max-concurrency', default=4, type=int, help='Ranges of one blob downloading at once')
+azure_client.add_connection_arguments(PARSER)
+metrics.add_metrics_arguments(PARSER)
+limiter.add_limit_arguments(PARSER)
 ARGS = PARSER.parse_args()
+metrics.start_from_args(ARGS)
+LIMITER = limiter.from_args(ARGS)
 
-SERVICE = azure_client.connect_service(AZURE_URL, AZURE_KEY)
+SERVICE = azure_client.connect_service(
+    AZURE_URL, AZURE_KEY, limiter=LIMITER, **azure_client.connection_settings(ARGS, ARGS.max_concurrency)
+)
+CHUNKS = ChunkStore(SERVICE) # Rebuilds dedup manifests, their chunk container is in each manifest
 CONTAINER = azure_client.connect_container(SERVICE, ARGS.container)
 
-BLOB_FILENAMES = azure_client.get_blob_manifest(CONTAINER)
+BLOB = CONTAINER.get_blob_client(ARGS.filename)
 
-if ARGS.filename in BLOB_FILENAMES:
-    BLOB = CONTAINER.get_blob_client(ARGS.filename)
+if BLOB.exists():
     BLOB_INFO = BLOB.get_blob_properties()
-    if BLOB_INFO.blob_tier not in ['Hot', 'Cool']:
-        log.error(f'{ARGS.filename} is not a tier that can be downloaded. Currently {BLOB_INFO.blob_tier}')
+    if BLOB_INFO.blob_tier not in azure_client.ONLINE_TIERS:
+        log.error('%s is not a tier that can be downloaded. Currently %s', ARGS.filename, BLOB_INFO.blob_tier)
         exit(2)
-    azure_client.download_blob(BLOB, BLOB_INFO, ARGS.destination, ARGS.overwrite)
+    azure_client.download_blob(
+        BLOB,
+        BLOB_INFO,
+        ARGS.destination,
+        ARGS.overwrite,
+        chunk_size=ARGS.chunk_size * 1024 * 1024,
+        max_concurrency=ARGS.max_concurrency,
+        chunks=CHUNKS
+    )
 else:
-    log.error(f'{ARGS.filename} was not found in container {ARGS.container}.')
-    exit(1)
+    PACK_INDEX = pack.load_index(CONTAINER, [ARGS.filename])
+    if ARGS.filename not in PACK_INDEX:
+        log.error('%s was not found in container %s.', ARGS.filename, ARGS.container)
+        exit(1)
+    PACKED = PACK_INDEX[ARGS.filename]
+    PACK_INFO = CONTAINER.get_blob_client(PACKED.pack).get_blob_properties()
+    if PACK_INFO.blob_tier not in azure_client.ONLINE_TIERS:
+        log.error('%s is packed in %s, which is %s. Rehydrate it first.',
+                  ARGS.filename, PACKED.pack, PACK_INFO.blob_tier)
+        exit(2)
+    if pack.extract_pack(CONTAINER, PACKED.pack, [PACKED], ARGS.destination, ARGS.overwrite):
+        exit(1)
 # TODO: this may not work with absoulte filepaths correctly!
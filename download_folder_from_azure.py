@@ -1,15 +1,16 @@
 #!/usr/bin/env python3
 '''Simple command line tool to download a single file from a container'''
 import argparse
+import asyncio
 import os
-import threading
-import queue
 
-from azure.storage.blob import StandardBlobTier
 from dotenv import load_dotenv, find_dotenv
 
-from azure_client import azure_client
-from azure_client.logger import log, formatter
+from azure_client import azure_client, limiter, manifest, metrics, pack, progress
+from azure_client.dedup import ChunkStore
+from azure_client.logger import log
+from azure_client.transfer import TransferBudget
+from azure_client.workers import WorkerPool
 
 load_dotenv(find_dotenv())
 AZURE_URL, AZURE_KEY = os.getenv("AZURE_URL"), os.getenv("AZURE_KEY")
@@ -20,38 +21,107 @@ PARSER.add_argument('--folder', '-f', required=True)
 PARSER.add_argument('--destination', '-d', required=True)
 PARSER.add_argument('--overwrite', '-o', action='store_false')
 PARSER.add_argument('--workers', '-w', default=1, type=int)
+PARSER.add_argument('--max-attempts', default=5, type=int, help='Tries per blob before giving up on it')
+PARSER.add_argument('--async', dest='use_async', action='store_true',
+                    help='Use the asyncio engine, best for lots of small files')
+PARSER.add_argument('--concurrency', default=256, type=int, help='Requests in flight with --async')
+PARSER.add_argument('--chunk-size', default=4, type=int,
+                    help='Range size in MiB, ranges up to 4 get a checksum checked per request')
+PARSER.add_argument('--max-concurrency', default=4, type=int, help='Ranges of one blob downloading at once')
+PARSER.add_argument('--connections', type=int,
+                    help='Requests in flight across all workers, defaults to the larger of workers/max-concurrency')
+azure_client.add_connection_arguments(PARSER)
+metrics.add_metrics_arguments(PARSER)
+limiter.add_limit_arguments(PARSER)
+progress.add_progress_arguments(PARSER)
 ARGS = PARSER.parse_args()
+metrics.start_from_args(ARGS)
+LIMITER = limiter.from_args(ARGS)
 
-SERVICE = azure_client.connect_service(AZURE_URL, AZURE_KEY)
+BUDGET = TransferBudget(ARGS.connections or max(ARGS.workers, ARGS.max_concurrency))
+
+SERVICE = azure_client.connect_service(
+    AZURE_URL, AZURE_KEY, limiter=LIMITER, **azure_client.connection_settings(ARGS, BUDGET.max_connections)
+)
+CHUNKS = ChunkStore(SERVICE) # Rebuilds dedup manifests, their chunk container is in each manifest
 CONTAINER = azure_client.connect_container(SERVICE, ARGS.container)
 
-BLOB_FILENAMES = azure_client.get_blob_manifest(CONTAINER)
-BLOB_FILENAMES_FILTERED = [x for x in BLOB_FILENAMES if x.startswith(ARGS.folder)]
-
-q = queue.Queue()
-
-def worker():
-    while True:
-        try:
-            file = q.get()
-            BLOB = CONTAINER.get_blob_client(file)
-            BLOB_INFO = BLOB.get_blob_properties()
-            if BLOB_INFO.blob_tier not in ['Hot', 'Cool']:
-                log.error(f'{ARGS.filename} is not a tier that can be downloaded. Currently {BLOB_INFO.blob_tier}')
-                q.task_done()
-            else:
-                azure_client.download_blob(BLOB, BLOB_INFO, ARGS.destination, ARGS.overwrite)
-                q.task_done()
-        except Exception as e:
-            log.error('File: %s', file)
-            log.error('Exception!', exc_info=e)
-            q.task_done()
-            continue
-
-for _ in range(ARGS.workers):
-    threading.Thread(target=worker, daemon=True).start()
-
-for file in BLOB_FILENAMES_FILTERED:
-    q.put(file)
-
-q.join()
+BLOBS = azure_client.iter_blobs(CONTAINER, name_starts_with=ARGS.folder, include=['metadata'])
+BLOBS = pack.expand_packs(BLOBS, CONTAINER, ARGS.folder)
+PROGRESS = progress.from_args(ARGS)
+# Only what can be downloaded counts
+ONLINE_SIZE = lambda x: manifest.stored_size(x) if x.blob_tier in azure_client.ONLINE_TIERS else None
+if PROGRESS is not None:
+    BLOBS = PROGRESS.planned(BLOBS, ONLINE_SIZE)
+PACK_FAILURES = [] # Packed files that failed their md5 check
+
+def download(BLOB_INFO):
+    file = BLOB_INFO.name
+    if BLOB_INFO.blob_tier not in azure_client.ONLINE_TIERS:
+        log.error('%s is not a tier that can be downloaded. Currently %s', file, BLOB_INFO.blob_tier)
+        return
+    if isinstance(BLOB_INFO, pack.PackSlice):
+        PACK_FAILURES.extend(pack.extract_pack(
+            CONTAINER,
+            file,
+            BLOB_INFO.members,
+            ARGS.destination,
+            ARGS.overwrite,
+            chunk_size=ARGS.chunk_size * 1024 * 1024,
+            budget=BUDGET
+        ))
+        return
+    BLOB = CONTAINER.get_blob_client(file)
+    azure_client.download_blob(
+        BLOB,
+        BLOB_INFO,
+        ARGS.destination,
+        ARGS.overwrite,
+        chunk_size=ARGS.chunk_size * 1024 * 1024,
+        max_concurrency=ARGS.max_concurrency,
+        budget=BUDGET,
+        chunks=CHUNKS
+    )
+
+async def download_async():
+    from azure_client import aio_client
+    if LIMITER is not None:
+        log.warning('Bandwidth and request limits only apply to the threaded engine, --async runs unlimited.')
+    service = aio_client.connect_service(
+        AZURE_URL, AZURE_KEY, **azure_client.connection_settings(ARGS, ARGS.concurrency)
+    )
+    container = service.get_container_client(ARGS.container)
+    BLOB_LIST = container.list_blobs(name_starts_with=ARGS.folder, include=['metadata'])
+
+    async def download(BLOB_INFO):
+        if BLOB_INFO.blob_tier not in azure_client.ONLINE_TIERS:
+            log.error('%s is not a tier that can be downloaded. Currently %s', BLOB_INFO.name, BLOB_INFO.blob_tier)
+            return
+        if pack.is_pack_blob(BLOB_INFO.name):
+            log.warning('%s holds packed files, download without --async to extract them.', BLOB_INFO.name)
+            return
+        BLOB = container.get_blob_client(BLOB_INFO.name)
+        await aio_client.download_blob(BLOB, BLOB_INFO, ARGS.destination, ARGS.overwrite)
+
+    try:
+        return await aio_client.run_pool(
+            download,
+            BLOB_LIST if PROGRESS is None else PROGRESS.planned_async(BLOB_LIST, ONLINE_SIZE),
+            ARGS.concurrency,
+            ARGS.max_attempts,
+            describe=lambda x: x.name
+        )
+    finally:
+        await aio_client.close_service(service)
+
+if ARGS.use_async:
+    DEAD_LETTERS = asyncio.run(download_async())
+else:
+    POOL = WorkerPool(download, ARGS.workers, ARGS.max_attempts, describe=lambda x: x.name)
+    DEAD_LETTERS = POOL.run(BLOBS)
+if PROGRESS is not None:
+    PROGRESS.stop()
+for entry in PACK_FAILURES:
+    log.error('%s from %s failed its md5 check.', entry.name, entry.pack)
+if DEAD_LETTERS or PACK_FAILURES:
+    exit(1)
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 '''Command line tool to list container and files within'''
+import argparse
+import itertools
 import os
-import sys
-import textwrap
 
 from dotenv import load_dotenv, find_dotenv
 import prettytable
 
-from azure_client import azure_client
+from azure_client import azure_client, blob_index, pack
 
 def human_readable(num, suffix='B'):
     for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
@@ -16,28 +16,69 @@ def human_readable(num, suffix='B'):
         num /= 1024.0
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
-if len(sys.argv) != 2:
-    print(f'Usage: {__file__} container_name\n\nWill list all files in container "container_name" with tier and size')
-    exit(1)
+COLUMNS = [79, 7, 9] # Widths of filename (cut to 79 below), tier and human_readable size
+RULE = '+' + '+'.join('-' * (x + 2) for x in COLUMNS) + '+'
+
+def table_row(*values):
+    '''One row laid out like prettytable, so the listing can be printed as it streams.'''
+    return '| ' + ' | '.join(str(v).ljust(w) for v, w in zip(values, COLUMNS)) + ' |'
+
+PARSER = argparse.ArgumentParser(description='List all files in a container with tier and size')
+PARSER.add_argument('container')
+PARSER.add_argument('--prefix', '-p', help='Only blobs whose names start with this')
+PARSER.add_argument('--tier', '-t', help='Only blobs in this tier')
+PARSER.add_argument('--summary', choices=['tier', 'prefix'],
+                    help='Count and size per tier, or per folder one level below --prefix, instead of every file')
+PARSER.add_argument('--refresh', action='store_true', help='List the container again even if --index is fresh')
+blob_index.add_index_arguments(PARSER)
+ARGS = PARSER.parse_args()
 
 load_dotenv(find_dotenv())
 
 AZURE_URL, AZURE_KEY = os.getenv("AZURE_URL"), os.getenv("AZURE_KEY")
-SERVICE = azure_client.connect_service(AZURE_URL, AZURE_KEY)
-CONTAINER = azure_client.connect_container(SERVICE, sys.argv[1], create=False)
-BLOB_INFO = azure_client.get_blob_list_information(CONTAINER)
-
-TABLE = prettytable.PrettyTable()
-TABLE.field_names = ['Filename', 'Tier', 'Size']
-TABLE.align = 'l'
+SERVICE = azure_client.connect_service(AZURE_URL, AZURE_KEY, **azure_client.connection_settings())
+CONTAINER = azure_client.connect_container(SERVICE, ARGS.container, create=False)
 
-total_size = 0
+# Without --index this is a throwaway index of one live listing, of just the prefix when there is one
+INDEX = blob_index.BlobIndex(ARGS.index or ':memory:', ARGS.container)
+if not ARGS.index:
+    INDEX.refresh(CONTAINER, ARGS.prefix)
+elif ARGS.refresh:
+    INDEX.refresh(CONTAINER)
+else:
+    INDEX.ensure_fresh(CONTAINER, ARGS.index_max_age * 3600)
 
-for fn, bt, sz in BLOB_INFO:
-    total_size += sz
-    fn = '.../' + fn[-75:] if len(fn) > 75 else fn
-    TABLE.add_row([fn, bt, human_readable(sz)])
+total_count = total_size = 0
 
-TABLE.add_row(['TOTALS', 'NA', human_readable(total_size)])
+if ARGS.summary:
+    TABLE = prettytable.PrettyTable()
+    TABLE.align = 'l'
+    # Packs count as the blobs they are stored as, that is what each tier is billed for
+    TABLE.field_names = ['Tier' if ARGS.summary == 'tier' else 'Prefix', 'Blobs', 'Size']
+    for key, count, size in INDEX.summary(ARGS.prefix, ARGS.summary):
+        if ARGS.tier and ARGS.summary == 'tier' and key != ARGS.tier:
+            continue
+        total_count += count
+        total_size += size
+        TABLE.add_row([key, count, human_readable(size)])
+    TABLE.add_row(['TOTALS', total_count, human_readable(total_size)])
+    print(TABLE)
+else:
+    if not ARGS.index and not pack.PACK_PREFIX.startswith(ARGS.prefix or ''):
+        INDEX.refresh(CONTAINER, pack.PACK_PREFIX) # The pack index, and the packs hold the tiers of their files
+    # Files in packs are listed on their own with the tier of their pack, the packs themselves aren't
+    BLOB_INFO = itertools.chain(
+        (x[:3] for x in INDEX.query(ARGS.prefix, ARGS.tier) if not pack.is_pack_blob(x[0])),
+        INDEX.query_packed(ARGS.prefix, ARGS.tier)
+    )
 
-print(TABLE)
+    # Rows are printed as they come out of the index, a table of millions of files is never held whole
+    print(RULE)
+    print(table_row('Filename', 'Tier', 'Size'))
+    print(RULE)
+    for fn, bt, sz in BLOB_INFO:
+        total_size += sz
+        fn = '.../' + fn[-75:] if len(fn) > 75 else fn
+        print(table_row(fn, bt, human_readable(sz)))
+    print(table_row('TOTALS', 'NA', human_readable(total_size)))
+    print(RULE)
@@ -1,62 +1,128 @@
 #!/usr/bin/env python3
 '''Command line tool to rehydrate or dehydrate an entire container'''
 import argparse
+import asyncio
+from collections import Counter
 import os
 import threading
-import queue
 
+from azure.core.exceptions import HttpResponseError
 from azure.storage.blob import StandardBlobTier, RehydratePriority
 from dotenv import load_dotenv, find_dotenv
 import prettytable
 
-from azure_client import azure_client
+from azure_client import azure_client, limiter, metrics
 from azure_client.logger import log, formatter
+from azure_client.workers import WorkerPool
 
 PARSER = argparse.ArgumentParser(description='Rehydrate/dehydrate an archive blob')
 PARSER.add_argument('--container', '-c', required=True)
 PARSER.add_argument('--tier', '-t', default='Cool')
 PARSER.add_argument('--priority', '-p', default='Standard')
 PARSER.add_argument('--workers', '-w', default=1, type=int)
+PARSER.add_argument('--max-attempts', default=5, type=int, help='Tries per blob before giving up on it')
+PARSER.add_argument('--batch', action='store_true',
+                    help='Change tiers with blob batch requests, up to --batch-size blobs per request')
+PARSER.add_argument('--batch-size', default=azure_client.BATCH_SIZE, type=int)
+PARSER.add_argument('--async', dest='use_async', action='store_true',
+                    help='Use the asyncio engine, best for lots of small files')
+PARSER.add_argument('--concurrency', default=256, type=int, help='Requests in flight with --async')
+azure_client.add_connection_arguments(PARSER)
+metrics.add_metrics_arguments(PARSER)
+limiter.add_limit_arguments(PARSER)
 ARGS = PARSER.parse_args()
+metrics.start_from_args(ARGS)
+LIMITER = limiter.from_args(ARGS)
 
 load_dotenv(find_dotenv())
 
 AZURE_URL, AZURE_KEY = os.getenv("AZURE_URL"), os.getenv("AZURE_KEY")
-SERVICE = azure_client.connect_service(AZURE_URL, AZURE_KEY)
+SERVICE = azure_client.connect_service(
+    AZURE_URL, AZURE_KEY, limiter=LIMITER, **azure_client.connection_settings(ARGS, ARGS.workers)
+)
 CONTAINER = azure_client.connect_container(SERVICE, ARGS.container, create=False)
-BLOB_FILENAMES = azure_client.get_blob_manifest(CONTAINER)
+BLOBS = azure_client.iter_blobs(CONTAINER)
 
-q = queue.Queue()
-
-def worker():
-    while True:
+def rehydrate(BLOB_INFO):
+    file = BLOB_INFO.name
+    if BLOB_INFO.blob_tier == ARGS.tier:
+        log.info('File %s is already at tier %s', file, ARGS.tier)
+    elif BLOB_INFO.archive_status == f'rehydrate-pending-to-{ARGS.tier.lower()}':
+        log.info('File %s is already pending rehydration to %s', file, ARGS.tier)
+    else:
+        BLOB = CONTAINER.get_blob_client(file)
         try:
-            file = q.get()
-            BLOB = CONTAINER.get_blob_client(file)
-            BLOB_INFO = BLOB.get_blob_properties()
-            if BLOB_INFO.blob_tier == ARGS.tier:
-                log.info(f'File {file} is already at tier {ARGS.tier}')
-                q.task_done()
-            elif BLOB_INFO.archive_status == f'rehydrate-pending-to-{ARGS.tier.lower()}':
-                log.info(f'File {file} is already pending rehydration to {ARGS.tier}')
-                q.task_done()
+            azure_client.set_blob_tier(BLOB, StandardBlobTier(ARGS.tier), RehydratePriority(ARGS.priority))
+        except HttpResponseError as e:
+            if e.error_code != 'BlobBeingRehydrated':
+                raise
+            log.info('File %s is already in the middle of rehydration', file)
+
+async def rehydrate_async():
+    from azure_client import aio_client
+    if LIMITER is not None:
+        log.warning('Bandwidth and request limits only apply to the threaded engine, --async runs unlimited.')
+    service = aio_client.connect_service(
+        AZURE_URL, AZURE_KEY, **azure_client.connection_settings(ARGS, ARGS.concurrency)
+    )
+    container = service.get_container_client(ARGS.container)
+
+    async def rehydrate(BLOB_INFO):
+        file = BLOB_INFO.name
+        if BLOB_INFO.blob_tier == ARGS.tier:
+            log.info('File %s is already at tier %s', file, ARGS.tier)
+        elif BLOB_INFO.archive_status == f'rehydrate-pending-to-{ARGS.tier.lower()}':
+            log.info('File %s is already pending rehydration to %s', file, ARGS.tier)
+        else:
+            BLOB = container.get_blob_client(file)
+            try:
+                await aio_client.set_blob_tier(BLOB, StandardBlobTier(ARGS.tier), RehydratePriority(ARGS.priority))
+            except HttpResponseError as e:
+                if e.error_code != 'BlobBeingRehydrated':
+                    raise
+                log.info('File %s is already in the middle of rehydration', file)
+
+    try:
+        return await aio_client.run_pool(
+            rehydrate,
+            container.list_blobs(),
+            ARGS.concurrency,
+            ARGS.max_attempts,
+            describe=lambda x: x.name
+        )
+    finally:
+        await aio_client.close_service(service)
+
+def rehydrate_batches():
+    TIER = StandardBlobTier(ARGS.tier)
+    COUNTS = Counter()
+    LOCK = threading.Lock()
+
+    def needs_change():
+        for BLOB_INFO in BLOBS:
+            state = azure_client.classify_tier_change(BLOB_INFO, TIER)
+            if state is None:
+                yield BLOB_INFO.name
             else:
-                azure_client.set_blob_tier(BLOB, StandardBlobTier(ARGS.tier), RehydratePriority(ARGS.priority))
-                q.task_done()
-        except Exception as e:
-            if e.error_code == 'BlobBeingRehydrated':
-                log.info(f'File {file} is already in the middle of rehydration')
-                q.task_done()
-                continue
-            log.error('File: %s', file)
-            log.error('Exception!', exc_info=e)
-            # log.error('Replacing file in queue.')
-            # q.put(file)
-
-for _ in range(ARGS.workers):
-    threading.Thread(target=worker, daemon=True).start()
-
-for azure_filename in BLOB_FILENAMES:
-    q.put(azure_filename)
-
-q.join()
+                with LOCK:
+                    COUNTS[state] += 1
+
+    def rehydrate_batch(batch):
+        azure_client.set_blob_tier_batch(CONTAINER, batch, TIER, RehydratePriority(ARGS.priority), COUNTS, LOCK)
+
+    POOL = WorkerPool(rehydrate_batch, ARGS.workers, ARGS.max_attempts, describe=lambda x: f'batch from {x[0]}')
+    dead_letters = POOL.run(azure_client.batched(needs_change(), ARGS.batch_size))
+    COUNTS['failed'] += sum(len(batch) for batch, _ in dead_letters)
+    log.info('Changed %d, skipped %d already at %s, %d already pending, %d failed.',
+             COUNTS['changed'], COUNTS['skipped'], ARGS.tier, COUNTS['pending'], COUNTS['failed'])
+    return dead_letters
+
+if ARGS.batch:
+    DEAD_LETTERS = rehydrate_batches()
+elif ARGS.use_async:
+    DEAD_LETTERS = asyncio.run(rehydrate_async())
+else:
+    POOL = WorkerPool(rehydrate, ARGS.workers, ARGS.max_attempts, describe=lambda x: x.name)
+    DEAD_LETTERS = POOL.run(BLOBS)
+if DEAD_LETTERS:
+    exit(1)
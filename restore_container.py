@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+'''Command line tool to restore an archived container, downloading blobs as soon as they are rehydrated'''
+import argparse
+import logging
+import os
+
+from azure.storage.blob import StandardBlobTier, RehydratePriority
+from dotenv import load_dotenv, find_dotenv
+
+from azure_client import azure_client, limiter, manifest, metrics, pack, restore
+from azure_client.dedup import ChunkStore
+from azure_client.logger import log, formatter
+from azure_client.transfer import TransferBudget
+from azure_client.workers import WorkerPool
+
+load_dotenv(find_dotenv())
+AZURE_URL, AZURE_KEY = os.getenv("AZURE_URL"), os.getenv("AZURE_KEY")
+
+PARSER = argparse.ArgumentParser(description='Rehydrate and download a container in one go')
+PARSER.add_argument('--container', '-c', required=True)
+PARSER.add_argument('--destination', '-d', required=True)
+PARSER.add_argument('--state', '-s', required=True, help='File to keep restore progress in, reuse it to resume')
+PARSER.add_argument('--prefix', help='Only restore blobs starting with this')
+PARSER.add_argument('--tier', '-t', default='Cool')
+PARSER.add_argument('--priority', '-p', default='Standard')
+PARSER.add_argument('--overwrite', '-o', action='store_false')
+PARSER.add_argument('--workers', '-w', default=1, type=int)
+PARSER.add_argument('--max-attempts', default=5, type=int,
+                    help='Tries per blob before giving up on it, for downloads and for tier changes')
+PARSER.add_argument('--debug', action='store_true')
+PARSER.add_argument('--logfile', '-l')
+PARSER.add_argument('--min-poll', default=60, type=float, help='Seconds between polls while blobs keep coming online')
+PARSER.add_argument('--max-poll', default=1800, type=float, help='Longest wait between polls')
+PARSER.add_argument('--chunk-size', default=4, type=int,
+                    help='Range size in MiB, ranges up to 4 get a checksum checked per request')
+PARSER.add_argument('--max-concurrency', default=4, type=int, help='Ranges of one blob downloading at once')
+PARSER.add_argument('--connections', type=int,
+                    help='Requests in flight across all workers, defaults to the larger of workers/max-concurrency')
+azure_client.add_connection_arguments(PARSER)
+metrics.add_metrics_arguments(PARSER)
+limiter.add_limit_arguments(PARSER)
+ARGS = PARSER.parse_args()
+metrics.start_from_args(ARGS)
+LIMITER = limiter.from_args(ARGS)
+
+if ARGS.logfile:
+    handler = logging.FileHandler(ARGS.logfile)
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+
+if ARGS.debug:
+    log.setLevel(logging.DEBUG)
+
+BUDGET = TransferBudget(ARGS.connections or max(ARGS.workers, ARGS.max_concurrency))
+STATE = restore.RestoreState(ARGS.state)
+
+SERVICE = azure_client.connect_service(
+    AZURE_URL, AZURE_KEY, limiter=LIMITER, **azure_client.connection_settings(ARGS, BUDGET.max_connections)
+)
+CHUNKS = ChunkStore(SERVICE) # Rebuilds dedup manifests, their chunk container is in each manifest
+CONTAINER = azure_client.connect_container(SERVICE, ARGS.container, create=False)
+
+PACKS = pack.group_by_pack(pack.load_index(CONTAINER), ARGS.prefix) # Only packs holding wanted files
+
+def download(BLOB_INFO):
+    if pack.is_pack_blob(BLOB_INFO.name):
+        failed = pack.extract_pack(
+            CONTAINER,
+            BLOB_INFO.name,
+            PACKS[BLOB_INFO.name],
+            ARGS.destination,
+            ARGS.overwrite,
+            chunk_size=ARGS.chunk_size * 1024 * 1024,
+            budget=BUDGET
+        )
+        STATE.set([BLOB_INFO.name], restore.FAILED if failed else restore.DOWNLOADED)
+        return
+    BLOB = CONTAINER.get_blob_client(BLOB_INFO.name)
+    operation = azure_client.download_blob(
+        BLOB,
+        BLOB_INFO,
+        ARGS.destination,
+        ARGS.overwrite,
+        chunk_size=ARGS.chunk_size * 1024 * 1024,
+        max_concurrency=ARGS.max_concurrency,
+        budget=BUDGET,
+        chunks=CHUNKS
+    )
+    blob_md5 = manifest.stored_md5(BLOB_INFO)
+    if operation.get('operation') == 'download' and blob_md5 and operation['md5'] != blob_md5:
+        STATE.set([BLOB_INFO.name], restore.FAILED)
+    else:
+        STATE.set([BLOB_INFO.name], restore.DOWNLOADED)
+
+FEED = restore.restore_feed(
+    CONTAINER,
+    STATE,
+    StandardBlobTier(ARGS.tier),
+    RehydratePriority(ARGS.priority),
+    name_starts_with=ARGS.prefix,
+    min_interval=ARGS.min_poll,
+    max_interval=ARGS.max_poll,
+    packs=PACKS,
+    max_attempts=ARGS.max_attempts
+)
+
+POOL = WorkerPool(download, ARGS.workers, ARGS.max_attempts, describe=lambda x: x.name)
+DEAD_LETTERS = POOL.run(FEED)
+STATE.set([x.name for x, _ in DEAD_LETTERS], restore.FAILED)
+log.info('Restore finished: %s', STATE.counts())
+FAILED = STATE.names(restore.FAILED)
+if FAILED:
+    log.error('%d blobs could not be restored, run again with the same --state to retry them:', len(FAILED))
+    for name in FAILED:
+        log.error('  %s', name)
+if DEAD_LETTERS or FAILED:
+    exit(1)
@@ -6,7 +6,8 @@ import os
 from azure.storage.blob import StandardBlobTier
 from dotenv import load_dotenv, find_dotenv
 
-from azure_client import azure_client
+from azure_client import azure_client, compress, fileio, limiter, metrics
+from azure_client.journal import BlockJournal
 
 load_dotenv(find_dotenv())
 AZURE_URL, AZURE_KEY = os.getenv("AZURE_URL"), os.getenv("AZURE_KEY")
@@ -16,24 +17,53 @@ PARSER.add_argument('--container', '-c')
 PARSER.add_argument('--filename', '-f')
 PARSER.add_argument('--overwrite', '-o', action='store_true')
 PARSER.add_argument('--tier', '-t')
+PARSER.add_argument('--resume-journal', '-r',
+                    help='Folder to journal staged blocks in so big uploads can resume after a crash')
+PARSER.add_argument('--block-size', '-b', default=4, type=int, help='Block size in MiB for big files')
+PARSER.add_argument('--max-concurrency', default=4, type=int, help='Blocks uploading at once')
+PARSER.add_argument('--mmap', action='store_true',
+                    help='Hash big files from memory maps, only safe when nothing truncates files during the run')
+azure_client.add_connection_arguments(PARSER)
+metrics.add_metrics_arguments(PARSER)
+limiter.add_limit_arguments(PARSER)
+compress.add_compression_arguments(PARSER)
 ARGS = PARSER.parse_args()
+if ARGS.mmap:
+    fileio.MMAP_THRESHOLD = fileio.DEFAULT_MMAP_THRESHOLD
+metrics.start_from_args(ARGS)
+LIMITER = limiter.from_args(ARGS)
+JOURNAL = BlockJournal(ARGS.resume_journal) if ARGS.resume_journal else None
+CODEC = compress.from_args(ARGS)
 
-SERVICE = azure_client.connect_service(AZURE_URL, AZURE_KEY)
+SERVICE = azure_client.connect_service(
+    AZURE_URL, AZURE_KEY, limiter=LIMITER, **azure_client.connection_settings(ARGS, ARGS.max_concurrency)
+)
 CONTAINER = azure_client.connect_container(SERVICE, ARGS.container)
 
-BLOB_FILENAMES = azure_client.get_blob_manifest(CONTAINER)
-
-if ARGS.filename in BLOB_FILENAMES:
+if CONTAINER.get_blob_client(ARGS.filename).exists():
     op = azure_client.upload_blob(
         CONTAINER,
         ARGS.filename,
         ARGS.filename,
         StandardBlobTier(ARGS.tier),
         update=True,
-        overwrite=ARGS.overwrite
+        overwrite=ARGS.overwrite,
+        block_size=ARGS.block_size * 1024 * 1024,
+        max_concurrency=ARGS.max_concurrency,
+        journal=JOURNAL,
+        codec=CODEC
     )
 else:
-    op = azure_client.upload_blob(CONTAINER, ARGS.filename, ARGS.filename, StandardBlobTier(ARGS.tier))
+    op = azure_client.upload_blob(
+        CONTAINER,
+        ARGS.filename,
+        ARGS.filename,
+        StandardBlobTier(ARGS.tier),
+        block_size=ARGS.block_size * 1024 * 1024,
+        max_concurrency=ARGS.max_concurrency,
+        journal=JOURNAL,
+        codec=CODEC
+    )
 print(op)
 
 # TODO: this may not work with absoulte filepaths correctly!
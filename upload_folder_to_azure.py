@@ -1,18 +1,21 @@
 #!/usr/bin/env python3
 '''Simple command line tool to upload a single file to a azure container'''
 import argparse
-from glob import glob, iglob
+import asyncio
 import os
-import pathlib
-import threading
-import queue
 import logging
 
 from azure.storage.blob import StandardBlobTier
 from dotenv import load_dotenv, find_dotenv
 
-from azure_client import azure_client
+from azure_client import azure_client, blob_index, compress, fileio, limiter, metrics, progress
+from azure_client.dedup import ChunkStore
+from azure_client.journal import BlockJournal
+from azure_client import manifest, pack, scanner
+from azure_client.prehash import prehash_plan
+from azure_client.transfer import TransferBudget
 from azure_client.logger import log, formatter
+from azure_client.workers import WorkerPool
 from azure_client.md5summer import md5summer
 
 load_dotenv(find_dotenv())
@@ -25,10 +28,50 @@ PARSER.add_argument('--overwrite', '-o', action='store_true')
 PARSER.add_argument('--tier', '-t', default='Archive')
 PARSER.add_argument('--strip-base-folder', '-s', action='store_true')
 PARSER.add_argument('--workers', '-w', default=1, type=int)
+PARSER.add_argument('--max-attempts', default=5, type=int, help='Tries per file before giving up on it')
 PARSER.add_argument('--debug', '-d', action='store_true')
 PARSER.add_argument('--logfile', '-l')
 PARSER.add_argument('--md5sums', '-m', required=True)
+PARSER.add_argument('--scan-workers', default=4, type=int, help='Threads listing the folder tree')
+PARSER.add_argument('--scan-snapshot', help='File to keep the last scan in, unchanged folders are not listed again')
+PARSER.add_argument('--resume-journal', '-r',
+                    help='Folder to journal staged blocks in so big uploads can resume after a crash')
+PARSER.add_argument('--block-size', '-b', default=4, type=int, help='Block size in MiB for big files')
+PARSER.add_argument('--max-concurrency', default=4, type=int, help='Blocks of one file uploading at once')
+PARSER.add_argument('--connections', type=int,
+                    help='Requests in flight across all workers, defaults to the larger of workers/max-concurrency')
+PARSER.add_argument('--async', dest='use_async', action='store_true',
+                    help='Use the asyncio engine, best for lots of small files')
+PARSER.add_argument('--concurrency', default=256, type=int, help='Requests in flight with --async')
+PARSER.add_argument('--hash-workers', type=int,
+                    help='Threads hashing files ahead of the uploads, defaults to the number of cores, 0 turns it off')
+PARSER.add_argument('--dedup', action='store_true',
+                    help='Split big files into content defined chunks and only send chunks not stored before')
+PARSER.add_argument('--chunk-container', help='Container the chunks go in, defaults to <container>-chunks')
+PARSER.add_argument('--chunk-index', help='SQLite file of chunks already stored, defaults to <md5sums>.chunks')
+PARSER.add_argument('--chunk-tier', default='Cool', choices=['Hot', 'Cool', 'Cold'],
+                    help='Tier of the chunks, always online so restores only have to rehydrate the manifests')
+PARSER.add_argument('--dedup-avg-size', default=1, type=int,
+                    help='Average chunk size in MiB, chunks run from a quarter to four times this')
+PARSER.add_argument('--pack', action='store_true',
+                    help='Put small files into tar pack blobs listed in an index blob instead of one blob each')
+PARSER.add_argument('--pack-size', default=256, type=int, help='Size in MiB a pack is closed at')
+PARSER.add_argument('--pack-threshold', default=1024, type=int, help='Files under this many KiB go in packs')
+PARSER.add_argument('--mmap', action='store_true',
+                    help='Hash big files from memory maps, only safe when nothing truncates files during the run')
+azure_client.add_connection_arguments(PARSER)
+metrics.add_metrics_arguments(PARSER)
+limiter.add_limit_arguments(PARSER)
+progress.add_progress_arguments(PARSER)
+compress.add_compression_arguments(PARSER)
+blob_index.add_index_arguments(PARSER)
 ARGS = PARSER.parse_args()
+if ARGS.mmap:
+    fileio.MMAP_THRESHOLD = fileio.DEFAULT_MMAP_THRESHOLD
+if (ARGS.dedup or ARGS.pack or ARGS.compress) and ARGS.use_async:
+    PARSER.error('--dedup, --pack and --compress only work with the threaded engine, drop --async')
+metrics.start_from_args(ARGS)
+LIMITER = limiter.from_args(ARGS)
 
 if ARGS.logfile:
     handler = logging.FileHandler(ARGS.logfile)
@@ -39,69 +82,128 @@ if ARGS.debug:
     log.setLevel(logging.DEBUG)
 
 MD5SUMS = md5summer(ARGS.md5sums)
+JOURNAL = BlockJournal(ARGS.resume_journal) if ARGS.resume_journal else None
+CODEC = compress.from_args(ARGS)
+BUDGET = TransferBudget(ARGS.connections or max(ARGS.workers, ARGS.max_concurrency))
 
-SERVICE = azure_client.connect_service(AZURE_URL, AZURE_KEY)
+SERVICE = azure_client.connect_service(
+    AZURE_URL, AZURE_KEY, limiter=LIMITER, **azure_client.connection_settings(ARGS, BUDGET.max_connections)
+)
 CONTAINER = azure_client.connect_container(SERVICE, ARGS.container)
-
-BLOB_FILENAMES = azure_client.get_blob_manifest(CONTAINER)
-
-# Getting the folders filenames and stripping absoulte paths for upload to azure, 
+CHUNKS = None
+if ARGS.dedup:
+    CHUNK_CONTAINER = ARGS.chunk_container or f'{ARGS.container}-chunks'
+    azure_client.connect_container(SERVICE, CHUNK_CONTAINER)
+    CHUNKS = ChunkStore(
+        SERVICE,
+        CHUNK_CONTAINER,
+        ARGS.chunk_index or f'{ARGS.md5sums}.chunks',
+        ARGS.dedup_avg_size * 1024 * 1024,
+        StandardBlobTier(ARGS.chunk_tier)
+    )
+
+INDEX = blob_index.from_args(ARGS, CONTAINER)
+REMOTE_INDEX = INDEX.remote_index() if INDEX is not None else manifest.get_remote_index(CONTAINER)
+PACKER = None
+if ARGS.pack:
+    PACKER = pack.Packer(
+        CONTAINER,
+        StandardBlobTier(ARGS.tier),
+        ARGS.pack_size * 1024 * 1024,
+        ARGS.pack_threshold * 1024,
+        ARGS.block_size * 1024 * 1024,
+        BUDGET,
+        MD5SUMS,
+        INDEX
+    )
+    REMOTE_INDEX.update(PACKER.remote_index(REMOTE_INDEX))
+
+# Getting the folders filenames and stripping absoulte paths for upload to azure,
 # cutting of first folder name if flagged. Added this flag since the container might be named the same as the folder
 # and then it would be silly to have a container named like movies with the only folder being movies in it.
-ABS_FOLDER = pathlib.Path(ARGS.folder)
-BASE_ABS_FOLDER = pathlib.Path(ARGS.folder).parents[0]
-
-file_list = [z for z in [ y for x in os.walk(ARGS.folder) for y in glob(os.path.join(x[0], '*'))] if not os.path.isdir(z)]
-
-if ARGS.folder.startswith('/'):
-    FINAL_FOLDER = str(pathlib.Path(ARGS.folder)).split(str(BASE_ABS_FOLDER) + os.sep)[1]
-    azure_filename_list = [ x.split(str(BASE_ABS_FOLDER) + os.sep)[-1] for x in file_list]
-    if ARGS.strip_base_folder:
-        azure_filename_list = [ x.split(str(FINAL_FOLDER) + os.sep)[-1] for x in azure_filename_list ]
-else:
-    FINAL_FOLDER = ARGS.folder
-    if ARGS.strip_base_folder:
-        azure_filename_list = [ x.split(str(FINAL_FOLDER) + os.sep)[-1] for x in file_list]
-    else:
-        azure_filename_list = [ x.split(str(BASE_ABS_FOLDER) + os.sep)[-1] for x in file_list]
+SCAN = scanner.scan_tree(ARGS.folder, ARGS.strip_base_folder, ARGS.scan_workers, ARGS.scan_snapshot)
 
 
 # Actually doing the upload
-q = queue.Queue()
-
-def worker():
-    while True:
-        try:
-            files = q.get()
-            filename, azure_filename = files
-            if azure_filename in BLOB_FILENAMES:
-                func_args = [
-                    CONTAINER,
-                    filename,
-                    azure_filename,
-                    StandardBlobTier(ARGS.tier),
-                    MD5SUMS,
-                    True,
-                    ARGS.overwrite,
-                    ARGS.debug
-                ]
-                func_kwargs = {}
-            else:
-                func_args = [CONTAINER, filename, azure_filename, StandardBlobTier(ARGS.tier)]
-                func_kwargs = {'debug': ARGS.debug}
-            azure_client.upload_blob(*func_args, **func_kwargs)
-        except Exception as e:
-            log.error('File: %s', azure_filename)
-            log.error('Exception!', exc_info=e)
-            log.error('Replacing file in queue.')
-            q.put(files)
-        q.task_done()
-
-for _ in range(ARGS.workers):
-    threading.Thread(target=worker, daemon=True).start()
-
-for filename, azure_filename in zip(file_list, azure_filename_list):
-    files = (filename, azure_filename)
-    q.put(files)
-
-q.join()
+def upload(item):
+    action, filename, azure_filename, remote, _ = item
+    if PACKER is not None and PACKER.wants(filename, azure_filename, remote):
+        PACKER.add(filename, azure_filename, remote)
+        return
+    azure_client.upload_blob(
+        CONTAINER,
+        filename,
+        azure_filename,
+        StandardBlobTier(ARGS.tier),
+        MD5SUMS,
+        update=action == manifest.UPDATE,
+        overwrite=ARGS.overwrite,
+        remote=remote,
+        debug=ARGS.debug,
+        block_size=ARGS.block_size * 1024 * 1024,
+        max_concurrency=ARGS.max_concurrency,
+        budget=BUDGET,
+        journal=JOURNAL,
+        chunks=CHUNKS,
+        codec=CODEC,
+        index=INDEX
+    )
+    if PACKER is not None:
+        PACKER.forget(azure_filename) # A plain blob now, an older packed copy must not shadow it
+
+PLAN = manifest.plan_uploads(
+    ((x.path, x.azure_name, x.size) for x in SCAN), REMOTE_INDEX, MD5SUMS, ARGS.overwrite
+)
+TO_SEND = (x for x in PLAN if x[0] != manifest.SKIP) # Streamed from the scan, never held as a whole
+PROGRESS = progress.from_args(ARGS)
+if PROGRESS is not None: # Totals grow as the scan goes, sizes come from it so nothing is stat'ed again
+    TO_SEND = PROGRESS.planned(TO_SEND, lambda x: x[4])
+if ARGS.hash_workers != 0:
+    TO_SEND = prehash_plan(TO_SEND, MD5SUMS, ARGS.hash_workers)
+
+async def upload_async():
+    from azure_client import aio_client
+    if LIMITER is not None:
+        log.warning('Bandwidth and request limits only apply to the threaded engine, --async runs unlimited.')
+    service = aio_client.connect_service(
+        AZURE_URL, AZURE_KEY, **azure_client.connection_settings(ARGS, ARGS.concurrency)
+    )
+    container = service.get_container_client(ARGS.container)
+
+    async def upload(item):
+        action, filename, azure_filename, remote, _ = item
+        await aio_client.upload_blob(
+            container,
+            filename,
+            azure_filename,
+            StandardBlobTier(ARGS.tier),
+            MD5SUMS,
+            update=action == manifest.UPDATE,
+            overwrite=ARGS.overwrite,
+            remote=remote,
+            block_size=ARGS.block_size * 1024 * 1024,
+            index=INDEX
+        )
+
+    try:
+        return await aio_client.run_pool(
+            upload,
+            aio_client.iterate_in_thread(TO_SEND),
+            ARGS.concurrency,
+            ARGS.max_attempts,
+            describe=lambda x: x[1]
+        )
+    finally:
+        await aio_client.close_service(service)
+
+if ARGS.use_async:
+    DEAD_LETTERS = asyncio.run(upload_async())
+else:
+    POOL = WorkerPool(upload, ARGS.workers, ARGS.max_attempts, describe=lambda x: x[1])
+    DEAD_LETTERS = POOL.run(TO_SEND)
+    if PACKER is not None:
+        DEAD_LETTERS += PACKER.close()
+if PROGRESS is not None:
+    PROGRESS.stop()
+if DEAD_LETTERS:
+    exit(1)